@@ -0,0 +1,181 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from pathlib import Path
+from typing import Union, List, Dict, Type, Tuple
+
+import xxhash
+from tqdm import tqdm
+
+from .file import File, fits_files, open_fits
+from .utilities import cache_directory
+
+HEADER_CARDS = ['OBSMODE', 'OBSTYPE', 'RUN', 'CAMERA', 'MJD-OBS'] + [f'L1_REF_{i}' for i in range(4)]
+FileEntry = namedtuple('FileEntry', ['filetypes', 'mos', 'lengths', 'header'])
+
+
+class FileCatalogue:
+    """
+    An on-disk catalogue of the fits files under `rootdir`, shared between python processes.
+    For each file it records which of `filetypes` it matches, whether it is MOS, its length in each part and the
+    primary header cards in `HEADER_CARDS`.
+    An entry is only recomputed (by opening the file) when the file's mtime or size changes, or when `version`
+    (the library version and the filetypes' patterns) does, so rescanning an unchanged archive only has to stat each file.
+    Filetypes whose matching depends on the database (`File.match_uses_database`) are matched again every time.
+    """
+    def __init__(self, rootdir: Union[Path, str], filetypes: List[Type[File]], fname: Union[Path, str] = None,
+                 version: str = ''):
+        self.rootdir = Path(rootdir)
+        self.filetypes = {f.__name__: f for f in filetypes}
+        self.fname = cache_directory() / 'file-catalogue.sqlite' if fname is None else Path(fname)
+        patterns = [(name, getattr(f, 'match_pattern', None), getattr(f, 'antimatch_pattern', None), list(map(str, f.parts)),
+                     getattr(f, 'match_uses_database', False)) for name, f in self.filetypes.items()]
+        self.version = f"{version}:{xxhash.xxh64(repr(patterns)).hexdigest()}"
+        self.entries = None  # {path: (mtime, size, entry)}, read from disk by `load`
+        self._connection = None
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.fname), timeout=10, isolation_level=None, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS files (rootdir TEXT, path TEXT, mtime REAL, size INTEGER, '
+                                     'version TEXT, entry TEXT, PRIMARY KEY (rootdir, path))')
+        return self._connection
+
+    def load(self) -> Dict[str, Tuple[float, int, FileEntry]]:
+        """
+        Returns the catalogued (mtime, size, entry) of each path (relative to rootdir), read from disk the first time
+        """
+        with self._lock:
+            if self.entries is None:
+                self.entries = {}
+                try:
+                    rows = self.connection.execute('SELECT path, mtime, size, entry FROM files WHERE rootdir = ? AND version = ?',
+                                                   (str(self.rootdir), self.version)).fetchall()
+                except sqlite3.Error as e:
+                    logging.warning(f"Could not read from the file catalogue {self.fname}: {e}")
+                    rows = []
+                for path, mtime, size, entry in rows:
+                    self.entries[path] = (mtime, size, FileEntry(**json.loads(entry)))
+            return self.entries
+
+    def relative(self, path: Union[Path, str]) -> str:
+        path = Path(path)
+        if path.is_absolute():
+            path = path.relative_to(self.rootdir)
+        return path.as_posix()
+
+    def static_filetypes(self) -> Dict[str, Type[File]]:
+        return {name: f for name, f in self.filetypes.items() if not getattr(f, 'match_uses_database', False)}
+
+    def dynamic_filetypes(self) -> Dict[str, Type[File]]:
+        return {name: f for name, f in self.filetypes.items() if getattr(f, 'match_uses_database', False)}
+
+    def describe(self, path: str, graph=None) -> FileEntry:
+        """
+        Open the file at `path` to find out what it is. Only the filetypes which don't depend on the database are matched.
+        """
+        with fits_files():
+            filetypes = [name for name, f in self.static_filetypes().items() if f.match_file(self.rootdir, Path(path), graph)]
+            if not filetypes:
+                return FileEntry(filetypes, None, {}, {})
+            return self.inspect(path, filetypes)
+
+    def inspect(self, path: str, filetypes: List[str], lengths: Dict[str, int] = None) -> FileEntry:
+        """
+        Read the header (and MOS flag) of a file matched by `filetypes` and, if it is MOS, the lengths of their parts
+        """
+        absolute = self.rootdir / path
+        lengths = {} if lengths is None else dict(lengths)
+        with fits_files():
+            header = open_fits(absolute)[0].header
+            cards = {k: header[k] for k in HEADER_CARDS if k in header}
+            mos = File.is_mos(header, absolute)
+            if mos:
+                for name in filetypes:
+                    for part in self.filetypes[name].parts:
+                        if str(part) not in lengths:
+                            lengths[str(part)] = self.filetypes[name].length(absolute, part)
+        return FileEntry(filetypes, mos, lengths, cards)
+
+    def store(self, path: str, mtime: float, size: int, entry: FileEntry):
+        with self._lock:
+            self.load()[path] = (mtime, size, entry)
+            try:
+                self.connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)',
+                                        (str(self.rootdir), path, mtime, size, self.version,
+                                         json.dumps(entry._asdict(), default=str)))
+            except sqlite3.Error as e:
+                logging.warning(f"Could not write to the file catalogue {self.fname}: {e}")
+
+    def catalogued(self, path: str, graph=None) -> FileEntry:
+        """
+        Returns the stored entry of a file (without the filetypes that depend on the database),
+        describing it again if it has changed since it was catalogued
+        """
+        stat = (self.rootdir / path).stat()
+        catalogued = self.load().get(path)
+        if catalogued is not None and catalogued[:2] == (stat.st_mtime, stat.st_size):
+            return catalogued[2]
+        entry = self.describe(path, graph)
+        self.store(path, stat.st_mtime, stat.st_size, entry)
+        return entry
+
+    def entry(self, path: Union[Path, str], graph=None) -> FileEntry:
+        """
+        Returns the catalogue entry of a file, matching the filetypes that depend on the database again
+        """
+        path = self.relative(path)
+        entry = self.catalogued(path, graph)
+        with fits_files():
+            dynamic = [name for name, f in self.dynamic_filetypes().items() if f.match_file(self.rootdir, Path(path), graph)]
+        if not dynamic:
+            return entry
+        if entry.mos is None:  # not matched by anything before, so the header has never been read
+            mtime, size, _ = self.entries[path]
+            self.store(path, mtime, size, self.inspect(path, [])._replace(filetypes=entry.filetypes))
+            entry = self.entries[path][2]
+        return entry._replace(filetypes=entry.filetypes + dynamic)
+
+    def matches(self, path: Union[Path, str], graph=None) -> List[Type[File]]:
+        return [self.filetypes[name] for name in self.entry(path, graph).filetypes]
+
+    def length(self, filetype: Type[File], path: Union[Path, str], part: str = None) -> int:
+        """
+        Returns filetype.length(path, part), only opening the file if it hasn't been catalogued
+        """
+        path = self.relative(path)
+        entry = self.catalogued(path)
+        if str(part) not in entry.lengths:
+            entry.lengths[str(part)] = filetype.length(self.rootdir / path, part)
+            mtime, size, _ = self.entries[path]
+            self.store(path, mtime, size, entry)
+        return entry.lengths[str(part)]
+
+    def scan(self, graph=None) -> Dict[Path, FileEntry]:
+        """
+        Returns the entry of every fits file under rootdir, describing only new or changed files
+        and forgetting those that have gone
+        """
+        found = {}
+        with self._lock:
+            self.connection.execute('BEGIN')
+            try:
+                for absolute in tqdm(sorted(self.rootdir.rglob('*.fit*')), desc='Scanning files'):
+                    found[absolute] = self.entry(absolute, graph)
+                gone = set(self.load()) - {self.relative(p) for p in found}
+                for path in gone:
+                    del self.entries[path]
+                self.connection.executemany('DELETE FROM files WHERE rootdir = ? AND path = ?',
+                                            [(str(self.rootdir), path) for path in gone])
+            finally:
+                self.connection.execute('COMMIT')
+        return found
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self.connection.execute('DELETE FROM files WHERE rootdir = ?', (str(self.rootdir),))
@@ -1,36 +1,46 @@
 import logging
 import os
+import pickle
 import re
 import time
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
-from functools import reduce
+from functools import reduce, partial
+from importlib.util import find_spec
 from pathlib import Path
 from textwrap import dedent
+from types import SimpleNamespace
 from typing import Union, List, Tuple, Type, Dict, Set, Callable, Optional
 from uuid import uuid4
 
-import graphviz
 import networkx as nx
 import pandas as pd
 import py2neo
 import textdistance
+import xxhash
 from networkx import NetworkXNoPath, NodeNotFound
-from networkx.drawing.nx_pydot import to_pydot
 from operator import mul
 from py2neo import ClientError, DatabaseError
+from py2neo.errors import ServiceUnavailable, ConnectionUnavailable, ConnectionBroken
 from tqdm import tqdm
 
-from .file import File, HDU
+from .catalogue import FileCatalogue
+from .file import File, HDU, fits_files
 from .graph import Graph, _convert_datatypes
 from .hierarchy import Multiple, Hierarchy, Graphable, OneOf
-from .path_finding import HierarchyGraph, get_all_class_bases
+from .path_finding import HierarchyGraph, get_all_class_bases, PathTable, hierarchy_hash
+from .__version__ import __version__
 from .readquery import Query
+from .readquery.cache import CompiledCypherCache, ResultCache
 from .readquery.exceptions import UserError, CardinalityError
 from .readquery.results import RowParser
-from .utilities import make_plural, make_singular
-from .writequery import Unwind
+from .notify import check_for_updates
+from .utilities import make_plural, make_singular, register_json_encoder, cache_directory
+from .writequery import Unwind, CypherQuery
+from .writequery.merging import QUERY_HASH_LABEL
 
+SCHEMA_VERSION = 1  # increment when the tables made by `Data._build_schema` change
 CONSTRAINT_FAILURE = re.compile(r"already exists with label `(?P<label>[^`]+)` and property "
                                 r"`(?P<idname>[^`]+)` = (?P<idvalue>[^`]+)$", flags=re.IGNORECASE)
 
@@ -83,6 +93,40 @@ def process_neo4j_error(data: 'Data', file: File, msg):
     logging.exception(f"filenames: {fname}, {file.fname}")
 
 
+def render_batch(filetype: Type[File], path: Path, slc: slice, part: str, rootdir: Path,
+                 collision_manager: str) -> Tuple[List[str], Dict, int, float]:
+    """
+    Read one batch of a file and render the cypher that writes it, without touching the database.
+    Module level so that it can be run in the worker processes of `Data.write_files`.
+    :return: cypher lines, parameters, total length of the file part, seconds taken
+    """
+    start = time.time()
+    with fits_files():  # every reader opens the file once and it is closed afterwards
+        with CypherQuery(collision_manager) as query:
+            filetype.read(rootdir, path, slc, part)
+            cypher, params = query.render_query(as_lines=True, parameterise=True)
+        length = filetype.length(rootdir / path, part)
+    return cypher, params, length, time.time() - start
+
+
+def rows_are_covered(rows: range, starts: List[int], ends: List[int]) -> bool:
+    """
+    Returns True if every row in `rows` lies within one of the inclusive intervals [starts[i], ends[i]]
+    """
+    if not len(rows):
+        return True
+    if rows.step != 1:
+        return all(any(s <= row <= e for s, e in zip(starts, ends)) for row in rows)
+    first, last = rows[0], rows[-1]
+    for s, e in sorted(zip(starts, ends)):  # walk through merged intervals until `last` is reached
+        if s > first:
+            return False
+        first = max(first, e + 1)
+        if first > last:
+            return True
+    return False
+
+
 def get_all_subclasses(cls: Type[Graphable]) -> List[Type[Graphable]]:
     all_subclasses = []
     for subclass in cls.__subclasses__():
@@ -232,6 +276,8 @@ def make_arrows(path, forwards: List[bool], descriptors=None):
 
 
 def plot_graph(G, fname, format):
+    import graphviz
+    from networkx.drawing.nx_pydot import to_pydot
     return graphviz.Source(to_pydot(G).to_string()).render(fname, format=format)
 
 
@@ -240,13 +286,15 @@ class Data:
     extra_hierarchies = []
 
     def __new__(cls, *args, **kwargs):
-        from fastapi.encoders import ENCODERS_BY_TYPE
-        ENCODERS_BY_TYPE[cls] = lambda x: x.as_dict()
+        register_json_encoder(cls, lambda x: x.as_dict())
         return super().__new__(cls)
 
     def __init__(self, rootdir: Union[Path, str] = None,
                  host: str = None, port=None, dbname=None,
-                 password=None, user=None, verbose=False):
+                 password=None, user=None, verbose=False, product_workers: int = 0, product_matrix: bool = False,
+                 result_cache: Union[bool, ResultCache] = False,
+                 pool_size: int = None, idle_timeout: float = None, fetch_size: int = 1000):
+        check_for_updates()
         self.verbose = verbose
         self.dbname = dbname or os.getenv('WEAVEIO_DB', 'production')
         self.host = host or os.getenv('WEAVEIO_HOST', '127.0.0.1')
@@ -258,38 +306,85 @@ class Data:
             raise ValueError(f"You must specify WEAVEIO_ROOTDIR as an environment variable or as an argument to Data (rootdir=...)")
         self.rootdir = Path(rootdir)
         self.write_allowed = False
-        self.query = Query(self)
-        self.rowparser = RowParser(self.rootdir)
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.fetch_size = fetch_size
+        self._neograph = None
+        self.rowparser = RowParser(self.rootdir, product_workers=product_workers, product_matrix=product_matrix)
         self.filelists = {}
-        self.hierarchy_graph = HierarchyGraph()
-        self.hierarchy_graph.initialise()
+        self.__dict__.update(self._load_schema())
+        self.path_table = PathTable(self.hierarchy_graph)
+        self.compiled_cache = CompiledCypherCache(version=f'{__version__}:{self.path_table.version}')
+        self.catalogue = FileCatalogue(self.rootdir, self.filetypes, version=f'{__version__}:{self.path_table.version}')
+        if result_cache is True:
+            result_cache = ResultCache(version=f'{__version__}:{self.host}:{self.port}:{self.dbname}')
+        self.result_cache = result_cache or None
+        self.query = Query(self)
+
+    def _schema_key(self) -> str:
+        """
+        The schema tables only depend on the hierarchy classes which are defined and on which of them this class uses
+        """
+        used = [h.__name__ for h in list(self.filetypes) + list(self.extra_hierarchies)]
+        return xxhash.xxh64(repr((SCHEMA_VERSION, __version__, type(self).__qualname__, used,
+                                  hierarchy_hash(get_all_subclasses(Hierarchy))))).hexdigest()
+
+    def _build_schema(self) -> Dict[str, object]:
+        """
+        Derive the hierarchy graph and the lookup tables of names, factors and relations from the hierarchy classes
+        """
+        schema = SimpleNamespace()
+        schema.hierarchy_graph = HierarchyGraph()
+        schema.hierarchy_graph.initialise()
         if self.filetypes:
-            self.hierarchies = hierarchies_from_files(*self.filetypes, templates=True)
+            schema.hierarchies = hierarchies_from_files(*self.filetypes, templates=True)
         else:
-            self.hierarchies = set()
-        self.hierarchies.update(set(self.extra_hierarchies))
-        self.hierarchies.update({hh for h in self.hierarchies for hh in get_all_class_bases(h)})
-        self.class_hierarchies = {h.__name__: h for h in self.hierarchies}
-        self.singular_hierarchies = {h.singular_name: h for h in self.hierarchies}  # type: Dict[str, Type[Hierarchy]]
-        self.plural_hierarchies = {h.plural_name: h for h in self.hierarchies if h.plural_name != 'graphables'}
-        self.factor_hierarchies = defaultdict(set)
-        for h in self.hierarchies:
+            schema.hierarchies = set()
+        schema.hierarchies.update(set(self.extra_hierarchies))
+        schema.hierarchies.update({hh for h in schema.hierarchies for hh in get_all_class_bases(h)})
+        schema.class_hierarchies = {h.__name__: h for h in schema.hierarchies}
+        schema.singular_hierarchies = {h.singular_name: h for h in schema.hierarchies}  # type: Dict[str, Type[Hierarchy]]
+        schema.plural_hierarchies = {h.plural_name: h for h in schema.hierarchies if h.plural_name != 'graphables'}
+        schema.factor_hierarchies = defaultdict(set)
+        for h in schema.hierarchies:
             for f in getattr(h, 'products_and_factors', []):
-                self.factor_hierarchies[f.lower()].add(h)
+                schema.factor_hierarchies[f.lower()].add(h)
             if h.idname is not None:
-                self.factor_hierarchies[h.idname].add(h)
-        self.factor_hierarchies = dict(self.factor_hierarchies)  # make sure we always get keyerrors when necessary!
-        self.factors = set(self.factor_hierarchies.keys())
-        self.plural_factors =  {make_plural(f.lower()): f.lower() for f in self.factors}
-        self.singular_factors = {f.lower() : f.lower() for f in self.factors}
-        self.singular_idnames = {h.idname: h for h in self.hierarchies if h.idname is not None}
-        self.plural_idnames = {make_plural(k): v for k,v in self.singular_idnames.items()}
-        self.relative_names = defaultdict(dict)
-        for h in self.hierarchies:
+                schema.factor_hierarchies[h.idname].add(h)
+        schema.factor_hierarchies = dict(schema.factor_hierarchies)  # make sure we always get keyerrors when necessary!
+        schema.factors = set(schema.factor_hierarchies.keys())
+        schema.plural_factors =  {make_plural(f.lower()): f.lower() for f in schema.factors}
+        schema.singular_factors = {f.lower() : f.lower() for f in schema.factors}
+        schema.singular_idnames = {h.idname: h for h in schema.hierarchies if h.idname is not None}
+        schema.plural_idnames = {make_plural(k): v for k,v in schema.singular_idnames.items()}
+        schema.relative_names = defaultdict(dict)
+        for h in schema.hierarchies:
             for name, relation in h.relative_names.items():
-                self.relative_names[name][h.__name__] = relation
-        self.relative_names = dict(self.relative_names)
-        self.plural_relative_names = {make_plural(name): name for name in self.relative_names}
+                schema.relative_names[name][h.__name__] = relation
+        schema.relative_names = dict(schema.relative_names)
+        schema.plural_relative_names = {make_plural(name): name for name in schema.relative_names}
+        return vars(schema)
+
+    def _load_schema(self) -> Dict[str, object]:
+        """
+        Returns `_build_schema()`, using a snapshot on disk if the hierarchy classes have not changed since it was made
+        """
+        fname = cache_directory() / f'schema-{self._schema_key()}.pkl'
+        try:
+            with open(fname, 'rb') as f:
+                return pickle.load(f)
+        except Exception:  # missing, corrupt, or refers to classes that no longer exist
+            pass
+        schema = self._build_schema()
+        tmp = fname.with_name(f'{fname.name}.{os.getpid()}.tmp')
+        try:
+            snapshot = pickle.dumps(schema, protocol=pickle.HIGHEST_PROTOCOL)
+            with open(tmp, 'wb') as f:
+                f.write(snapshot)
+            os.replace(tmp, fname)
+        except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+            logging.warning(f"Could not save a snapshot of the schema to {fname}: {e}")
+        return schema
 
     def __repr__(self):
         return f'<Data({self.user}@{self.host}[{self.dbname}]:{self.port}:{self.rootdir})>'
@@ -347,16 +442,15 @@ class Data:
             Find the shortest path in one direction, but search both directions, both are equally valid
             If more than one path is returned, throw an ambiguous path exception
 
+        The answer only depends on the hierarchies, so it is looked up in (and stored to) the persistent `path_table`
         """
-        paths = list(self.hierarchy_graph.find_paths(from_obj, to_obj, singular))
-        if not paths:
-            if singular:
-                raise NetworkXNoPath(f"No singular path found between `{from_obj}` and `{to_obj}`")
-            raise NetworkXNoPath(f"No path found between `{from_obj}` and `{to_obj}`")
-        paths, edges, reversed = zip(*[(path[::-1], [self.hierarchy_graph.short_edge(e[1], e[0]) for e in es[::-1]], True) if path[0] is to_obj else (path, es, False) for path, es in paths])
-        singulars = [self.hierarchy_graph.edge_path_is_singular(es) for es in edges]
-        return paths, singulars, reversed
+        return self.path_table.lookup(from_obj, to_obj, singular)
 
+    def build_path_table(self):
+        """
+        Find the paths between every pair of hierarchies now, rather than when they are first queried
+        """
+        self.path_table.build(self.hierarchies)
 
     def parents_of_defined_child(self, potential_child: Type[Hierarchy]) -> Set[Type[Hierarchy]]:
         parents = {h for h in self.hierarchies if potential_child in [c.node if isinstance(c, Multiple) else c for c in h.children]}
@@ -407,7 +501,7 @@ class Data:
     def write_cypher(self, collision_manager='track&flag'):
         if self.write_allowed:
             return self.graph.write(collision_manager)
-        raise IOError(f"You have not allowed write operations in this instance of data (write=False)")
+        raise IOError("You have not allowed write operations in this instance of data (write=False)")
 
     @property
     @contextmanager
@@ -419,14 +513,138 @@ class Data:
     def is_unique_factor(self, name):
         return len(self.factor_hierarchies[name]) == 1
 
+    @property
+    def neograph(self) -> py2neo.Graph:
+        """
+        The py2neo graph (and so the pool of connections to the database) that this object uses for its whole life.
+        It is made the first time it is needed. At most `pool_size` connections are kept and connections older
+        than `idle_timeout` seconds are replaced (py2neo's defaults are used if these are None).
+        """
+        if self._neograph is None:
+            d = {}
+            if self.password is not None:
+                d['password'] = self.password
+            if self.user is not None:
+                d['user'] = self.user
+            if self.pool_size is not None:
+                d['max_size'] = self.pool_size
+            if self.idle_timeout is not None:
+                d['max_age'] = self.idle_timeout
+            self._neograph = py2neo.Graph(host=self.host, port=self.port, name=self.dbname, **d)
+        return self._neograph
+
     @property
     def graph(self):
-        d = {}
-        if self.password is not None:
-            d['password'] = self.password
-        if self.user is not None:
-            d['user'] = self.user
-        return Graph(host=self.host, port=self.port, name=self.dbname, write=self.write_allowed, **d)
+        """
+        A read-only or write `Graph` (depending on whether writing is allowed right now) which shares the connection pool
+        """
+        return Graph(neograph=self.neograph, write=self.write_allowed)
+
+    def check_connection(self) -> bool:
+        """
+        Check that the database answers, reconnecting once if it doesn't. Returns whether it is reachable.
+        """
+        for _ in range(2):
+            try:
+                return self.neograph.evaluate('RETURN 1') == 1
+            except (ServiceUnavailable, ConnectionUnavailable, ConnectionBroken, OSError) as e:
+                logging.warning(f"Could not reach the database at {self.host}:{self.port}: {e}")
+                self.close()
+        return False
+
+    def close(self):
+        """
+        Close all connections to the database. They are reopened when next needed.
+        """
+        if self._neograph is not None:
+            self._neograph.service.connector.close()
+            self._neograph = None
+        if getattr(self, '_driver', None) is not None:
+            self._driver.close()
+            self._driver = None
+
+    def high_water_mark(self):
+        """
+        The latest `_dbupdated` time of any object and the numbers of nodes and relationships in the database.
+        The time changes whenever anything is written and the counts also change when anything is deleted.
+        The counts come from neo4j's count store, so this is as quick as the time alone.
+        """
+        return self.graph.neograph.evaluate('CALL { MATCH (n) RETURN count(n) as nodes }\n'
+                                            'CALL { MATCH ()-[r]->() RETURN count(r) as relationships }\n'
+                                            'CALL { OPTIONAL MATCH (n:Hierarchy) WHERE n._dbupdated IS NOT NULL '
+                                            'RETURN n._dbupdated as updated ORDER BY updated DESC LIMIT 1 }\n'
+                                            'RETURN [updated, nodes, relationships]')
+
+    def _make_driver(self, driver_class):
+        auth = None if self.user is None else (self.user, self.password)
+        config = {} if self.pool_size is None else {'max_connection_pool_size': self.pool_size}
+        return driver_class.driver(f'bolt://{self.host}:{self.port}', auth=auth, **config)
+
+    @property
+    def driver(self):
+        """
+        A neo4j driver for this database, made the first time it is needed.
+        Unlike py2neo, it pulls the records of a query from the server `fetch_size` at a time (see `stream`).
+        This needs the official neo4j driver (`pip install neo4j`) which is not otherwise required.
+        """
+        if getattr(self, '_driver', None) is None:
+            try:
+                from neo4j import GraphDatabase
+            except ImportError as e:
+                raise ImportError("Streaming queries need the neo4j driver, run `pip install neo4j`") from e
+            self._driver = self._make_driver(GraphDatabase)
+        return self._driver
+
+    @property
+    def async_driver(self):
+        """
+        A neo4j async driver for this database, made the first time it is needed.
+        This needs the official neo4j driver (`pip install neo4j`) which is not otherwise required.
+        """
+        if getattr(self, '_async_driver', None) is None:
+            try:
+                from neo4j import AsyncGraphDatabase
+            except ImportError as e:
+                raise ImportError("Asynchronous queries need the neo4j driver, run `pip install neo4j`") from e
+            self._async_driver = self._make_driver(AsyncGraphDatabase)
+        return self._async_driver
+
+    def stream(self, cypher: str, parameters: dict, fetch_size: int = None):
+        """
+        Run a read query with the neo4j driver and yield its records one by one.
+        Records are pulled from the server `fetch_size` (default `Data.fetch_size`) at a time as they are consumed,
+        so only that many are held at once. Parameters are converted in the same way as `Graph.execute`.
+        """
+        parameters = _convert_datatypes(parameters, nan2missing=True, none2missing=True)
+        with self.driver.session(database=self.dbname, fetch_size=fetch_size or self.fetch_size) as session:
+            yield from session.run(cypher, parameters)
+
+    def read_records(self, cypher: str, parameters: dict):
+        """
+        The records of a read query. If the neo4j driver is installed, they are pulled from the server `fetch_size`
+        at a time with `stream`, otherwise py2neo receives the whole result before the first record is returned.
+        """
+        if find_spec('neo4j') is None:
+            return self.graph.execute(cypher, **parameters)
+        return self.stream(cypher, parameters)
+
+    async def astream(self, cypher: str, parameters: dict, chunksize: int = None):
+        """
+        Run a read query with the async driver and yield its records in lists of up to `chunksize` (`fetch_size` by default).
+        Parameters are converted in the same way as `Graph.execute`.
+        """
+        chunksize = chunksize or self.fetch_size
+        parameters = _convert_datatypes(parameters, nan2missing=True, none2missing=True)
+        async with self.async_driver.session(database=self.dbname, fetch_size=chunksize) as session:
+            result = await session.run(cypher, parameters)
+            chunk = []
+            async for record in result:
+                chunk.append(record)
+                if len(chunk) == chunksize:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
 
     def make_constraints_cypher(self) -> Dict[str, List[str]]:
         d = {hierarchy: hierarchy.make_schema() for hierarchy in self.hierarchies}
@@ -544,17 +762,41 @@ class Data:
         return q, {'_check_fname': fname, '_check_completed': completed,
                    '_check_parts': list(map(str, all_parts)), '_check_total_length': total_length}
 
+    def file_length(self, filetype: Type[File], path: Path, part: str) -> int:
+        """
+        Returns the number of rows in the file[part], kept in the file catalogue so that it is only read once
+        """
+        return self.catalogue.length(filetype, path, part)
+
+    def batches_are_complete(self, batches: List[Tuple[Type[File], Path, slice, str]]) -> List[bool]:
+        """
+        Returns True for each (filetype, path, slice, part) batch that is already complete in the database.
+        The completed intervals of all files are fetched in one query and compared locally.
+        """
+        if not batches:
+            return []
+        q = dedent("""
+        UNWIND $fnames as fname
+        MATCH (f:File {fname: fname})
+        RETURN fname, [k in keys(f) WHERE k STARTS WITH '_dbcompleted_' | [k, f[k]]]
+        """)
+        fnames = list({path.name for filetype, path, slc, part in batches})
+        completed = {fname: dict(pairs) for fname, pairs in self.graph.execute(q, fnames=fnames)}
+        complete = []
+        for filetype, path, slc, part in batches:
+            done = completed.get(path.name)
+            if done is None or f'_dbcompleted_{part}_start' not in done:
+                complete.append(False)
+                continue
+            rows = range(self.file_length(filetype, path, part))[slc]
+            complete.append(rows_are_covered(rows, done[f'_dbcompleted_{part}_start'], done[f'_dbcompleted_{part}_end']))
+        return complete
+
     def file_batch_is_complete(self, filetype: File, path: Path, slc: slice, part: str) -> bool:
         """
         Returns True if the file[rows-slice][part] is complete otherwise False
         """
-        total_length = filetype.length(self.rootdir / path, part)
-        q = dedent(f"""
-        OPTIONAL MATCH (f:File {{fname: $fname}})
-        with f, apoc.coll.zip(f._dbcompleted_{part}_start, f._dbcompleted_{part}_end) as intervals
-        return all(x in $rows where any(i in intervals where i[0] <= x and x <= i[1]))
-        """)
-        return self.graph.execute(q, fname=path.name, rows=list(range(total_length)[slc])).evaluate() or False
+        return self.batches_are_complete([(filetype, path, slc, part)])[0]
 
     def files_to_batches(self, *paths: Union[Path, str], batch_size=None, batches_slc=None, parts=None,
                          skip_complete=False):
@@ -566,42 +808,96 @@ class Data:
         bar = tqdm(paths, desc='Building todo list')
         for path in bar:
             path = Path(path)
-            matches = [f for f in self.filetypes if f.match_file(self.rootdir, path.relative_to(self.rootdir), self.graph)]
+            matches = self.catalogue.matches(path, self.graph)
             if len(matches) > 1:
                 raise ValueError(f"{path} matches more than 1 file type: {matches} with `{[m.match_pattern for m in matches]}`")
             filetype = matches[0]
             filetype_batch_size = filetype.recommended_batchsize if batch_size is None else batch_size
-            slices = filetype.get_batches(path, filetype_batch_size, parts, batches_slc)
-            bs = [(filetype, path.relative_to(self.rootdir), slc, part) for slc, part in slices]
-            if skip_complete:
-                bs = [b for b in bs if not self.file_batch_is_complete(*b)]
-            batches += bs
+            slices = filetype.get_batches(path, filetype_batch_size, parts, batches_slc, partial(self.file_length, filetype))
+            batches += [(filetype, path.relative_to(self.rootdir), slc, part) for slc, part in slices]
+        if skip_complete:
+            batches = [b for b, complete in zip(batches, self.batches_are_complete(batches)) if not complete]
         batches.sort(key=lambda b: (self.filetypes.index(b[0]), b[1]))  # make sure files are ingested in order of dependency
         return batches
 
+    def remove_query_hashes(self):
+        """
+        Remove the `_query_hash` which keeps relationships merged in the same write query apart.
+        Only relationships of nodes created by a write carry it and those nodes are labelled with `QUERY_HASH_LABEL`,
+        so this touches only what the last write made rather than scanning the whole database.
+        This is done before and after every write in `write_files`, so it is also where the result cache is emptied.
+        """
+        if self.result_cache is not None:
+            self.result_cache.clear()
+        return self.graph.execute(f'MATCH (n:{QUERY_HASH_LABEL}) OPTIONAL MATCH (n)-[r]-() WHERE r._query_hash IS NOT NULL '
+                                  f'REMOVE r._query_hash, n:{QUERY_HASH_LABEL}')
+
+    def rendered_batches(self, batches, collision_manager='ignore', workers=0, queue_depth=2,
+                         skip: List[bool] = None):
+        """
+        Yield each batch in order alongside a function returning its rendered cypher, parameters, length and render time.
+        The function is None for batches flagged in `skip`.
+        With `workers` > 0, batches are rendered in a process pool, keeping up to `queue_depth` batches in flight
+        beyond the one being yielded, so that reading files overlaps with writing the previous batch.
+        """
+        if skip is None:
+            skip = [False] * len(batches)
+        if not workers:
+            for batch, skipped in zip(batches, skip):
+                yield batch, None if skipped else partial(render_batch, *batch, self.rootdir, collision_manager)
+            return
+        pending = deque()
+        todo = zip(batches, skip)
+        with ProcessPoolExecutor(workers) as pool:
+            try:
+                while True:
+                    while len(pending) <= queue_depth:
+                        batch, skipped = next(todo, (None, None))
+                        if batch is None:
+                            break
+                        if skipped:
+                            pending.append((batch, None))
+                        else:
+                            pending.append((batch, pool.submit(render_batch, *batch, self.rootdir, collision_manager)))
+                    if not pending:
+                        return
+                    batch, future = pending.popleft()
+                    yield batch, None if future is None else future.result
+            finally:
+                for _, future in pending:  # closed early, so don't wait for the renders nobody will write
+                    if future is not None:
+                        future.cancel()
+
     def write_files(self, *paths: Union[Path, str], raise_on_duplicate_file=False, skip_complete=True,
                     collision_manager='ignore', batch_size=None, parts=None, halt_on_error=True,
                     dryrun=False, do_not_apply_constraints=False, test_one=False, batches_slc: slice = None,
                     debug=False, debug_time=False, debug_params=False, debug_plan=False, timeout=None,
-                    replan='skip_except_first', runtime='pipelined',
+                    replan='skip_except_first', runtime='pipelined', workers=0, queue_depth=2,
                     ) -> Optional[pd.DataFrame]:
         """
         Read in the files given in `paths` to the database.
         `collision_manager` is the method with which the database deals with overwriting data.
         Values of `collision_manager` can be {'ignore', 'overwrite', 'track&flag'}.
         track&flag will have the same behaviour as ignore but places the overlapping data in its own node for later retrieval.
+        If `workers` > 0, batches are read and rendered by that many processes, up to `queue_depth` batches ahead of
+        the one being written, whilst a single writer executes them in order of dependency.
         :return
-            statistics dataframe
+            statistics dataframe, with the time spent reading/rendering (`render_time`),
+            waiting for the render (`wait_time`) and writing (`elapsed_time`) each batch
         """
         if not halt_on_error:
             logging.warning(f"`halt_on_error` is set to False. This would allow files to read without first reading their dependent files. "
                             f"This is not recommended.")
         if not do_not_apply_constraints:
             self.apply_constraints()
+        if not self.write_allowed:
+            raise IOError("You have not allowed write operations in this instance of data (write=False)")
         batches = self.files_to_batches(*paths, batch_size=batch_size, batches_slc=batches_slc, parts=parts)
         if not batches:
             return
         elapsed_times = []
+        render_times = []
+        wait_times = []
         stats = []
         timestamps = []
         if dryrun:
@@ -614,96 +910,103 @@ class Data:
             with open('debug-timestamp.log', 'w') as f:
                 pass
         out_batches = []
-        for i, (filetype, path, slc, part) in enumerate(bar):
-            bar.set_description(f'{path}[{slc.start}:{slc.stop}:{part}]')
-            try:
-                if raise_on_duplicate_file:
-                    if len(self.graph.execute('MATCH (f:File {fname: $fname}) return count(f)', fname=path.name)) != 0:
-                        raise FileExistsError(f"{path.name} exists in the DB and raise_on_duplicate_file=True")
-                if skip_complete:
-                    if self.file_batch_is_complete(filetype, path, slc, part):
+        skip = self.batches_are_complete(batches) if skip_complete else None
+        rendered = self.rendered_batches(batches, collision_manager, workers, queue_depth, skip)
+        try:
+            for i, ((filetype, path, slc, part), render) in enumerate(zip(bar, rendered)):
+                bar.set_description(f'{path}[{slc.start}:{slc.stop}:{part}]')
+                try:
+                    if raise_on_duplicate_file:
+                        if len(self.graph.execute('MATCH (f:File {fname: $fname}) return count(f)', fname=path.name)) != 0:
+                            raise FileExistsError(f"{path.name} exists in the DB and raise_on_duplicate_file=True")
+                    if render is None:
                         continue
-                with self.write_cypher(collision_manager) as query:
-                    filetype.read(self.rootdir, path, slc, part)
-                    cypher, params = query.render_query(as_lines=True)
-                    uuid = f"//{uuid4()}"
-                    guarantee, added_data = self.mark_batch_complete_query(path.name, slc, part, filetype.length(self.rootdir / path, part), filetype.parts)
+                    waiting = time.time()
+                    cypher, params, total_length, render_time = render()
+                    wait_time = time.time() - waiting
+                    tag = str(uuid4())  # a parameter rather than a comment, so that the cypher text is the same for every batch
+                    guarantee, added_data = self.mark_batch_complete_query(path.name, slc, part, total_length, filetype.parts)
                     if replan == 'skip_except_first':
                         replan_cypher = f'CYPHER replan=skip'
                         replan = 'skip'
                     else:
                         replan_cypher = f'CYPHER replan={replan}'
-                    lines = [uuid, f'CYPHER runtime={runtime}', replan_cypher]  # runtime is to avoid neo4j bug with pipelines: https://github.com/neo4j/neo4j/issues/12441
+                    lines = [f'CYPHER runtime={runtime}', replan_cypher]  # runtime is to avoid neo4j bug with pipelines: https://github.com/neo4j/neo4j/issues/12441
                     if debug_plan:
                         lines.append('PROFILE')
                     lines += cypher[:-1] + ['WITH time0', guarantee, cypher[-1]]
                     params.update(added_data)
+                    params['_query_tag'] = tag
                     cypher = '\n'.join(lines)
-                if debug:
-                    with open('debug-query.log', 'w') as f:
-                        f.write(cypher)
-                    if debug_params:
-                        with open('debug-params.log', 'w') as f:
-                            f.write(self.graph.output_for_debug(**params, arrow=False, cmdline=False, silent=True))
-                start = time.time()
-                timed_out = False
-                if not dryrun:
-                    try:
-                        self.graph.execute('MATCH (n) remove n._query_hash')
-                        self.graph.execute('MATCH ()-[r]-() remove r._query_hash')
-                        results = self.graph.execute(cypher, **params)
-                        stats.append(results.stats())
-                        timestamp = results.evaluate()
-                        successful = True
-                    except (ConnectionError, RuntimeError, IndexError, ConnectionResetError) as e:
-                        is_running = True
-                        timed_out = False
-                        while is_running:
-                            is_running = self.graph.execute("CALL dbms.listQueries() YIELD query WHERE query STARTS WITH $uuid return count(*)", uuid=uuid).evaluate()
-                            time.sleep(1)
-                            bar.set_description(f'{path}[{slc.start}:{slc.stop}:{part}]')
-                            if timeout is not None:
-                                if time.time() - start > timeout:
-                                    timed_out = True
-                                    break
-                        r = self.graph.execute('MATCH (f:File {fname: $fname}) return timestamp()', fname=path.name)
-                        timestamp = r.evaluate()
-                        successful = timestamp is not None
-                        stats.append(r.stats())
-                        if not successful and halt_on_error:
-                            if timed_out:
-                                raise ConnectionTimeOutError(f"Connection timed out whilst writing {path}{slc.start}:{slc.stop}:{part} and it failed") from e
-                            else:
-                                raise ConnectionError(f"{path} could not be written to the database see neo4j logs for more details") from e
-                    finally:
-                        self.graph.execute('MATCH (n) remove n._query_hash')
-                        self.graph.execute('MATCH ()-[r]-() remove r._query_hash')
-                    if timestamp is None:
-                        logging.warning(f"This query terminated early due to either an empty input table/data or "
-                                        f"a match within the query returned no matches or it timed-out. "
-                                        f"Adjust your `.read` method and query to allow for empty tables/data")
-                    timestamps.append(timestamp)
-                    if successful:
-                        elapsed_times.append(time.time() - start)
-                    else:
-                        elapsed_times.append(-1)
-                    out_batches.append((filetype, path, slc, part))
-                    if debug or debug_time:
-                        with open('debug-timestamp.log', 'a') as f:
-                            f.write(str(elapsed_times[-1]) + '\n')
-            except (ClientError, DatabaseError, FileExistsError, ConnectionError) as e:
-                logging.exception('ClientError:', exc_info=True)
-                if halt_on_error:
-                    raise e
-                print(e)
-            if test_one:
-                batches = batches[i:i+1]
-                logging.info(f"Writing terminated because `test_one=True`")
-                break
+                    if debug:
+                        with open('debug-query.log', 'w') as f:
+                            f.write(cypher)
+                        if debug_params:
+                            with open('debug-params.log', 'w') as f:
+                                f.write(self.graph.output_for_debug(**params, arrow=False, cmdline=False, silent=True))
+                    start = time.time()
+                    timed_out = False
+                    if not dryrun:
+                        try:
+                            self.remove_query_hashes()
+                            results = self.graph.execute(cypher, **params)
+                            stats.append(results.stats())
+                            timestamp = results.evaluate()
+                            successful = True
+                        except (ConnectionError, RuntimeError, IndexError, ConnectionResetError) as e:
+                            is_running = True
+                            timed_out = False
+                            while is_running:
+                                is_running = self.graph.execute("CALL dbms.listQueries() YIELD parameters WHERE parameters._query_tag = $tag return count(*)", tag=tag).evaluate()
+                                time.sleep(1)
+                                bar.set_description(f'{path}[{slc.start}:{slc.stop}:{part}]')
+                                if timeout is not None:
+                                    if time.time() - start > timeout:
+                                        timed_out = True
+                                        break
+                            r = self.graph.execute('MATCH (f:File {fname: $fname}) return timestamp()', fname=path.name)
+                            timestamp = r.evaluate()
+                            successful = timestamp is not None
+                            stats.append(r.stats())
+                            if not successful and halt_on_error:
+                                if timed_out:
+                                    raise ConnectionTimeOutError(f"Connection timed out whilst writing {path}{slc.start}:{slc.stop}:{part} and it failed") from e
+                                else:
+                                    raise ConnectionError(f"{path} could not be written to the database see neo4j logs for more details") from e
+                        finally:
+                            self.remove_query_hashes()
+                        if timestamp is None:
+                            logging.warning(f"This query terminated early due to either an empty input table/data or "
+                                            f"a match within the query returned no matches or it timed-out. "
+                                            f"Adjust your `.read` method and query to allow for empty tables/data")
+                        timestamps.append(timestamp)
+                        if successful:
+                            elapsed_times.append(time.time() - start)
+                        else:
+                            elapsed_times.append(-1)
+                        render_times.append(render_time)
+                        wait_times.append(wait_time)
+                        out_batches.append((filetype, path, slc, part))
+                        if debug or debug_time:
+                            with open('debug-timestamp.log', 'a') as f:
+                                f.write(str(elapsed_times[-1]) + '\n')
+                except (ClientError, DatabaseError, FileExistsError, ConnectionError) as e:
+                    logging.exception('ClientError:', exc_info=True)
+                    if halt_on_error:
+                        raise e
+                    print(e)
+                if test_one:
+                    batches = batches[i:i+1]
+                    logging.info(f"Writing terminated because `test_one=True`")
+                    break
+        finally:
+            rendered.close()  # shuts down any render workers, also when writing fails
         if len(out_batches) and not dryrun:
             df = pd.DataFrame(stats)
             df['timestamp'] = timestamps
             df['elapsed_time'] = elapsed_times
+            df['render_time'] = render_times
+            df['wait_time'] = wait_times
             _, df['fname'], slcs, parts = zip(*out_batches)
             df['batch_start'], df['batch_end'] = zip(*[(i.start, i.stop) for i in slcs])
             df['part'] = parts
@@ -712,7 +1015,7 @@ class Data:
             # df = pd.DataFrame(columns=['elapsed_time', 'fname', 'batch_start', 'batch_end', 'part'])
             # df['elapsed_time'] = elapsed_times
         else:
-            df = pd.DataFrame(columns=['timestamp', 'elapsed_time', 'fname', 'batch_start', 'batch_end'])
+            df = pd.DataFrame(columns=['timestamp', 'elapsed_time', 'render_time', 'wait_time', 'fname', 'batch_start', 'batch_end', 'part'])
         if dryrun:
             return
         return df.set_index(['fname', 'batch_start', 'batch_end', 'part'])
@@ -728,8 +1031,9 @@ class Data:
         else:
             filetypes = [f for f in self.filetypes if f.singular_name in filetype_names]
 
+        entries = self.catalogue.scan(self.graph)
         for filetype in filetypes:
-            filelist += sorted([i for i in filetype.match_files(self.rootdir, self.graph)], key=lambda f: f.name)
+            filelist += sorted([path for path, entry in entries.items() if filetype.__name__ in entry.filetypes], key=lambda f: f.name)
         if skip_complete_files:
             extant_fnames = self.get_complete_files() if skip_complete_files else []
             filtered_filelist = [i for i in filelist if str(i.name) not in extant_fnames]
@@ -738,7 +1042,7 @@ class Data:
         diff = len(filelist) - len(filtered_filelist)
         if diff:
             print(f'Skipping {diff} complete files (use skip_complete_files=False to go over them again)')
-        return [f for f in tqdm(filtered_filelist, desc='getting MOS files') if File.check_mos(f)]
+        return [f for f in filtered_filelist if entries[f].mos]
 
     def write_directory(self, *filetype_names, collision_manager='ignore', skip_extant_files=True, halt_on_error=False,
                         batch_size=None, parts=None, dryrun=False, **kwargs) -> pd.DataFrame:
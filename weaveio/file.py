@@ -1,14 +1,77 @@
 import re
+from contextlib import contextmanager
 from pathlib import Path
-from typing import Union, List, Tuple, Dict
+from typing import Union, List, Tuple, Dict, Callable
 
 from astropy.io import fits
 from astropy.io.fits.hdu.base import _BaseHDU
+from astropy.table import Table as AstropyTable
 
+from weaveio.context import ContextMeta
 from weaveio.graph import Graph
 from weaveio.hierarchy import Hierarchy, Multiple
 
 
+class FitsFiles(metaclass=ContextMeta):
+    """
+    The fits files opened (and tables decoded) whilst reading a file, so that each is only opened once.
+    Use `fits_files()` to make one, which closes them all on exit.
+    """
+    def __init__(self):
+        self.hdulists = {}  # type: Dict[str, fits.HDUList]
+        self.tables = {}  # type: Dict[Tuple[str, Union[int, str]], AstropyTable]
+
+    def open(self, path: Union[Path, str]) -> fits.HDUList:
+        key = str(path)
+        if key not in self.hdulists:
+            self.hdulists[key] = fits.open(path)
+        return self.hdulists[key]
+
+    def table(self, path: Union[Path, str], ext: Union[int, str]) -> AstropyTable:
+        key = (str(path), ext)
+        if key not in self.tables:
+            self.tables[key] = AstropyTable(self.open(path)[ext].data)
+        return self.tables[key]
+
+    def close(self):
+        for hdulist in self.hdulists.values():
+            hdulist.close()
+        self.hdulists.clear()
+        self.tables.clear()
+
+FitsFiles._context_class = FitsFiles
+
+
+@contextmanager
+def fits_files():
+    """
+    Within this context, `open_fits` and `read_fits_table` share each opened file and decoded table.
+    Nested contexts use the outermost one and the files are closed when it exits.
+    """
+    files = FitsFiles.get_context(error_if_none=False)
+    if files is not None:
+        yield files
+        return
+    files = FitsFiles()
+    with files:
+        try:
+            yield files
+        finally:
+            files.close()
+
+
+def open_fits(path: Union[Path, str]) -> fits.HDUList:
+    """Returns the opened fits file, which is shared (and closed for you) within `fits_files()`"""
+    files = FitsFiles.get_context(error_if_none=False)
+    return fits.open(path) if files is None else files.open(path)
+
+
+def read_fits_table(path: Union[Path, str], ext: Union[int, str]) -> AstropyTable:
+    """Returns the table in hdu `ext`, which is shared (so must not be modified) within `fits_files()`"""
+    files = FitsFiles.get_context(error_if_none=False)
+    return AstropyTable(open_fits(path)[ext].data) if files is None else files.table(path, ext)
+
+
 class File(Hierarchy):
     is_template = True
     idname = 'fname'
@@ -17,6 +80,7 @@ class File(Hierarchy):
     antimatch_pattern = '^$'
     recommended_batchsize = None
     parts = [None]
+    match_uses_database = False  # True if `match_file` depends on what is in the database, so it can't be cached
 
     @classmethod
     def length(cls, path, part=None):
@@ -24,9 +88,9 @@ class File(Hierarchy):
 
     def open(self):
         try:
-            return fits.open(self.data.rootdir / self.fname)
+            return open_fits(self.data.rootdir / self.fname)
         except AttributeError:
-            return fits.open(self.fname)
+            return open_fits(self.fname)
 
     def __init__(self, **kwargs):
         if 'fname' in kwargs:
@@ -38,15 +102,21 @@ class File(Hierarchy):
         super().__init__(tables=None, **kwargs)
 
     @classmethod
-    def get_batches(cls, path, batch_size, parts: List[Union[str, None]] = None, slc: slice = None):
+    def get_batches(cls, path, batch_size, parts: List[Union[str, None]] = None, slc: slice = None,
+                    length: Callable[[Path, str], int] = None):
+        """
+        Returns the (slice, part) batches of a file. `length(path, part)` defaults to `cls.length`.
+        """
         if parts is None:
             parts = cls.parts
+        if length is None:
+            length = cls.length
         parts = sorted({p for p in parts if p in cls.parts})
         if slc is None:
             slc = slice(None, None)
         if batch_size is None:
             return ((slc, part) for part in parts)
-        return ((slice(i, i + batch_size), part) for part in parts for i in range(0, cls.length(path, part), batch_size)[slc])
+        return ((slice(i, i + batch_size), part) for part in parts for i in range(0, length(path, part), batch_size)[slc])
 
     @classmethod
     def match_file(cls, directory: Union[Path, str], fname: Union[Path, str], graph: Graph):
@@ -61,7 +131,12 @@ class File(Hierarchy):
 
     @classmethod
     def check_mos(cls, path):
-        header = fits.open(path)[0].header
+        with fits_files():
+            return cls.is_mos(open_fits(path)[0].header, path)
+
+    @classmethod
+    def is_mos(cls, header, path=None) -> bool:
+        """Returns True if the primary `header` of the file at `path` is of a MOS target observation"""
         try:
             return 'IFU' not in header['OBSMODE'] and (header.get('OBSTYPE', '') in ['TARGET', ''])
         except KeyError as e:
@@ -77,7 +152,7 @@ class File(Hierarchy):
         path = Path(directory) / Path(fname)
         relative_path = path.relative_to(Path(directory))
         file = cls(fname=path.name, path=str(relative_path), **hierarchies)
-        hdus = [i for i in fits.open(path)]
+        hdus = [i for i in open_fits(path)]
         if len(hdus) != len(cls.hdus):
             raise TypeError(f"Class {cls} asserts there are {len(cls.hdus)} HDUs ({list(cls.hdus.keys())})"
                             f" whereas {path} has {len(hdus)} ({[i.name for i in hdus]})")
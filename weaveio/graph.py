@@ -94,9 +94,12 @@ class Graph(metaclass=ContextMeta):
             instance._parent = cls.get_context(error_if_none=False)
         return instance
 
-    def __init__(self, profile=None, name=None, **settings):
+    def __init__(self, profile=None, name=None, neograph: NeoGraph = None, **settings):
+        """
+        Pass `neograph` to share an existing py2neo graph (and its connections) instead of connecting again
+        """
         self.write_allowed = settings.pop('write', False)
-        self.neograph = NeoGraph(profile, name, **settings)
+        self.neograph = NeoGraph(profile, name, **settings) if neograph is None else neograph
 
     def create_unique_constraint(self, label, key):
         try:
@@ -4,14 +4,13 @@ from pathlib import Path
 from typing import Union, List, Tuple, Dict
 
 import inspect
-from astropy.io import fits
 from astropy.io.fits.hdu.base import _BaseHDU
 from astropy.table import Table as AstropyTable
 import numpy as np
 import pandas as pd
 
 from weaveio.config_tables import progtemp_config
-from weaveio.file import File, PrimaryHDU, TableHDU, BinaryHDU
+from weaveio.file import File, PrimaryHDU, TableHDU, BinaryHDU, fits_files, open_fits, read_fits_table
 from weaveio.hierarchy import unwind, collect, Multiple, Hierarchy, OneOf, Optional
 from weaveio.opr3.hierarchy import Survey, Targprog, Catalogue, \
     WeaveTarget, SurveyTarget, Fibre, FibreTarget, Progtemp, ArmConfig, Obstemp, \
@@ -34,13 +33,13 @@ class HeaderFibinfoFile(File):
 
     @classmethod
     def length(cls, path, part=None):
-        return fits.open(path)['FIBTABLE'].header['NAXIS2']
+        with fits_files():
+            return open_fits(path)['FIBTABLE'].header['NAXIS2']
 
     @classmethod
     def read_fibinfo_dataframe(cls, path, slc=None):
-        hdus = fits.open(path)
-        fibinfo_hdu = hdus['FIBTABLE']
-        fibinfo = AstropyTable(fibinfo_hdu.data).to_pandas()
+        with fits_files():
+            fibinfo = read_fits_table(path, 'FIBTABLE').to_pandas()
         fibinfo.columns = [i.lower() for i in fibinfo.columns]
         fibinfo.rename(columns=lambda x: f'{x[1:]}_error' if x.startswith('emag') else x, inplace=True)
         if 'nspec' in fibinfo.columns:
@@ -137,11 +136,13 @@ class HeaderFibinfoFile(File):
 
     @classmethod
     def read_header(cls, path: Path, i=0):
-        return fits.open(path)[i].header
+        with fits_files():
+            return open_fits(path)[i].header
 
     @classmethod
     def read_fibtable(cls, path: Path):
-        return AstropyTable(fits.open(path)[cls.fibinfo_i].data)
+        with fits_files():
+            return AstropyTable(read_fits_table(path, cls.fibinfo_i), copy=True)
 
     @classmethod
     def read(cls, directory: Path, fname: Path, slc: slice = None, part=None) -> 'File':
@@ -188,8 +189,8 @@ class L1File(HeaderFibinfoFile):
 
     @classmethod
     def wavelengths(cls, rootdir: Path, fname: Union[Path, str]):
-        hdulist = fits.open(rootdir / fname)
-        header = hdulist[1].header
+        with fits_files():
+            header = open_fits(rootdir / fname)[1].header
         increment, zeropoint, size = header['cd1_1'], header['crval1'], header['naxis1']
         return WavelengthHolder(wvl=(np.arange(0, size) * increment) + zeropoint,
                                 cd1_1=header['cd1_1'], crval1=header['crval1'], naxis1=header['naxis1'])
@@ -7,16 +7,15 @@ from typing import Union, List, Dict, Type, Set, Tuple, Optional
 import inspect
 
 import numpy as np
-from astropy.io import fits
 from astropy.io.fits.hdu.base import _BaseHDU
 from astropy.table import Table, Column
 
-from weaveio.file import File, PrimaryHDU, TableHDU
+from weaveio.file import File, PrimaryHDU, TableHDU, fits_files, open_fits, read_fits_table
 from weaveio.graph import Graph
 from weaveio.hierarchy import Multiple, unwind, collect, Hierarchy, find_branch
 from weaveio.opr3.hierarchy import APS, OB, OBSpec, Exposure, WeaveTarget, _predicate, Run, ArmConfig, FibreTarget, Fibre
 from weaveio.opr3.l1 import L1Spectrum, L1SingleSpectrum, L1StackSpectrum, L1SupertargetSpectrum
-from weaveio.opr3.l2 import L2, L2Single, L2Stack, L2Superstack, L2Supertarget, IngestedSpectrum, Fit, ModelSpectrum, Redrock, \
+from weaveio.opr3.l2 import L2Single, L2Stack, L2Superstack, L2Supertarget, IngestedSpectrum, Fit, ModelSpectrum, Redrock, \
     RVSpecfit, Ferre, PPXF, Gandalf, GandalfModelSpectrum, CombinedIngestedSpectrum, CombinedModelSpectrum, Template, RedshiftArray, GandalfEmissionModelSpectrum, GandalfCleanModelSpectrum, \
     GandalfCleanIngestedSpectrum, L2Product, gandalf_line_names, gandalf_index_names, UncombinedIngestedSpectrum, UncombinedModelSpectrum, BaseCombinedModelSpectrum
 from weaveio.opr3.l1files import L1File, L1SuperstackFile, L1StackFile, L1SingleFile, L1SupertargetFile
@@ -120,11 +119,12 @@ class L2File(File):
 
     @classmethod
     def length(cls, path, part=None):
-        hdus = fits.open(path)
-        if part is None:
-            return hdus[1].header['NAXIS2']
-        d = {'RR': 1, 'RVS': 2, 'FR':2, 'GAND': 3, 'PPXF': 3}
-        return hdus[d[part]].header['NAXIS2']
+        with fits_files():
+            hdus = open_fits(path)
+            if part is None:
+                return hdus[1].header['NAXIS2']
+            d = {'RR': 1, 'RVS': 2, 'FR':2, 'GAND': 3, 'PPXF': 3}
+            return hdus[d[part]].header['NAXIS2']
 
     @classmethod
     def make_l2(cls, spectra, nspec, **hiers):
@@ -205,7 +205,9 @@ class L2File(File):
 
     @classmethod
     def read_header_and_aps(cls, path):
-        return fits.open(path)[0].header, fits.open(path)[1].header['APS_V'].strip()
+        with fits_files():
+            hdus = open_fits(path)
+            return hdus[0].header, hdus[1].header['APS_V'].strip()
 
     @classmethod
     def read_hdus(cls, directory: Union[Path, str], fname: Union[Path, str], l1files: List[L1File],
@@ -225,11 +227,12 @@ class L2File(File):
     @classmethod
     def get_all_fibreids(cls, path):
         aps_ids = set()
-        for hdu in fits.open(path)[1:]:
-            try:
-                aps_ids |= set(hdu.data['APS_ID'].tolist())
-            except KeyError:
-                pass
+        with fits_files():
+            for hdu in open_fits(path)[1:]:
+                try:
+                    aps_ids |= set(hdu.data['APS_ID'].tolist())
+                except KeyError:
+                    pass
         return sorted(aps_ids)
 
     @classmethod
@@ -450,50 +453,51 @@ class L2File(File):
         fname = Path(fname)
         directory = Path(directory)
         path = directory / fname
-        header, aps = cls.read_header_and_aps(path)
-        l1files = cls.parse_fname(header, fname)
-        aps = APS(version=aps)
-        hierarchies = cls.find_shared_hierarchy(path)
-        astropy_hdus = fits.open(path)
-        fnames = [l1.fname for l1 in l1files]
-        assert len(fnames) > 1, f"{fname} has only one L1 file"
-        safe_tables = {}
-        safe_cypher_tables = {}
-        for i, hdu in enumerate(astropy_hdus[1:4], 1):
-            safe_tables[i] = filter_products_from_table(Table(hdu.data)[slc], MAX_REDSHIFT_GRID_LENGTH)
-            cols = [col for col in safe_tables[i].colnames if not ('chi2' not in col and 'czz_' in col)]
-            safe_cypher_tables[i] =  CypherData(safe_tables[i][cols])
-        if part == 'RVS':
-            l2, specfits, specs, *types = cls.read_rvspecfit(path, astropy_hdus[5], [x.lower() for x in astropy_hdus[2].data.names],
+        with fits_files():  # the file is opened once for the whole read and closed afterwards
+            header, aps = cls.read_header_and_aps(path)
+            l1files = cls.parse_fname(header, fname)
+            aps = APS(version=aps)
+            hierarchies = cls.find_shared_hierarchy(path)
+            astropy_hdus = open_fits(path)
+            fnames = [l1.fname for l1 in l1files]
+            assert len(fnames) > 1, f"{fname} has only one L1 file"
+            safe_tables = {}
+            safe_cypher_tables = {}
+            for i, hdu in enumerate(astropy_hdus[1:4], 1):
+                safe_tables[i] = filter_products_from_table(read_fits_table(path, i)[slc], MAX_REDSHIFT_GRID_LENGTH)
+                cols = [col for col in safe_tables[i].colnames if not ('chi2' not in col and 'czz_' in col)]
+                safe_cypher_tables[i] =  CypherData(safe_tables[i][cols])
+            if part == 'RVS':
+                l2, specfits, specs, *types = cls.read_rvspecfit(path, astropy_hdus[5], [x.lower() for x in astropy_hdus[2].data.names],
+                                                     safe_cypher_tables[2], fnames, **hierarchies)
+                hdu_node = 5
+            elif part == 'FR':
+                l2, specfits, specs, *types = cls.read_ferre(path, astropy_hdus[5], [x.lower() for x in astropy_hdus[2].data.names],
                                                  safe_cypher_tables[2], fnames, **hierarchies)
-            hdu_node = 5
-        elif part == 'FR':
-            l2, specfits, specs, *types = cls.read_ferre(path, astropy_hdus[5], [x.lower() for x in astropy_hdus[2].data.names],
-                                             safe_cypher_tables[2], fnames, **hierarchies)
-            hdu_node = 5
-        elif part == 'PPXF':
-            l2, specfits, specs, *types = cls.read_ppxf(path, astropy_hdus[6], [x.lower() for x in astropy_hdus[3].data.names],
-                                            safe_cypher_tables[3], fnames, **hierarchies)
-            hdu_node = 6
-        elif part == 'RR':
-            zs = cls.make_redshift_arrays(safe_tables[1])
-            l2, specfits, specs, *types = cls.read_redrock(path, astropy_hdus[4], [x.lower() for x in astropy_hdus[1].data.names],
-                                               safe_cypher_tables[1], fnames, zs, **hierarchies)
-            hdu_node = 4
-        elif part == 'GAND':
-            l2, specfits, specs, extra_specs, *types = cls.read_gandalf(path, astropy_hdus[6], [x.lower() for x in astropy_hdus[3].data.names],
-                             safe_cypher_tables[3], fnames, **hierarchies)
-            hdu_node = 6
-        else:
-            raise ValueError(f"{part} is not a valid part")
-        hdu_nodes, file, _ = cls.read_hdus(directory, fname, l2=l2, l1files=l1files, aps=aps, **hierarchies)
-        hdu = hdu_nodes[hdu_node]
-        names = {'logwvl': 'loglam', 'wvl': 'lambda'}
-        if specs is not None:
-            suffix = '' if part in ['PPXF', 'GAND'] else '_C'
-            cls.attach_products_to_spectra(specs, part, hdu, names, types, suffix)
-        if part == 'GAND':
-            cls.attach_products_to_gandalf_extra_spectra(extra_specs, hdu)
+                hdu_node = 5
+            elif part == 'PPXF':
+                l2, specfits, specs, *types = cls.read_ppxf(path, astropy_hdus[6], [x.lower() for x in astropy_hdus[3].data.names],
+                                                safe_cypher_tables[3], fnames, **hierarchies)
+                hdu_node = 6
+            elif part == 'RR':
+                zs = cls.make_redshift_arrays(safe_tables[1])
+                l2, specfits, specs, *types = cls.read_redrock(path, astropy_hdus[4], [x.lower() for x in astropy_hdus[1].data.names],
+                                                   safe_cypher_tables[1], fnames, zs, **hierarchies)
+                hdu_node = 4
+            elif part == 'GAND':
+                l2, specfits, specs, extra_specs, *types = cls.read_gandalf(path, astropy_hdus[6], [x.lower() for x in astropy_hdus[3].data.names],
+                                 safe_cypher_tables[3], fnames, **hierarchies)
+                hdu_node = 6
+            else:
+                raise ValueError(f"{part} is not a valid part")
+            hdu_nodes, file, _ = cls.read_hdus(directory, fname, l2=l2, l1files=l1files, aps=aps, **hierarchies)
+            hdu = hdu_nodes[hdu_node]
+            names = {'logwvl': 'loglam', 'wvl': 'lambda'}
+            if specs is not None:
+                suffix = '' if part in ['PPXF', 'GAND'] else '_C'
+                cls.attach_products_to_spectra(specs, part, hdu, names, types, suffix)
+            if part == 'GAND':
+                cls.attach_products_to_gandalf_extra_spectra(extra_specs, hdu)
 
 
 class L2SingleFile(L2File):
@@ -555,9 +559,10 @@ class L2SupertargetFile(L2File):
 
     @classmethod
     def find_shared_hierarchy(cls, path: Path) -> Dict:
-        hdus = fits.open(path)
-        names = [i.name for i in hdus]
-        cname = hdus[names.index('CLASS_TABLE')].data['CNAME'][0]
+        with fits_files():
+            hdus = open_fits(path)
+            names = [i.name for i in hdus]
+            cname = hdus[names.index('CLASS_TABLE')].data['CNAME'][0]
         return {'weavetarget': WeaveTarget.find(cname=cname)}
 
 
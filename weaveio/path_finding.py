@@ -1,10 +1,21 @@
+import atexit
+import logging
 import math
+import os
+import pickle
+import weakref
 from itertools import zip_longest
-from typing import Type, Union, Set, List, Tuple
+from pathlib import Path
+from typing import Type, Union, Set, List, Tuple, Iterable
+
 import networkx as nx
+import xxhash
 from networkx.classes.filters import no_filter
 
 from weaveio.hierarchy import Multiple, Hierarchy, OneOf, Graphable
+from weaveio.utilities import cache_directory
+
+PATH_TABLE_VERSION = 1  # increment this when the path finding changes so that old tables are not used
 
 
 def normalise_relation(h):
@@ -401,3 +412,120 @@ def get_all_class_bases(cls: Type[Graphable]) -> Set[Type[Graphable]]:
         new.add(b)
         new.update(get_all_class_bases(b))
     return new
+
+
+def _describe_relation(relation) -> tuple:
+    if not isinstance(relation, Multiple):
+        return getattr(relation, '__name__', relation),
+    node = getattr(relation.node, '__name__', relation.node)
+    constrain = tuple(getattr(c, '__name__', c) for c in relation.constrain)
+    return node, relation.minnumber, relation.maxnumber, constrain, relation.relation_idname, \
+           relation.one2one, relation.ordered, relation.notreal
+
+
+def hierarchy_hash(hierarchies: Iterable[Type[Graphable]]) -> str:
+    """
+    Returns a hash of everything that path finding depends on in a set of hierarchy classes.
+    Anything derived from the schema and persisted to disk should be versioned by this hash.
+    """
+    digester = xxhash.xxh64(str(PATH_TABLE_VERSION))
+    for h in sorted(hierarchies, key=lambda h: (h.__module__, h.__qualname__)):
+        description = (h.__module__, h.__qualname__, [b.__name__ for b in h.__bases__],
+                       h.is_template, h.idname, h.identifier_builder, h.factors, h.products,
+                       [_describe_relation(r) for r in h.parents], [_describe_relation(r) for r in h.children],
+                       [_describe_relation(r) for r in h.produces])
+        digester.update(repr(description))
+    return digester.hexdigest()
+
+
+_path_tables = weakref.WeakSet()  # saved at exit, without keeping them alive until then
+
+
+@atexit.register
+def _save_path_tables():
+    for table in list(_path_tables):
+        table.save()
+
+
+class PathTable:
+    """
+    A persistent lookup table of the paths between two hierarchies:
+        (from, to, singular) -> (paths, singulars, reversed)
+    Finding paths in the HierarchyGraph is slow but only depends upon the hierarchy classes,
+    so each result is stored here and written to disk, versioned by the `hierarchy_hash` of the graph.
+    Lookups that fail are stored too, so they fail just as quickly the next time.
+    """
+    def __init__(self, graph: 'HierarchyGraph', directory: Union[Path, str] = None, version: str = None):
+        self.graph = graph
+        self.version = hierarchy_hash(graph.nodes) if version is None else version
+        directory = cache_directory() if directory is None else Path(directory)
+        self.fname = directory / f'paths-{self.version}.pkl'
+        self.table = self._load()  # type: Dict[Tuple[Type[Hierarchy], Type[Hierarchy], bool], tuple]
+        self.unsaved = 0
+        _path_tables.add(self)
+
+    def _load(self) -> dict:
+        try:
+            with open(self.fname, 'rb') as f:
+                return pickle.load(f)
+        except Exception:  # missing, corrupt, or refers to classes that no longer exist
+            return {}
+
+    def save(self):
+        """
+        Merge new entries into the table on disk. This happens automatically at exit
+        """
+        if not self.unsaved:
+            return
+        table = self._load()  # another process may have added entries in the meantime
+        table.update(self.table)
+        tmp = self.fname.with_name(f'{self.fname.name}.{os.getpid()}.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.fname)
+        except OSError as e:
+            logging.warning(f"Could not save the hierarchy path table to {self.fname}: {e}")
+            return
+        self.table = table
+        self.unsaved = 0
+
+    def compute(self, a: Type[Hierarchy], b: Type[Hierarchy], singular: bool):
+        paths = list(self.graph.find_paths(a, b, singular))
+        if not paths:
+            if singular:
+                raise nx.NetworkXNoPath(f"No singular path found between `{a}` and `{b}`")
+            raise nx.NetworkXNoPath(f"No path found between `{a}` and `{b}`")
+        paths, edges, reversed = zip(*[(path[::-1], [self.graph.short_edge(e[1], e[0]) for e in es[::-1]], True) if path[0] is b else (path, es, False) for path, es in paths])
+        singulars = [self.graph.edge_path_is_singular(es) for es in edges]
+        return paths, singulars, reversed
+
+    def lookup(self, a: Type[Hierarchy], b: Type[Hierarchy], singular: bool):
+        key = (a, b, singular)
+        try:
+            entry = self.table[key]
+        except KeyError:
+            try:
+                entry = self.compute(a, b, singular)
+            except (nx.NetworkXNoPath, nx.NodeNotFound) as e:
+                entry = (type(e), str(e))
+            self.table[key] = entry
+            self.unsaved += 1
+        if isinstance(entry[0], type) and issubclass(entry[0], Exception):
+            raise entry[0](entry[1])
+        paths, singulars, reversed = entry
+        return paths, list(singulars), reversed
+
+    def build(self, hierarchies: Iterable[Type[Hierarchy]]):
+        """
+        Fill the table for every pair of `hierarchies` and save it
+        """
+        hierarchies = [h for h in hierarchies if h in self.graph]
+        for a in hierarchies:
+            for b in hierarchies:
+                for singular in [True, False]:
+                    try:
+                        self.lookup(a, b, singular)
+                    except (nx.NetworkXNoPath, nx.NodeNotFound):
+                        pass
+        self.save()
@@ -1,8 +1,12 @@
 from .objects import Query
 from .functions import *
 from .aggregations import *
-from .results import filtered, masked, apply, Table
+from .results import filtered, masked, apply, Table, RaggedColumn, SharedColumn
 from .uploads import join
 from .helpers import *
 from .split import split
 from .align import align
+from . import functions, aggregations, helpers
+
+__all__ = ['Query', 'filtered', 'masked', 'apply', 'Table', 'RaggedColumn', 'SharedColumn', 'join', 'split', 'align']
+__all__ += functions.__all__ + aggregations.__all__ + helpers.__all__
@@ -1,3 +1,4 @@
+import asyncio
 import itertools
 import logging
 import time
@@ -5,19 +6,20 @@ import warnings
 from collections import defaultdict, namedtuple
 from contextlib import contextmanager
 from copy import copy
+from functools import partial
 from typing import Tuple, List, Dict, Any, Union, TYPE_CHECKING
 from warnings import warn
 
 import networkx as nx
 from networkx import NetworkXNoPath, NodeNotFound
-from py2neo.cypher import Cursor
 
 from weaveio.hierarchy import Hierarchy
 
 from .exceptions import AmbiguousPathError, CardinalityError, DisjointPathError, AttributeNameError
 from .parser import QueryGraph
-from .results import Table, AstropyTable
+from .results import Table, AstropyTable, SplitRecord
 from ..path_finding import collapse_classes_to_superclasses
+from ..utilities import lift_literals, register_json_encoder, replace_parameters
 
 if TYPE_CHECKING:
     from .objects import ObjectQuery, Query, AttributeQuery
@@ -72,8 +74,7 @@ class BaseQuery(QueryFunctionBase):
     one_column = False
 
     def __new__(cls, *args, **kwargs):
-        from fastapi.encoders import ENCODERS_BY_TYPE
-        ENCODERS_BY_TYPE[cls] = lambda x: [x._data, x._node]
+        register_json_encoder(cls, lambda x: [x._data, x._node])
         return super().__new__(cls)
 
     def _debug_output(self, skip=0, limit=None, distinct=False, no_cache=False, graph_export_fname=None,
@@ -135,7 +136,8 @@ class BaseQuery(QueryFunctionBase):
             return r, r._to_cypher(skip, limit, distinct)
 
     def _execute_single_query(self, query, cypher, params):
-        return query._data.graph.execute(cypher, **{k.replace('$', ''): v for k, v in params.items()})
+        # literals have been lifted into `params` so that queries of the same shape share neo4j's cached query plan
+        return query._data.graph.execute(cypher, **params)
 
     def _get_cached_parameters(self):
         params = {}
@@ -154,18 +156,30 @@ class BaseQuery(QueryFunctionBase):
         :param no_groups: whether to return a single cursor or a generator of cursors
         """
         with logtime('executing'):
-            cached_params = self._get_cached_parameters()
-            placeholder_params = self._G.dependency_parameters(self._node)
-            params = {**placeholder_params, **cached_params}
-            if not no_groups and any(v == '<placeholder>' for v in params.values()):
-                groupids, names = get_groupids(self._G, params)
-                if groupids:
-                    return _execute_groups(groupids, names, params), self
-            new, lines = self._compile(skip, limit, distinct)
-            cypher = '\n'.join(lines)
-            params = self._prepare_parameters(lines, params)
+            groups, new, cypher, params = self._prepare_execution(skip, limit, distinct, no_groups)
+            if groups is not None:
+                return groups, new
             return self._execute_single_query(new, cypher, params), new
 
+    def _prepare_execution(self, skip=0, limit=None, distinct=False, no_groups=False):
+        """
+        Compile the query, returning (groups, new, cypher, params).
+        If the query has been `split`, `groups` is a generator of the group parameters (as in `_execute`) and the
+        cypher is not compiled, otherwise `groups` is None.
+        """
+        cached_params = self._get_cached_parameters()
+        placeholder_params = self._G.dependency_parameters(self._node)
+        params = {**placeholder_params, **cached_params}
+        if not no_groups and any(v == '<placeholder>' for v in params.values()):
+            groupids, names = get_groupids(self._G, params)
+            if groupids:
+                return _execute_groups(groupids, names, params), self, None, params
+        new, lines = self._compile(skip, limit, distinct)
+        params = self._prepare_parameters(lines, params)
+        cypher, params = lift_literals('\n'.join(lines), {k.replace('$', ''): v for k, v in params.items()},
+                                       new._G.variable_names)
+        return None, new, cypher, params
+
     def _iterate_groups(self, generator, query):
         for split_indexes, params in generator:
             copied = copy(query)  # copy the query, so that the parameters are not shared between the cursors
@@ -173,11 +187,14 @@ class BaseQuery(QueryFunctionBase):
             yield SplitQuery(split_indexes, copied)
 
     def _iterate(self, skip=0, limit=None, distinct=False, no_groups=False):
-        cursor_or_gen, new = self._execute(skip, limit, distinct, no_groups)  # produces either a cursor or a generator of cursors
-        if not isinstance(cursor_or_gen, Cursor):
-            yield from self._iterate_groups(cursor_or_gen, new)
+        with logtime('executing'):
+            groups, new, cypher, params = self._prepare_execution(skip, limit, distinct, no_groups)
+        if groups is not None:
+            yield from self._iterate_groups(groups, new)
         else:
-            rows = new._data.rowparser.iterate_cursor(cursor_or_gen, new._names, new._is_products, True)
+            # records are pulled from the server `fetch_size` at a time (if the neo4j driver is installed)
+            rows = new._data.rowparser.iterate_cursor(new._data.read_records(cypher, params), new._names,
+                                                      new._is_products, True, new._data.fetch_size)
             i = None
             with logtime('total streaming (by iteration)'):
                 for i, row in enumerate(rows):
@@ -191,12 +208,71 @@ class BaseQuery(QueryFunctionBase):
     def __iter__(self):
         yield from self._iterate()
 
-    def _to_table(self, skip=0, limit=None, distinct=False) -> Tuple[Table, 'BaseQuery']:
+    def _to_table(self, skip=0, limit=None, distinct=False, ragged=None, memory_budget=None) -> Tuple[Table, 'BaseQuery']:
         with logtime('total streaming'):
-            cursor_or_gen, new = self._execute(skip, limit, distinct)  # produces either a cursor or a generator of cursors
-            if not isinstance(cursor_or_gen, Cursor):
-                return [SplitResult(split_indexes, query._to_table(skip, limit, distinct)) for split_indexes, query in self._iterate_groups(cursor_or_gen, new)], new
-            return new._data.rowparser.parse_to_table(cursor_or_gen, new._names, new._is_products), new
+            groups, new, cypher, params = self._prepare_execution(skip, limit, distinct)
+            if groups is not None:
+                return self._split_tables(skip, limit, distinct, ragged), new
+            return new._read_table(cypher, params, ragged, memory_budget), new
+
+    def _read_table(self, cypher, params, ragged=None, memory_budget=None) -> Table:
+        """
+        Run the cypher and parse the result into a table, reusing a result from `Data.result_cache` if there is one
+        that was read since the last write to the database.
+        If `memory_budget` is given, the records are pulled from the database `Data.fetch_size` at a time
+        with `Data.stream` and the table is built in chunks with `RowParser.stream_to_table`.
+        """
+        cache = getattr(self._data, 'result_cache', None)
+        key = None if cache is None else cache.key(cypher, params, self._names, self._is_products, ragged)
+        if key is None:
+            return self._parse_table(self._run_for_table(cypher, params, memory_budget), ragged, memory_budget)
+        mark = self._data.high_water_mark()
+        table = cache.get(key, mark)
+        if table is None:
+            table = self._parse_table(self._run_for_table(cypher, params, memory_budget), ragged, memory_budget)
+            cache.set(key, mark, table)
+        return table
+
+    def _run_for_table(self, cypher, params, memory_budget=None):
+        # py2neo receives the whole result before returning its cursor, so a memory budget needs the streaming driver
+        if memory_budget is None:
+            return self._execute_single_query(self, cypher, params)
+        return self._data.stream(cypher, params)
+
+    def _parse_table(self, cursor, ragged=None, memory_budget=None) -> Table:
+        rowparser = self._data.rowparser
+        if memory_budget is None:
+            return rowparser.parse_to_table(cursor, self._names, self._is_products, ragged)
+        return rowparser.stream_to_table(cursor, self._names, self._is_products, ragged,
+                                         self._data.fetch_size, memory_budget)
+
+    def _split_tables(self, skip=0, limit=None, distinct=False, ragged=None) -> List[SplitResult]:
+        """
+        Run every group of a split query in one round trip, returning the same as running each `SplitQuery` separately.
+        The compiled cypher is wrapped in a `CALL {}` subquery which is run for each group by unwinding the group values,
+        and the rows are partitioned by their group afterwards.
+        The group parameters and returned columns are taken from the query graph rather than read back from the cypher.
+        """
+        params = {**self._G.dependency_parameters(self._node), **self._get_cached_parameters()}
+        groupids, names = get_groupids(self._G, params)
+        groups = list(itertools.product(*groupids))
+        new, lines = self._compile(skip, limit, distinct)
+        params = self._prepare_parameters(lines, params)
+        columns = new._G.return_columns(new._node)
+        cypher = replace_parameters('\n'.join(lines), {name[1:]: f'_group.{name[1:]}' for name in names})
+        cypher = f"UNWIND range(0, size($_groups) - 1) as _split\n" \
+                 f"WITH _split, $_groups[_split] as _group\n" \
+                 f"CALL {{\nWITH _group\n{cypher}\n}}\n" \
+                 f"RETURN _split, {', '.join(columns)}"
+        params = {k.replace('$', ''): v for k, v in params.items()}
+        params['_groups'] = [{name[1:]: value for name, value in zip(names, values)} for values in groups]
+        cypher, params = lift_literals(cypher, params, new._G.variable_names)
+        partitions = [[] for _ in groups]
+        for record in new._data.graph.execute(cypher, **params):
+            partitions[record[0]].append(SplitRecord(record))
+        rowparser = new._data.rowparser
+        return [SplitResult(values, (rowparser.parse_to_table(records, new._names, new._is_products, ragged), new))
+                for values, records in zip(groups, partitions)]
 
     def _post_process_table(self, result, squeeze):
         if isinstance(result, SplitResult):
@@ -214,11 +290,103 @@ class BaseQuery(QueryFunctionBase):
             return row[row.colnames[0]]
         return row
 
-    def __call__(self, skip=0, limit=1000, distinct=False, squeeze=True, **kwargs):
-        tbl, new = self._to_table(skip, limit, distinct)
+    def __call__(self, skip=0, limit=1000, distinct=False, squeeze=True, ragged=None, memory_budget=None, **kwargs):
+        """
+        Run the query and return the result as a table (or a column/value if `squeeze` and there is only one)
+        :param ragged: By default, arrays of different lengths are padded into a masked 2D column.
+                       If 'offsets', they are returned as a `RaggedColumn` which is only padded when `.dense()` is called.
+        :param memory_budget: If given, rows are read `Data.fetch_size` at a time and once the table takes up more than
+                              `memory_budget` bytes it is moved to temporary memory-mapped files on disk.
+        """
+        tbl, new = self._to_table(skip, limit, distinct, ragged, memory_budget)
+        return new._finalise_table(tbl, limit, squeeze)
+
+    async def acall(self, skip=0, limit=1000, distinct=False, squeeze=True, ragged=None, **kwargs):
+        """
+        `await query.acall(...)` is the same as `query(...)` but does not block the event loop.
+        The query is compiled and its products read in an executor and the cypher is run with neo4j's async driver
+        (`pip install neo4j`).
+        Queries that have been `split` are run entirely in the executor.
+        """
+        loop = asyncio.get_running_loop()
+        groups, new, cypher, params = await loop.run_in_executor(None, self._prepare_execution, skip, limit, distinct)
+        if groups is not None:
+            return await loop.run_in_executor(None, partial(self, skip, limit, distinct, squeeze, ragged, **kwargs))
+        records = []
+        async for chunk in new._data.astream(cypher, params):
+            records += chunk
+        tbl = await loop.run_in_executor(None, new._data.rowparser.parse_to_table, records, new._names,
+                                         new._is_products, ragged)
+        return new._finalise_table(tbl, limit, squeeze)
+
+    async def aiter(self, skip=0, limit=None, distinct=False, chunksize=None):
+        """
+        `async for row in query.aiter()` is the same as `for row in query` but does not block the event loop.
+        Rows are fetched `chunksize` (default `Data.fetch_size`) at a time with neo4j's async driver
+        and their products are read in an executor.
+        """
+        loop = asyncio.get_running_loop()
+        chunksize = chunksize or self._data.fetch_size
+        groups, new, cypher, params = await loop.run_in_executor(None, self._prepare_execution, skip, limit, distinct)
+        if groups is not None:
+            for split_query in await loop.run_in_executor(None, list, self._iterate_groups(groups, new)):
+                yield split_query
+            return
+        rowparser = new._data.rowparser
+        i = None
+        async for chunk in new._data.astream(cypher, params, chunksize):
+            rows = rowparser.iterate_cursor(chunk, new._names, new._is_products, True, chunksize)
+            rows = await loop.run_in_executor(None, list, rows)
+            for i, row in enumerate(rows, start=0 if i is None else i + 1):
+                yield new._post_process_row(row)
+        if limit == i:
+            warnings.simplefilter("always")
+            warn(f"This query has been capped to {limit} rows but the result is larger than that. "
+                 f"Consider using the `limit` parameter to better limit the result or set `limit` to None to get "
+                 f"the full result (although this is not recommended).")
+
+    def pages(self, page_size=1000, squeeze=False, ragged=None):
+        """
+        Iterate over the whole result in tables of the rows of up to `page_size` index objects (usually one row each).
+        Unlike `query(skip=..., limit=...)`, the query is run only once: its rows are ordered by the neo4j id of their
+        index object, pulled from the database `Data.fetch_size` at a time (see `Data.read_records`) and cut into pages
+        between index objects, so all the rows of an object are always in the same page and fetching a page doesn't
+        depend on how many came before it.
+        """
+        groups, new, cypher, params = self._prepare_execution()
+        if groups is not None:
+            raise TypeError("Split queries cannot be paged, iterate over the split query and page each part instead")
+        index = new._G.index_variable(new._node)
+        if index is None:  # a single row
+            yield new._post_process_table(new._to_table(ragged=ragged)[0], squeeze)
+            return
+        lines = new._to_cypher(0, None, False)
+        lines[-1] = f"{lines[-1]}, id({index}) as _page_key ORDER BY _page_key"  # the last line is the RETURN statement
+        params = self._prepare_parameters(lines, {**new._G.dependency_parameters(new._node), **new._get_cached_parameters()})
+        cypher, params = lift_literals('\n'.join(lines), {k.replace('$', ''): v for k, v in params.items()},
+                                       new._G.variable_names)
+        names, is_products = new._names + ['_page_key'], new._is_products + [False]
+
+        def read_page(records):
+            table = new._data.rowparser.parse_to_table(records, names, is_products, ragged)
+            table.remove_column('_page_key')
+            return new._post_process_table(table, squeeze)
+
+        objects = itertools.groupby(new._data.read_records(cypher, params), key=lambda record: record[-1])
+        empty = True
+        while True:
+            records = [record for _, rows in itertools.islice(objects, page_size) for record in rows]
+            if not records:
+                break
+            empty = False
+            yield read_page(records)
+        if empty:  # an empty result is still one (empty) page
+            yield read_page([])
+
+    def _finalise_table(self, tbl, limit, squeeze):
         if isinstance(tbl, list):
             return tbl
-        tbl = new._post_process_table(tbl, squeeze)
+        tbl = self._post_process_table(tbl, squeeze)
         try:
             if not len(tbl):
                 return tbl
@@ -244,7 +412,7 @@ class BaseQuery(QueryFunctionBase):
         self._single = single
         self._data = data
         if G is None:
-            self._G = QueryGraph()
+            self._G = QueryGraph(getattr(data, 'compiled_cache', None))
         else:
             self._G = G
         if node is None:
@@ -0,0 +1,164 @@
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Union, Optional, Any, List, Tuple
+
+import numpy as np
+import xxhash
+
+from .results import Table, table_to_arrays, table_from_arrays
+from ..utilities import cache_directory
+
+
+class CompiledCypherCache:
+    """
+    An on-disk cache of compiled queries which is shared between python processes.
+    Entries are keyed by the canonical hash of the query graph and by `version` (the schema and library versions),
+    so a change to either never returns stale cypher.
+    When there are more than `maxsize` entries, the least recently used ones are removed.
+    """
+    def __init__(self, fname: Union[Path, str] = None, version: str = '', maxsize: int = 10000):
+        self.fname = cache_directory() / 'compiled-cypher.sqlite' if fname is None else Path(fname)
+        self.version = version
+        self.maxsize = maxsize
+        self._connection = None
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(str(self.fname), timeout=10, isolation_level=None, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS compiled (key TEXT PRIMARY KEY, value BLOB, used REAL)')
+        return self._connection
+
+    def get(self, key: str) -> Optional[Any]:
+        key = f'{self.version}:{key}'
+        try:
+            with self._lock:
+                row = self.connection.execute('SELECT value FROM compiled WHERE key = ?', (key,)).fetchone()
+                if row is None:
+                    return None
+                self.connection.execute('UPDATE compiled SET used = ? WHERE key = ?', (time.time(), key))
+            return pickle.loads(row[0])
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError) as e:
+            logging.warning(f"Could not read from the compiled cypher cache {self.fname}: {e}")
+            return None
+
+    def set(self, key: str, value: Any):
+        key = f'{self.version}:{key}'
+        try:
+            with self._lock:
+                self.connection.execute('INSERT OR REPLACE INTO compiled VALUES (?, ?, ?)',
+                                        (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time()))
+                self._writes += 1
+                if self._writes % 100 == 1:
+                    self.evict()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not write to the compiled cypher cache {self.fname}: {e}")
+
+    def evict(self):
+        self.connection.execute('DELETE FROM compiled WHERE key NOT IN '
+                                '(SELECT key FROM compiled ORDER BY used DESC LIMIT ?)', (self.maxsize,))
+
+    def clear(self):
+        with self._lock:
+            self.connection.execute('DELETE FROM compiled')
+
+
+class ResultCache:
+    """
+    An opt-in on-disk cache of query results (the tables, products included) keyed by the cypher and its parameters.
+    Each result is saved with the database's high-water mark (the latest `_dbupdated` time and the numbers of nodes and
+    relationships) when it was read and is only returned while the high-water mark is the same,
+    i.e. until anything is written to or deleted from the database. `Data.write_files` also empties the cache.
+    Results are stored as one uncompressed .npz file each, and when they take up more than `maxbytes`
+    the least recently used are deleted.
+    """
+    def __init__(self, directory: Union[Path, str] = None, version: str = '', maxbytes: int = 2 * 1024**3):
+        self.directory = cache_directory() / 'results' if directory is None else Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.version = version
+        self.maxbytes = maxbytes
+        self.hits = self.misses = 0
+
+    def key(self, cypher: str, parameters: dict, *args) -> Optional[str]:
+        """
+        Returns the key for a result or None if the parameters can't be hashed (they must be picklable)
+        """
+        try:
+            return xxhash.xxh64(pickle.dumps((self.version, cypher, parameters, args))).hexdigest()
+        except (pickle.PicklingError, TypeError, AttributeError):
+            return None
+
+    def get(self, key: str, mark) -> Optional[Table]:
+        fname = self.directory / f'{key}.npz'
+        try:
+            with np.load(fname, allow_pickle=False) as arrays:
+                if str(arrays['_mark']) != str(mark):
+                    self.misses += 1
+                    fname.unlink()
+                    return None
+                table = table_from_arrays(arrays)
+            os.utime(fname)  # mark as recently used
+            self.hits += 1
+            return table
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read {fname} from the result cache: {e}")
+            self.misses += 1
+            return None
+
+    def set(self, key: str, mark, table: Table):
+        arrays = table_to_arrays(table)
+        if arrays is None:
+            return
+        fname = self.directory / f'{key}.npz'
+        tmp = self.directory / f'{key}.{os.getpid()}.{threading.get_ident()}.tmp.npz'
+        try:
+            np.savez(tmp, _mark=np.array(str(mark)), **arrays)
+            os.replace(tmp, fname)
+        except OSError as e:
+            logging.warning(f"Could not write to the result cache {self.directory}: {e}")
+            return
+        self.evict()
+
+    def entries(self) -> List[Tuple[Path, os.stat_result]]:
+        entries = []
+        for fname in self.directory.glob('*.npz'):
+            try:
+                entries.append((fname, fname.stat()))
+            except FileNotFoundError:  # removed by another process
+                pass
+        return entries
+
+    def evict(self):
+        """
+        Delete the least recently used results until the total size is under `maxbytes`
+        """
+        entries = sorted(self.entries(), key=lambda e: e[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        for fname, stat in entries:
+            if total <= self.maxbytes:
+                break
+            try:
+                fname.unlink()
+            except FileNotFoundError:
+                pass
+            total -= stat.st_size
+
+    def clear(self):
+        """
+        Delete every result
+        """
+        for fname, _ in self.entries():
+            try:
+                fname.unlink()
+            except FileNotFoundError:  # removed by another process
+                pass
@@ -1,19 +1,37 @@
+import heapq
 from functools import lru_cache
-from typing import List, Tuple
+from typing import List, Tuple, Set, Dict
 
-import graphviz
 import networkx as nx
+import xxhash
 from networkx.classes.graphviews import generic_graph_view
-from networkx.drawing.nx_pydot import to_pydot
 
 
 class HashedDiGraph(nx.DiGraph):
-    hash_edge_attr = 'type'
-    hash_node_attr = 'i'
+    """
+    A DiGraph which keeps an index of the ancestors of each node as nodes/edges are added,
+    so that reachability (ignoring `unindexed_edge_type` edges) is a set lookup rather than a search.
+    It also keeps the Merkle hash of each node (see `node_hashes`) up to date, so the graph (or the graph above `sink`)
+    can be hashed without looking at every node.
+    The index and hashes are only maintained through `add_node`/`add_edge`.
+    """
+    unindexed_edge_type = 'wrt'
+
+    def __init__(self, incoming_graph_data=None, **attr):
+        self.ancestor_index = {}
+        self.node_hash = {}
+        self.hash_position = {}
+        self.hash_total = 0
+        self.sink = None
+        super().__init__(incoming_graph_data, **attr)
 
     @property
     def name(self) -> str:
-        return nx.weisfeiler_lehman_graph_hash(self, edge_attr=self.hash_edge_attr, node_attr=self.hash_node_attr)
+        if self.sink is not None:
+            return self.node_hash[self.sink]
+        if len(self.node_hash) == len(self):
+            return f'{self.hash_total:016x}'
+        return canonical_hash(self)
 
     @name.setter
     def name(self, s):
@@ -26,14 +44,73 @@ class HashedDiGraph(nx.DiGraph):
         """add_node but return existing node if it is matched, ignoring attributes"""
         if node_for_adding in self.nodes:
             return node_for_adding
-        return super().add_node(node_for_adding, **attr)
+        self.ancestor_index[node_for_adding] = {node_for_adding}
+        r = super().add_node(node_for_adding, **attr)
+        self.hash_position[node_for_adding] = len(self.hash_position)
+        self._rehash(node_for_adding)
+        return r
 
     def add_edge(self, u_of_edge, v_of_edge, **attr):
         """add_edge but return existing node if it is matched"""
         if (u_of_edge, v_of_edge) in self.edges:
             if self.edges[(u_of_edge, v_of_edge)] == attr:
                 return (u_of_edge, v_of_edge)
+        for n in (u_of_edge, v_of_edge):
+            if n not in self.hash_position:
+                self.ancestor_index[n] = {n}
+                self.hash_position[n] = len(self.hash_position)
         super().add_edge(u_of_edge, v_of_edge, **attr)
+        if attr.get('type') != self.unindexed_edge_type:
+            self._index_edge(u_of_edge, v_of_edge)
+            self._rehash(u_of_edge, v_of_edge)
+        else:
+            self._rehash(v_of_edge, u_of_edge)
+
+    def _rehash(self, *nodes):
+        """
+        Recompute the hashes of `nodes` and then of every node whose hash depends on a changed one.
+        Nodes are visited in the order they were added (which is topological) and propagation stops at unchanged hashes.
+        """
+        todo = [(self.hash_position[n], n) for n in nodes]
+        heapq.heapify(todo)
+        while todo:
+            _, node = heapq.heappop(todo)
+            new = _node_hash(self, node, self.node_hash)
+            old = self.node_hash.get(node)
+            if new == old:
+                continue
+            if old is not None:
+                self.hash_total -= int(old, 16)
+            self.hash_total = (self.hash_total + int(new, 16)) % 2**64
+            self.node_hash[node] = new
+            for s, d in self._succ[node].items():
+                if d.get('type') != self.unindexed_edge_type:
+                    heapq.heappush(todo, (self.hash_position[s], s))
+            for p, d in self._pred[node].items():
+                if d.get('type') == self.unindexed_edge_type:
+                    heapq.heappush(todo, (self.hash_position[p], p))
+
+    def _index_edge(self, u, v):
+        """
+        Everything above `u` is now also above `v` and above everything below `v`.
+        Usually `v` is a new leaf node so this only touches one set.
+        """
+        index = self.ancestor_index
+        new = index.setdefault(u, {u}) - index.setdefault(v, {v})
+        todo = [v]
+        while new and todo:
+            node = todo.pop()
+            missing = new - index[node]
+            if missing:
+                index[node] |= missing
+                todo += [s for s, d in self._succ[node].items() if d.get('type') != self.unindexed_edge_type]
+
+    def ancestors_of(self, node) -> Set:
+        """
+        Returns all nodes which have a path to `node` (ignoring `unindexed_edge_type` edges), including `node` itself.
+        Do not modify the returned set.
+        """
+        return self.ancestor_index.get(node, {node})
 
 
 def plot_graph(graph, highlight_nodes=None, highlight_edges=None):
@@ -53,6 +130,8 @@ def plot_graph(graph, highlight_nodes=None, highlight_edges=None):
         if e in highlight_edges:
             g.edges[e]['arrowsize'] = 2
     nx.relabel_nodes(g, {n: f"{d['i']}\n{d['label']}" for n, d in graph.nodes(data=True)}, copy=False)
+    import graphviz
+    from networkx.drawing.nx_pydot import to_pydot
     return graphviz.Source(to_pydot(g).to_string())
 
 
@@ -199,3 +278,39 @@ def get_above_state_traversal_graph(graph: HashedDiGraph):
 def node_dependencies(graph, node):
     dag = subgraph_view(graph, excluded_edge_type='wrt')
     return {n for n in graph.nodes if nx.has_path(dag, n, node)} - {node}
+
+
+def _describe_edge(data: dict) -> tuple:
+    return tuple(sorted((k, v.fingerprint if k == 'statement' else v) for k, v in data.items() if k != 'style'))
+
+
+def _node_hash(graph, node, hashes: dict) -> str:
+    inputs = [(_describe_edge(d), hashes.get(a, '')) for a, _, d in graph.in_edges(node, data=True) if d.get('type') != 'wrt']
+    wrts = [hashes.get(b, '') for _, b, d in graph.out_edges(node, data=True) if d.get('type') == 'wrt']
+    return xxhash.xxh64(repr((sorted(inputs), sorted(wrts)))).hexdigest()
+
+
+def node_hashes(graph) -> Dict:
+    """
+    Returns a Merkle hash for each node in the graph.
+    A node's hash is made from its incoming edges (and their statements), the hashes of the nodes they come from,
+    and the hash of the node it aggregates to (if any).
+    So it describes everything needed to build that node, regardless of the order in which the graph was built.
+    """
+    dag = nx.subgraph_view(graph, filter_edge=lambda a, b: graph.edges[(a, b)].get('type') != 'wrt')
+    hashes = {}
+    for node in nx.topological_sort(dag):
+        hashes[node] = _node_hash(graph, node, hashes)
+    return hashes
+
+
+def canonical_hash(graph, hashes: Dict = None) -> str:
+    """
+    A hash of the structure and statements of the graph, which is the same in every python process
+    """
+    ends = [n for n in graph.nodes if not any(d.get('type') != 'wrt' for _, _, d in graph.out_edges(n, data=True))]
+    known = getattr(graph, 'node_hash', {})
+    if len(ends) == 1 and hashes is None and ends[0] in known:
+        return known[ends[0]]  # the hash of the only sink already describes the whole graph
+    hashes = node_hashes(graph) if hashes is None else hashes
+    return xxhash.xxh64(repr(sorted(hashes[n] for n in ends))).hexdigest()
@@ -8,6 +8,9 @@ from .utilities import mask_infs
 from .objects import AttributeQuery, ObjectQuery
 from .base import BaseQuery
 
+__all__ = ['sign', 'exp', 'log', 'log10', 'sqrt', 'floor', 'ceil', 'ismissing', 'isnull', 'isnan', 'neo4j_id', 'reduce',
+           'switch', 'to_int']
+
 
 def _template_operator(string_op: str, name: str, item: BaseQuery, python_func: Callable = None,
                        remove_infs=True, in_dtype=None, out_dtype=None, *args, **kwargs):
@@ -1,6 +1,9 @@
+import logging
+import os
 from collections import defaultdict
 from copy import copy
-from typing import List, Tuple, Dict
+from functools import partial
+from typing import List, Tuple, Dict, Optional, TYPE_CHECKING
 from pathlib import Path
 import warnings
 
@@ -12,6 +15,9 @@ from .utilities import mask_infs, remove_successive_duplicate_lines, dtype_conve
 from .digraph import HashedDiGraph, plot_graph, add_start, add_traversal, add_filter, add_aggregation, add_operation, add_return, add_unwind, subgraph_view, get_above_state_traversal_graph, node_dependencies, add_node_reference
 from .statements import StartingMatch, Traversal, NullStatement, Operation, GetItem, AssignToVariable, DirectFilter, CopyAndFilter, Aggregate, Return, Unwind, GetProduct, UnionTraversal, ApplyToList
 
+if TYPE_CHECKING:
+    from .cache import CompiledCypherCache
+
 
 class ParserError(Exception):
     pass
@@ -109,7 +115,134 @@ def traverse(graph, start=None, end=None, done=None, ordering=None, views=None):
                 raise DeadEndException  # all options exhausted, entire recursive path is bad
 
 
-def verify_traversal(graph, traversal_order):
+def plan(graph, start=None, end=None):
+    """
+    Order the traversal of the graph in one forward pass, without backtracking.
+    The walk follows the same rules as `traverse`:
+        - a node is only visited once all of its dependencies have been visited
+        - an aggregation is immediately followed by its wrt edge back up the tree
+        - returning along a wrt edge resets the nodes of that branch which are needed later, so they are traversed again
+    At a fork, instead of trying every option, choose the option that leads to a "stop"
+    (an aggregation that has not returned yet, or the end) along a path whose dependencies are all satisfied.
+    Single operations are preferred (as in `traverse`), then the stop that was added to the graph first.
+    The end is only chosen when there is nothing left to aggregate.
+    Raises DeadEndException when there is no such option, in which case use `traverse` instead.
+    """
+    dag = subgraph_view(graph, excluded_edge_type='wrt')
+    if start is None or end is None:
+        naive_ordering = list(nx.topological_sort(dag))
+        if start is None:
+            start = naive_ordering[0]  # get top node
+        if end is None:
+            end = naive_ordering[-1]
+    position = {n: i for i, n in enumerate(graph.nodes)}
+    children, deps, wrts, dag_predecessors = defaultdict(list), defaultdict(list), defaultdict(list), defaultdict(list)
+    for a, b, d in graph.edges(data=True):
+        typ = d.get('type', '')
+        if typ == 'wrt':
+            wrts[a].append(b)
+            continue
+        dag_predecessors[b].append(a)
+        if typ == 'dep':
+            deps[b].append(a)
+        else:
+            children[a].append(b)
+
+    def is_op(node, option):
+        edge = graph.edges[(node, option)]
+        return edge.get('type', '') == 'operation' and edge.get('single', False)
+
+    def best_stop(node, option, done):
+        """
+        the stop reachable from `option` along a path that has its dependencies satisfied.
+        Only the dependencies met along the path can change what is reachable from a node, so the best stop
+        is memoised on (node, dependencies met on the way there) and each node is searched once per such set
+        instead of once per path (which is exponential when paths split and join again).
+        """
+        visited = done | {node}
+        needed = {d for n in graph.nodes for d in deps[n]} - visited
+        memo = {}
+
+        def search(n, met):
+            key = (n, met)
+            if key not in memo:
+                if not all(d in visited or d in met for d in deps[n]):
+                    memo[key] = None
+                elif any((n, w) not in done for w in wrts[n]):
+                    memo[key] = (False, position[n])
+                else:
+                    met = met | ({n} & needed)
+                    stops = [search(c, met) for c in children[n] if c not in visited]
+                    stops = [s for s in stops if s is not None] + ([(True, position[n])] if n == end else [])
+                    memo[key] = min(stops, default=None)
+            return memo[key]
+
+        return search(option, frozenset())
+
+    ordering = [start]
+    node = start
+    done = set()  # stores wrt edges and visited nodes
+    while True:
+        if not all(dep in done for dep in deps[node]):
+            raise DeadEndException
+        options = [b for b in wrts[node] if (node, b) not in done]  # must do wrt first
+        if len(options) > 1:
+            raise DeadEndException
+        elif options:
+            target = options[0]
+            done.add((node, target))
+            # reset the branch from the wrt target to here, but only the nodes that have dep-paths
+            # to somewhere not yet visited (without going through this aggregation)
+            most_recent_mention = len(ordering) - ordering[::-1].index(target) - 1
+            this_branch = ordering[most_recent_mention:]
+            still_todo = set(graph.nodes) - done - set(this_branch)
+            needed = set(still_todo)
+            search = list(still_todo)
+            while search:
+                for n in dag_predecessors[search.pop()]:
+                    if n != node and n not in needed:
+                        needed.add(n)
+                        search.append(n)
+            for n in set(this_branch[:-1]) & needed:
+                done.discard(n)
+                for w in wrts[n]:
+                    done.discard((n, w))
+            done.add(node)
+            node = target
+            ordering.append(node)
+            continue
+        options = [o for o in children[node] if o not in done]  # where to go next?
+        if not options:
+            if node != end:
+                raise DeadEndException
+            return ordering
+        if len(options) > 1:
+            ranked = []
+            for option in options:
+                stop = best_stop(node, option, done)
+                if stop is not None:
+                    is_end, pos = stop
+                    ranked.append((not is_op(node, option), is_end, pos, option))
+            if not ranked:
+                raise DeadEndException
+            *_, is_end, _, option = min(ranked)
+            if is_end and any((n, w) not in done for n, ws in wrts.items() for w in ws):
+                raise DeadEndException  # going to the end now would leave aggregations behind
+            options = [option]
+        done.add(node)
+        node = options[0]
+        ordering.append(node)
+
+
+def verify_traversal(graph, traversal_order, dependencies=None, reference=None):
+    """
+    Check that `traversal_order` visits every edge of `graph` and that all dependencies of a node are visited before it.
+    `dependencies(node)` may be given to avoid searching the graph for each node.
+    If a `reference` ordering is given (e.g. from `traverse`), check that both orderings are equivalent:
+    they must traverse the same edges and end at the same node.
+    """
+    if dependencies is None:
+        dependencies = partial(node_dependencies, graph)
     edges = list(zip(traversal_order[:-1], traversal_order[1:]))
     if any(graph.edges[e]['type'] == 'dep' for e in edges):
         raise ParserError(f"Some dep edges where traversed. This is a bug")
@@ -119,9 +252,12 @@ def verify_traversal(graph, traversal_order):
     done = set()
     for n in traversal_order:
         if n not in done:
-            if not all(dep in done for dep in node_dependencies(graph, n)):
+            if not all(dep in done for dep in dependencies(n)):
                 raise ParserError(f"node {n} does not have all its dependencies satisfied. This is a bug")
             done.add(n)
+    if reference is not None:
+        if set(zip(reference[:-1], reference[1:])) != set(edges) or reference[-1] != traversal_order[-1]:
+            raise ParserError("The planned traversal is not equivalent to the backtracking traversal. This is a bug")
 
 
 def verify(graph):
@@ -247,8 +383,10 @@ class QueryGraph:
         again after filtering, then the aggregation is changed to conserve the required data and the duplicated traversal is removed
 
     """
+    check_planner = bool(os.getenv('WEAVEIO_CHECK_PLANNER', ''))  # compare each planned ordering with `traverse`
 
-    def __init__(self):
+    def __init__(self, compiled_cache: 'CompiledCypherCache' = None):
+        self.compiled_cache = compiled_cache
         self.G = HashedDiGraph()
         self.start = add_start(self.G, 'data')
         self.variable_names = defaultdict(int)
@@ -450,7 +588,7 @@ class QueryGraph:
         if wrt_node == parent_node or op_name == 'aggr':
             statement = NullStatement(self.G.nodes[parent_node]['variables'] + [wrt_node], self)
         else:
-            if wrt_node not in nx.ancestors(self.dag_G, parent_node):
+            if wrt_node not in self.G.ancestors_of(parent_node):
                 raise SyntaxError(f"{parent_node} cannot be aggregated to {wrt_node} ({wrt_node} is not an ancestor of {parent_node})")
             statement = Aggregate(self.G.nodes[parent_node]['variables'][0], wrt_node, op_format_string, op_name, self)
         previous = next(self.backwards_G.successors(parent_node), parent_node)
@@ -586,7 +724,28 @@ class QueryGraph:
     def restricted(self, result_node=None) -> HashedDiGraph:
         if result_node is None:
             return nx.subgraph_view(self.G)
-        return nx.subgraph_view(self.G, lambda n: nx.has_path(self.dag_G, n, result_node))
+        ancestors = frozenset(self.G.ancestors_of(result_node))
+        view = nx.subgraph_view(self.G, ancestors.__contains__)
+        view.sink, view.node_hash = result_node, self.G.node_hash  # everything above result_node is in the view
+        return view
+
+    def index_variable(self, result_node) -> Optional[str]:
+        """
+        Returns the variable of the object that indexes the rows returned by `result_node` (None if there isn't one)
+        """
+        for *_, statement in self.G.in_edges(result_node, data='statement'):
+            if isinstance(statement, Return):
+                return statement.index_variable
+        return None
+
+    def return_columns(self, result_node) -> List[str]:
+        """
+        Returns the names of the columns returned by the cypher for `result_node`, in order
+        """
+        for *_, statement in self.G.in_edges(result_node, data='statement'):
+            if isinstance(statement, Return):
+                return statement.columns
+        return []
 
     def dependency_parameters(self, result_node):
         ps = set()
@@ -595,40 +754,86 @@ class QueryGraph:
                 ps |= set(statement.parameters)
         return {k: v for k, v in self.parameters.items() if k in ps}
 
-    def traverse_query(self, result_node=None, simplify=True):
+    def traverse_query(self, result_node=None, simplify=True, backtrack=False):
+        """
+        Returns the order in which to visit nodes to build the query for `result_node`.
+        This uses the one-pass `plan` unless `backtrack` is True (or the planner gives up),
+        in which case the backtracking `traverse` is used.
+        """
         graph = self.restricted(result_node)
         # verify(graph)
         if simplify:
             graph = simplify_graph(graph)
+        if not backtrack:
+            try:
+                return plan(graph)
+            except DeadEndException:
+                logging.info(f"Could not plan the traversal to {result_node} in one pass, backtracking instead")
         return traverse(graph)[0]
 
     def verify_traversal(self, goal, ordering, simplify=True):
+        """
+        Check the ordering is valid. If `check_planner` is set, also check it is equivalent to the backtracking traversal
+        """
         graph = self.restricted(goal)
         if simplify:
             graph = simplify_graph(graph)
-        return verify_traversal(graph, ordering)
+        reference = traverse(graph)[0] if self.check_planner else None
+        return verify_traversal(graph, ordering, lambda n: self.G.ancestors_of(n) - {n}, reference)
 
     def cypher_lines(self, result, no_cache=False):
         try:
             cypher = self.G.nodes[result]['cypher']
             ordering = self.G.nodes[result]['ordering']
         except KeyError:
-            ordering = self.traverse_query(result)
-            self.verify_traversal(result, ordering)
-            statements = []
-            for i, e in enumerate(zip(ordering[:-1], ordering[1:])):
-                try:
-                    statement = self.G.edges[e]['statement'].make_cypher(ordering[:i+1])
-                    if statement is not None:
-                        statements.append(statement)
-                except KeyError:
-                    pass
-            cypher = remove_successive_duplicate_lines(statements)
+            # orderings are persisted as node hashes since node ids are specific to this graph
+            use_cache = not no_cache and self.compiled_cache is not None
+            compiled = self._load_compiled(result) if use_cache else None
+            if compiled is None:
+                ordering, cypher = self._compile(result)
+                if use_cache:
+                    hashes = self.G.node_hash
+                    self.compiled_cache.set(hashes[result], ([hashes[n] for n in ordering], cypher))
+            else:
+                ordering, cypher = compiled
             if not no_cache:
                 self.G.nodes[result]['cypher'] = cypher
                 self.G.nodes[result]['ordering'] = ordering
         return copy(cypher)
 
+    def _compile(self, result):
+        ordering = self.traverse_query(result)
+        try:
+            self.verify_traversal(result, ordering)
+        except ParserError:
+            if self.check_planner:
+                raise
+            ordering = self.traverse_query(result, backtrack=True)
+            self.verify_traversal(result, ordering)
+        statements = []
+        for i, e in enumerate(zip(ordering[:-1], ordering[1:])):
+            try:
+                statement = self.G.edges[e]['statement'].make_cypher(ordering[:i+1])
+                if statement is not None:
+                    statements.append(statement)
+            except KeyError:
+                pass
+        return ordering, remove_successive_duplicate_lines(statements)
+
+    def _load_compiled(self, result):
+        """
+        Look up the ordering and cypher for `result` in the persistent cache by the hash of `restricted(result)`
+        """
+        compiled = self.compiled_cache.get(self.G.node_hash[result])
+        if compiled is None:
+            return None
+        hashed_ordering, cypher = compiled
+        hashes = {n: self.G.node_hash[n] for n in self.G.ancestors_of(result)}
+        nodes = {h: n for n, h in hashes.items()}
+        if len(nodes) != len(hashes) or not all(h in nodes for h in hashed_ordering):
+            return None  # hashes are ambiguous for this graph
+        return [nodes[h] for h in hashed_ordering], cypher
+
     def node_is_null_statement(self, node):
         if self.node_holds_type(node, 'aggr'):
             return any(isinstance(d.get('statement', None), NullStatement) for _, _, d in self.G.in_edges(node, data=True))
@@ -1,6 +1,14 @@
-from collections import OrderedDict, Counter, defaultdict
+import os
+import weakref
+from collections import OrderedDict, Counter, defaultdict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import List, Union, Tuple
+from tempfile import mkstemp
+from threading import RLock
+from typing import List, Union, Tuple, Callable, Optional, Dict
 
 import numpy as np
 import py2neo
@@ -9,6 +17,14 @@ from astropy.table import Table as AstropyTable, Row as AstropyRow, MaskedColumn
 from py2neo.cypher import Cursor
 
 
+def padding_value(dtype):
+    """
+    The value put under the mask where arrays are padded: NaN for floats, otherwise zero (or the empty string)
+    """
+    dtype = np.dtype(dtype)
+    return np.nan if np.issubdtype(dtype, np.inexact) else np.zeros((), dtype=dtype)[()]
+
+
 def ragged_array(data):
     """
     Given an object array of different length lists/arrays (indexed on the first axis) return a ragged array
@@ -27,18 +43,38 @@ def ragged_array(data):
     if len(set(shapes)) == 1:
         return data
     maxshape = np.max(shapes, axis=0)
-    array = np.ma.empty((len(data), *maxshape), dtype=dtype)
-    array.mask = True
+    array = np.ma.array(np.full((len(data), *maxshape), padding_value(dtype), dtype=dtype), mask=True)
     slcs = [tuple(slice(0, s) for s in shape_tuple) for shape_tuple in shapes]
     for i, (slc, d) in enumerate(zip(slcs, data)):
         array.__setitem__((i, *slc), d)
     return array
 
 
-def ragged_column(data, name):
+RAGGED_REPRESENTATIONS = [None, 'offsets']
+
+
+def check_ragged(ragged):
+    if ragged not in RAGGED_REPRESENTATIONS:
+        raise ValueError(f"ragged must be one of {RAGGED_REPRESENTATIONS}, not {ragged!r}")
+
+
+def ragged_column(data, name, ragged=None):
+    """
+    Make a column from a list of values. Values of different shapes are padded into a masked array,
+    unless ragged='offsets' where 1D values of different lengths are stored in a `RaggedColumn` instead.
+    """
+    check_ragged(ragged)
+    if ragged == 'offsets':
+        darrays = [np.ma.asarray(d) for d in data]
+        if len({d.shape for d in darrays}) > 1 and all(d.ndim == 1 or is_null(d) for d in darrays):
+            return RaggedColumn.from_arrays(darrays, name=name)
     return MaskedColumn(ragged_array(data), name=name)
 
 
+def is_null(value) -> bool:
+    return np.ndim(value) == 0 and bool(np.ma.getmaskarray(value))
+
+
 class ColnameParser:
     def __init__(self, parent, partial_colname: str):
         self.parent = parent
@@ -69,6 +105,9 @@ class MaskedColumn(AstropyMaskedColumn):
         """
         return ragged_column([func(d, *args, **kwargs) for d in self.data], self.name)
 
+    def dense(self) -> 'MaskedColumn':
+        return self
+
     def masked(self, mask, inplace=False):
         if inplace:
             c = self
@@ -86,6 +125,115 @@ class MaskedColumn(AstropyMaskedColumn):
         return c
 
 
+class RaggedColumn(MaskedColumn):
+    """
+    A column of 1D arrays of different lengths, which are not padded to the same length.
+    The values of all the rows are stored one after the other in one flat masked array
+    and each row is a view of its part of that array. Null rows are masked.
+    Use `dense()` to get the padded `MaskedColumn` that would be returned by default.
+    """
+    @classmethod
+    def from_arrays(cls, arrays, name=None) -> 'RaggedColumn':
+        arrays = [np.ma.asarray(a) for a in arrays]
+        null = np.array([is_null(a) for a in arrays], dtype=bool)
+        dtypes = {a.dtype for a, n in zip(arrays, null) if not n and not np.all(a.mask)}
+        dtype = np.result_type(*dtypes) if dtypes else np.float_
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([0 if n else a.size for a, n in zip(arrays, null)], out=offsets[1:])
+        values = np.ma.empty(offsets[-1], dtype=dtype)
+        values.mask = np.zeros(offsets[-1], dtype=bool)
+        for a, n, start, stop in zip(arrays, null, offsets[:-1], offsets[1:]):
+            if not n:
+                values[start:stop] = a
+        return cls.from_values(values, offsets, null, name)
+
+    @classmethod
+    def from_values(cls, values: np.ma.MaskedArray, offsets: np.ndarray, null: np.ndarray = None, name=None) -> 'RaggedColumn':
+        """
+        Make a column where row i is values[offsets[i]:offsets[i+1]] (or null)
+        """
+        null = np.zeros(len(offsets) - 1, dtype=bool) if null is None else null
+        cells = np.empty(len(null), dtype=object)
+        for i, (start, stop) in enumerate(zip(offsets[:-1], offsets[1:])):
+            cells[i] = values[start:stop]
+        return cls(cells, mask=null, name=name)
+
+    @property
+    def null(self) -> np.ndarray:
+        return np.ma.getmaskarray(self)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.array([0 if n else len(c) for c, n in zip(self.data.data, self.null)], dtype=np.int64)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(self.lengths, out=offsets[1:])
+        return offsets
+
+    @property
+    def flat_values(self) -> np.ma.MaskedArray:
+        """
+        The values of all rows one after the other. Row i is flat_values[offsets[i]:offsets[i+1]]
+        """
+        cells = [c for c, n in zip(self.data.data, self.null) if not n]
+        if not cells:
+            return np.ma.array([], dtype=np.float_)
+        return np.ma.concatenate(cells)
+
+    def apply(self, func, *args, **kwargs) -> 'MaskedColumn':
+        """
+        Apply a function to each row in the column. If the results are still of different lengths, they are not padded.
+        :param func: Callable to apply to each row. Takes the 1D array of that row.
+        """
+        return ragged_column([func(d, *args, **kwargs) for d in self.data], self.name, ragged='offsets')
+
+    def dense(self) -> MaskedColumn:
+        """
+        Returns the rows padded to the same length in a masked 2D column
+        """
+        lengths, null = self.lengths, self.null
+        values = self.flat_values
+        shape = (len(self), lengths.max(initial=0))
+        array = np.ma.array(np.full(shape, padding_value(values.dtype), dtype=values.dtype), mask=True)
+        for i, (c, n, length) in enumerate(zip(self.data.data, null, lengths)):
+            if not n:
+                array[i, :length] = c
+        return MaskedColumn(array, name=self.name)
+
+
+class SharedColumn(MaskedColumn):
+    """
+    A column of products which many rows share (e.g. the wavelength grid of all the spectra in a file).
+    Each distinct product (`categories`) is stored once and each row is the same read-only array as the others
+    that share it (`codes` gives the index of its category), so the column takes no more memory than its categories.
+    Use `dense()` to get the padded `MaskedColumn` that would be returned by default.
+    """
+    @classmethod
+    def from_categories(cls, categories: List[np.ma.MaskedArray], codes: np.ndarray, name=None) -> 'SharedColumn':
+        categories = [read_only(np.ma.asarray(c)) for c in categories]
+        cells = np.empty(len(codes), dtype=object)
+        for i, code in enumerate(codes):
+            cells[i] = categories[code]
+        return cls(cells, mask=np.zeros(len(codes), dtype=bool), name=name)
+
+    @property
+    def categories(self) -> List[np.ma.MaskedArray]:
+        return list({id(c): c for c in self.data.data}.values())
+
+    @property
+    def codes(self) -> np.ndarray:
+        ids = {}
+        return np.array([ids.setdefault(id(c), len(ids)) for c in self.data.data], dtype=np.int64)
+
+    def dense(self) -> MaskedColumn:
+        """
+        Returns the rows copied into a masked 2D column (padded if the categories have different lengths)
+        """
+        return ragged_column(list(self.data.data), self.name)
+
+
 class Table(DotHandlerMixin, AstropyTable):  # allow using `.` to access columns
     Row = Row
     Column = MaskedColumn
@@ -93,20 +241,27 @@ class Table(DotHandlerMixin, AstropyTable):  # allow using `.` to access columns
     def apply(self, func, *args, **kwargs) -> 'MaskedColumn':
         """
         Apply a function to each row in the column. Returns nd array if possible otherwise an unstructured array.
+        If the table has any `RaggedColumn`s, results of different lengths are not padded either.
         :param func: Callable to apply to each row. Takes an array/scalar depending on the type of the column.
         """
-        return ragged_column([func(row, *args, **kwargs) for row in self], func.__name__)
+        ragged = 'offsets' if any(isinstance(self[c], RaggedColumn) for c in self.colnames) else None
+        return ragged_column([func(row, *args, **kwargs) for row in self], func.__name__, ragged)
+
+    def dense(self) -> 'Table':
+        """
+        Returns a copy of the table where `RaggedColumn`s are padded and `SharedColumn`s are copied for each row
+        """
+        return Table([self[c].dense() for c in self.colnames], meta=self.meta)
 
 class ArrayHolder:
     def __init__(self, array):
         self.array = array
 
 
-def vstack_rows(rows: List[Tuple[List, List[bool], List[str]]], *args, **kwargs) -> Table:
-    # for each column, remove null rows, make table, put nulls back in
-    columns, names = zip(*rows)
-    names = names[0]
-    columns = list(zip(*columns))
+def unique_column_names(names: List[str]) -> List[str]:
+    """
+    Number the names which are duplicated e.g. [a, b, a] -> [a0, b, a1]
+    """
     duplicate_names = [n for n, i in Counter(names).items() if i > 1]
     counter = defaultdict(int)
     _names = []
@@ -116,7 +271,44 @@ def vstack_rows(rows: List[Tuple[List, List[bool], List[str]]], *args, **kwargs)
             counter[n] += 1
         else:
             _names.append(n)
-    return Table([ragged_column(c, f"{n}{counter.get(n, '')}") for c, n in zip(columns, _names)])
+    return [f"{n}{counter.get(n, '')}" for n in _names]
+
+
+def vstack_rows(rows: List[Tuple[List, List[bool], List[str]]], *args, **kwargs) -> Table:
+    # for each column, remove null rows, make table, put nulls back in
+    columns, names = zip(*rows)
+    columns = list(zip(*columns))
+    return Table([ragged_column(c, n) for c, n in zip(columns, unique_column_names(names[0]))])
+
+
+SCALAR_TYPES = {bool, int, float, type(None)}
+INT64_RANGE = (np.iinfo(np.int64).min, np.iinfo(np.int64).max)
+
+
+def scalar_column(values: Tuple, name: str) -> Union[MaskedColumn, None]:
+    """
+    Make a column from python scalars in one go, giving the same column as converting each value
+    with `RowParser.parse_value` and then using `ragged_column`.
+    That conversion promotes a column containing null to float, masking nulls, nans and infs (with NaN underneath).
+    Returns None if the values are not all numbers/bools/nulls or all strings; those need converting one by one.
+    """
+    types = set(map(type, values))
+    if types == {str}:
+        return MaskedColumn(np.array(values), mask=np.zeros(len(values), dtype=bool), name=name)
+    if not types <= SCALAR_TYPES:
+        return None
+    if int in types:
+        ints = [v for v in values if type(v) is int]
+        if min(ints) < INT64_RANGE[0] or max(ints) > INT64_RANGE[1]:
+            return None
+    if types & {float, type(None)}:
+        data = np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+        mask = ~np.isfinite(data)
+        data[mask] = np.nan
+    else:
+        data = np.array(values)
+        mask = np.zeros(len(values), dtype=bool)
+    return MaskedColumn(data, mask=mask, name=name)
 
 def int_or_slice(x: Union[int, float, slice, None]) -> Union[int, slice]:
     if isinstance(x, (int, float)):
@@ -126,50 +318,432 @@ def int_or_slice(x: Union[int, float, slice, None]) -> Union[int, slice]:
     else:
         return slice(None, None)
 
+def read_only(value):
+    """
+    Returns a read-only view of an array (anything else is returned as it is)
+    """
+    if isinstance(value, np.ndarray):
+        value = value.view()
+        value.flags.writeable = False
+    return value
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'evictions', 'files', 'mapped_bytes'])
+
+
 class FileHandler:
-    def __init__(self, rootdir: Union[Path, str], max_concurrency: int = 1000):
+    """
+    Reads products out of fits files under `rootdir`.
+    Open files are kept in a least-recently-used cache limited both by the number of files (`max_concurrency`)
+    and by the total size of the files mapped into memory (`max_mapped_bytes`). Evicted files are closed.
+    Headers are cached separately (up to `max_headers`) so that header reads survive eviction.
+    All cache bookkeeping is done under a lock so products can be read from several threads at once, but files
+    are opened and parsed outside of it: each file (and extension) is loaded by the first thread to ask for it
+    while any others wait for that, and files being read are not evicted.
+    If `product_workers` > 0, the products of different files are read concurrently by a pool of that many threads.
+    """
+    def __init__(self, rootdir: Union[Path, str], max_concurrency: int = 1000, max_mapped_bytes: int = 8 * 1024**3,
+                 max_headers: int = 100_000, product_workers: int = 0):
         self.rootdir = Path(rootdir)
         self.max_concurrency = max_concurrency
+        self.max_mapped_bytes = max_mapped_bytes
+        self.max_headers = max_headers
         self.files = OrderedDict()
+        self.sizes = {}
+        self.hdus = {}
+        self.headers = OrderedDict()
+        self.mapped_bytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = RLock()
+        self.loading = {}  # key -> Future of a file or extension being loaded by another thread
+        self.in_use = Counter()
+        self.executor = None
+        if product_workers:
+            self.executor = ThreadPoolExecutor(product_workers, thread_name_prefix='weaveio-products')
+
+    def cache_info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, self.evictions, len(self.files), self.mapped_bytes)
 
     def read(self, filename: Union[Path, str], ext: Union[float, int, str] = None, index: Union[float, int, slice] = None,
              key: Union[str, int, float, slice] = None, header_only=False):
-        f = self.open_file(filename)
-        if ext is None:
-            ext = 0
-        ext = ext if isinstance(ext, str) else int(ext)
-        hdu = f[ext]
         index = int_or_slice(index)
         key = key if isinstance(key, str) else int_or_slice(key)
         if header_only:
+            header = self.read_header(filename, ext)
             if key is not None:
-                return hdu.header[key]
-            return hdu.header
-        return hdu.data[index][key]
+                return header[key]
+            return header
+        return self.read_data(filename, ext)[index][key]
 
+    def read_many(self, addresses: List[list]) -> List:
+        """
+        Read a list of product addresses (the arguments to `read`) and return the data in the same order.
+        Single rows of the same (file, extension, key) are gathered with one fancy-indexed read per group
+        and scattered back, everything else falls back to `read`.
+        """
+        return self.prefetch_many(addresses)()
 
-    def open_file(self, filename: Union[Path, str]):
+    def prefetch_many(self, addresses: List[list]) -> Callable[[], List]:
+        """
+        Start reading `addresses` and return a function which waits for and returns the data, as in `read_many`.
+        Without a thread pool the addresses are read straight away.
+        Repeated addresses are only read once and share the same read-only array.
+        """
+        try:
+            unique = {}
+            inverse = [unique.setdefault(tuple(address), len(unique)) for address in addresses]
+        except TypeError:  # unhashable addresses can't be deduplicated
+            unique = addresses
+        if len(unique) < len(addresses):
+            pending = self.prefetch_many([list(address) for address in unique])
+            def collect_shared():
+                results = [read_only(result) for result in pending()]
+                return [results[i] for i in inverse]
+            return collect_shared
+        files = defaultdict(list)
+        for i, address in enumerate(addresses):
+            files[address[0]].append(i)
+        if self.executor is None:
+            results = self._read_many(addresses)
+            return lambda: results
+        futures = [(positions, self.executor.submit(self._read_many, [addresses[i] for i in positions]))
+                   for positions in files.values()]
+        def collect():
+            results = [None] * len(addresses)
+            for positions, future in futures:
+                for i, result in zip(positions, future.result()):
+                    results[i] = result
+            return results
+        return collect
+
+    def _read_many(self, addresses: List[list]) -> List:
+        results = [None] * len(addresses)
+        groups = defaultdict(list)
+        for i, address in enumerate(addresses):
+            filename, ext, index, key, *header_only = address
+            if (header_only and header_only[0]) or not isinstance(index, (int, float)):
+                results[i] = self.read(*address)
+            else:
+                groups[(filename, ext, key)].append((i, int(index)))
+        for (filename, ext, key), members in groups.items():
+            data = self.read_data(filename, ext)
+            key = key if isinstance(key, str) else int_or_slice(key)
+            indices, inverse = np.unique([index for _, index in members], return_inverse=True)
+            if not isinstance(data, fits.FITS_rec):
+                block = data[indices]
+                for (i, _), j in zip(members, inverse):
+                    results[i] = block[j][key]
+            elif isinstance(key, (str, int)):
+                block = data.field(key)[indices]
+                for (i, _), j in zip(members, inverse):
+                    results[i] = block[j]
+            else:
+                for i, index in members:
+                    results[i] = data[index][key]
+        return results
+
+    def read_data(self, filename: Union[Path, str], ext: Union[float, int, str] = None):
+        """
+        Return the (memory-mapped) data of an extension
+        """
+        with self.using(filename):
+            return self.open_hdu(filename, ext).data
+
+    def read_header(self, filename: Union[Path, str], ext: Union[float, int, str] = None) -> fits.Header:
+        """
+        Return the header of an extension, parsing it only the first time it is asked for
+        """
+        ext = 0 if ext is None else ext if isinstance(ext, str) else int(ext)
+        address = (self.rootdir / Path(filename), ext)
+        with self.lock:
+            if address in self.headers:
+                self.hits += 1
+                self.headers.move_to_end(address)
+                return self.headers[address]
+        with self.using(filename):
+            header = self.open_hdu(filename, ext).header
+        with self.lock:
+            self.headers[address] = header
+            while len(self.headers) > self.max_headers:
+                self.headers.popitem(last=False)
+        return header
+
+    @contextmanager
+    def using(self, filename: Union[Path, str]):
+        """
+        Keep a file from being evicted (and closed) while it is read outside the lock
+        """
         filename = self.rootdir / Path(filename)
-        if filename in self.files:
-            return self.files[filename]
+        with self.lock:
+            self.in_use[filename] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.in_use[filename] -= 1
+                if not self.in_use[filename]:
+                    del self.in_use[filename]
+
+    def load_once(self, key, cached: Callable, load: Callable):
+        """
+        Return `cached()` if it isn't None, otherwise `load()` it (outside the lock).
+        If another thread is already loading `key`, wait for its result instead of loading it again.
+        """
+        with self.lock:
+            value = cached()
+            if value is not None:
+                return value
+            future = self.loading.get(key)
+            loader = future is None
+            if loader:
+                future = self.loading[key] = Future()
+        if not loader:
+            return future.result()
+        try:
+            value = load()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
         else:
-            if len(self.files) >= self.max_concurrency:
-                self.close_file(next(iter(self.files)))
-            self.files[filename] = fits.open(str(filename), memmap=True)
-            return self.files[filename]
+            future.set_result(value)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+
+    def open_hdu(self, filename: Union[Path, str], ext: Union[float, int, str] = None):
+        ext = 0 if ext is None else ext if isinstance(ext, str) else int(ext)
+        address = (self.rootdir / Path(filename), ext)
+
+        def load():
+            f = self.open_file(filename)
+            hdu = f[ext]  # reads the headers up to `ext`
+            with self.lock:
+                if self.files.get(address[0]) is f:  # don't keep extensions of a file that was evicted meanwhile
+                    self.hdus[address] = hdu
+            return hdu
+
+        return self.load_once(address, lambda: self.hdus.get(address), load)
+
+    def cached_file(self, filename: Path):
+        with self.lock:
+            if filename in self.files:
+                self.hits += 1
+                self.files.move_to_end(filename)
+                return self.files[filename]
+
+    def open_file(self, filename: Union[Path, str]):
+        filename = self.rootdir / Path(filename)
+
+        def load():
+            size = filename.stat().st_size
+            f = fits.open(str(filename), memmap=True)
+            with self.lock:
+                self.misses += 1
+                while self.files and (len(self.files) >= self.max_concurrency or
+                                      self.mapped_bytes + size > self.max_mapped_bytes):
+                    evict = next((name for name in self.files if not self.in_use[name]), None)
+                    if evict is None:  # everything open is being read
+                        break
+                    self.evictions += 1
+                    self.close_file(evict)
+                self.files[filename] = f
+                self.sizes[filename] = size
+                self.mapped_bytes += size
+            return f
+
+        return self.load_once(filename, lambda: self.cached_file(filename), load)
 
     def close_file(self, filename: Path):
-        if filename in self.files:
-            del self.files[filename]
+        """
+        Close a file and forget its extensions. Arrays that were already read from it stay valid
+        since astropy only closes the memory map once nothing refers to it.
+        """
+        with self.lock:
+            if filename in self.files:
+                self.files.pop(filename).close()
+                self.mapped_bytes -= self.sizes.pop(filename)
+                for address in [a for a in self.hdus if a[0] == filename]:
+                    del self.hdus[address]
 
     def close_all(self):
-        for filename in list(self.files):
-            self.close_file(filename)
+        with self.lock:
+            for filename in list(self.files):
+                self.close_file(filename)
 
     def __del__(self):
+        if getattr(self, 'executor', None) is not None:
+            self.executor.shutdown(wait=False)
         self.close_all()
 
 
+def table_to_arrays(table: AstropyTable) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Returns the columns of a table as plain numpy arrays (values and masks, and offsets for `RaggedColumn`s)
+    for saving with `np.savez`. Returns None if a column can't be stored without pickling (i.e. it has objects).
+    """
+    arrays = {'_names': np.array(table.colnames, dtype=str),
+              '_ragged': np.array([isinstance(table[c], RaggedColumn) for c in table.colnames], dtype=bool),
+              '_shared': np.array([isinstance(table[c], SharedColumn) for c in table.colnames], dtype=bool)}
+    for i, name in enumerate(table.colnames):
+        column = table[name]
+        if isinstance(column, SharedColumn):
+            arrays[f'{i}.codes'] = column.codes
+            for j, category in enumerate(column.categories):
+                if category.dtype.hasobject:
+                    return None
+                arrays[f'{i}.{j}.data'], arrays[f'{i}.{j}.mask'] = np.ma.getdata(category), np.ma.getmaskarray(category)
+            continue
+        if isinstance(column, RaggedColumn):
+            values = column.flat_values
+            arrays[f'{i}.offsets'], arrays[f'{i}.null'] = column.offsets, column.null
+        else:
+            values = np.ma.asarray(column)
+        if values.dtype.hasobject:
+            return None
+        arrays[f'{i}.data'], arrays[f'{i}.mask'] = np.ma.getdata(values), np.ma.getmaskarray(values)
+    return arrays
+
+
+def table_from_arrays(arrays) -> 'Table':
+    """
+    The inverse of `table_to_arrays`
+    """
+    columns = []
+    shared = arrays['_shared'] if '_shared' in arrays else np.zeros_like(arrays['_ragged'])
+    for i, (name, ragged) in enumerate(zip(arrays['_names'], arrays['_ragged'])):
+        if shared[i]:
+            codes = arrays[f'{i}.codes']
+            categories = [np.ma.array(arrays[f'{i}.{j}.data'], mask=arrays[f'{i}.{j}.mask'])
+                          for j in range(codes.max(initial=-1) + 1)]
+            columns.append(SharedColumn.from_categories(categories, codes, str(name)))
+            continue
+        values = np.ma.array(arrays[f'{i}.data'], mask=arrays[f'{i}.mask'])
+        if ragged:
+            columns.append(RaggedColumn.from_values(values, arrays[f'{i}.offsets'], arrays[f'{i}.null'], str(name)))
+        else:
+            columns.append(MaskedColumn(values, name=str(name)))
+    return Table(columns)
+
+
+def remove_file(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
+
+
+def temporary_memmap(shape, dtype, directory: Union[Path, str] = None) -> np.memmap:
+    """
+    Returns an array memory-mapped from a new temporary file in `directory`, which lives exactly as long as the array.
+    The file is unlinked straight away (its data stays readable until the last view of the array is gone) or,
+    where the OS won't allow that, removed once the mapping is garbage collected.
+    """
+    fd, fname = mkstemp(prefix='weaveio-', suffix='.dat', dir=directory)
+    os.close(fd)
+    array = np.memmap(fname, dtype=dtype, mode='w+', shape=shape)
+    try:
+        os.remove(fname)
+    except OSError:
+        weakref.finalize(array._mmap, remove_file, fname)  # views share the mmap, not the memmap array
+    return array
+
+
+def spill_arrays(arrays: Dict[str, np.ndarray], directory: Union[Path, str] = None) -> Dict[str, np.ndarray]:
+    """
+    Copy each array to a read-only `temporary_memmap` in `directory` (empty arrays are kept in memory)
+    """
+    spilled = {}
+    for key, array in arrays.items():
+        if array.size:
+            spilled[key] = temporary_memmap(array.shape, array.dtype, directory)
+            spilled[key][...] = array
+            spilled[key].flags.writeable = False
+        else:
+            spilled[key] = array
+    return spilled
+
+
+def column_nbytes(column: MaskedColumn) -> int:
+    if isinstance(column, RaggedColumn):
+        values = column.flat_values
+        return values.nbytes + np.ma.getmaskarray(values).nbytes
+    return np.ma.getdata(column).nbytes + np.ma.getmaskarray(column).nbytes
+
+
+class ArrayAllocator:
+    """
+    Makes empty arrays, either in memory or (if `spill`) as `temporary_memmap`s in `directory`
+    """
+    def __init__(self, spill: bool = False, directory: Union[Path, str] = None):
+        self.spill = spill
+        self.directory = directory
+
+    def __call__(self, shape, dtype, fill) -> np.ndarray:
+        if not self.spill or not np.prod(shape):
+            array = np.empty(shape, dtype=dtype)
+        else:
+            array = temporary_memmap(shape, dtype, self.directory)
+        array[...] = fill
+        return array
+
+
+def concatenate_columns(columns: List[MaskedColumn], name: str, ragged=None,
+                        allocate: ArrayAllocator = None) -> MaskedColumn:
+    """
+    Join columns of consecutive rows, giving the same column as `ragged_column` on all the rows at once:
+    values of different shapes are padded to the largest (or make a `RaggedColumn` if ragged='offsets').
+    The joined arrays are made with `allocate`.
+    """
+    allocate = ArrayAllocator() if allocate is None else allocate
+    if all(isinstance(c, SharedColumn) for c in columns):  # only the references to the shared products are joined
+        cells = np.concatenate([c.data.data for c in columns])
+        return SharedColumn(cells, mask=np.zeros(len(cells), dtype=bool), name=name)
+    dense = [c for c in columns if not isinstance(c, RaggedColumn)]
+    ndims = {c.ndim for c in dense}
+    dtype = np.result_type(*[c.flat_values.dtype if isinstance(c, RaggedColumn) else c.dtype for c in columns])
+    if ragged == 'offsets' and ndims <= {2} and (len(dense) < len(columns) or len({c.shape[1:] for c in dense}) > 1):
+        columns = [c if isinstance(c, RaggedColumn) else RaggedColumn.from_arrays(list(c), name) for c in columns]
+        lengths = np.concatenate([c.lengths for c in columns])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        data, mask = allocate((offsets[-1],), dtype, 0), allocate((offsets[-1],), bool, False)
+        for column, start in zip(columns, offsets[np.cumsum([0] + [len(c) for c in columns[:-1]])]):
+            values = column.flat_values
+            data[start:start + len(values)] = np.ma.getdata(values)
+            mask[start:start + len(values)] = np.ma.getmaskarray(values)
+        null = np.concatenate([c.null for c in columns])
+        return RaggedColumn.from_values(np.ma.array(data, mask=mask, copy=False), offsets, null, name)
+    if len(ndims) > 1 or dtype.hasobject:  # can't be joined as arrays, so do it row by row in memory
+        return ragged_column([value for column in columns for value in column], name, ragged)
+    shape = (sum(len(c) for c in columns), *np.max([c.shape[1:] for c in columns], axis=0).astype(int))
+    data, mask = allocate(shape, dtype, padding_value(dtype)), allocate(shape, bool, True)
+    start = 0
+    for column in columns:
+        slc = (slice(start, start + len(column)), *(slice(0, n) for n in column.shape[1:]))
+        data[slc] = np.ma.getdata(column)
+        mask[slc] = np.ma.getmaskarray(column)
+        start += len(column)
+    return MaskedColumn(data, mask=mask, name=name, copy=False)
+
+
+class SplitRecord(tuple):
+    """
+    A cypher record without its leading split index column.
+    It has the `keys` and `values` that the `RowParser` reads from records.
+    """
+    def __new__(cls, record):
+        split = super().__new__(cls, record.values()[1:])
+        split._keys = record.keys()[1:]
+        return split
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self)
+
+
 def recursive_replace_None(l: List) -> List:
     if not isinstance(l, list):
         return np.ma.masked if l is None else l
@@ -179,45 +753,308 @@ def recursive_replace_None(l: List) -> List:
 
 
 class RowParser(FileHandler):
+    """
+    Parses query results, reading the products they point to with `FileHandler`.
+    If `product_matrix`, product columns whose rows are the same length in fits tables are read into one 2D array
+    (a zero-copy view of the file where possible) rather than row by row.
+    """
+    def __init__(self, rootdir: Union[Path, str], *args, product_matrix: bool = False, **kwargs):
+        super().__init__(rootdir, *args, **kwargs)
+        self.product_matrix = product_matrix
+
     def parse_product_row(self, row: py2neo.cypher.Record, names: List[Union[str, None]], is_products: List[bool],
                           as_row: bool):
         """
         Take a pandas dataframe and replace the structure of ['fname', 'extn', 'index', 'key', 'header_only']
         with the actual data
         """
+        return self.parse_row(row.keys(), self.read_rows([row], is_products)[0], names, as_row)
+
+    def parse_row(self, keys: List[str], values: List, names: List[Union[str, None]], as_row: bool):
+        """
+        Mask the values of a row whose products have already been read and name its columns
+        """
         columns = []
         colnames = []
-        for value, cypher_name, name, is_product in zip(row.values(), row.keys(), names, is_products):
-            if is_product:
-                if value is not None:
-                    if isinstance(value[0], list):  # i.e. its a list of product addresses that have been collected
-                        value = [self.read(*v) for v in value]
-                    else:
-                        value = self.read(*value)
-            value = recursive_replace_None(value)
-            name = cypher_name if name is None or name == 'None' else name
-            mask = value is None or np.size(value) == 0
-            try:
-                mask = mask | ~np.isfinite(value)
-            except TypeError:
-                pass
-            value = np.ma.where(~mask, np.ma.asarray(value), np.ma.masked)
-            columns.append(value)
-            colnames.append(name)
+        for value, cypher_name, name in zip(values, keys, names):
+            columns.append(self.parse_value(value, False))
+            colnames.append(cypher_name if name is None or name == 'None' else name)
         if as_row:
             columns = [MaskedColumn([value]) for value in columns]
             return Table(columns, names=colnames)[0]
         return columns, colnames
 
-    def iterate_cursor(self, cursor: Cursor, names: List[Union[str, None]], is_products: List[bool], as_row: bool):
-        for row in cursor:
-            yield self.parse_product_row(row, names, is_products, as_row)
+    def read_products(self, values: List) -> List:
+        """
+        Replace the product addresses in a column of values with the data they point to.
+        Every address in the column is read together by `read_many`.
+        """
+        return self.prefetch_products(values)()
+
+    def prefetch_products(self, values: List) -> Callable[[], List]:
+        """
+        Start reading the products of a column, returning a function which waits for them as in `read_products`
+        """
+        addresses, positions = [], []
+        values = list(values)
+        for i, value in enumerate(values):
+            if value is not None:
+                if isinstance(value[0], list):  # i.e. its a list of product addresses that have been collected
+                    addresses += value
+                    positions += [(i, j) for j in range(len(value))]
+                    values[i] = [None] * len(value)
+                else:
+                    addresses.append(value)
+                    positions.append((i, None))
+        pending = self.prefetch_many(addresses)
+        def collect():
+            for (i, j), data in zip(positions, pending()):
+                if j is None:
+                    values[i] = data
+                else:
+                    values[i][j] = data
+            return values
+        return collect
+
+    def read_rows(self, rows: List[py2neo.cypher.Record], is_products: List[bool]) -> List[List]:
+        """
+        Return the values of each row with the products read, column by column
+        """
+        return self.prefetch_rows(rows, is_products)()
+
+    def prefetch_rows(self, rows: List[py2neo.cypher.Record], is_products: List[bool]) -> Callable[[], List[List]]:
+        columns = [self.prefetch_products(values) if is_product else partial(list, values)
+                   for values, is_product in zip(zip(*(row.values() for row in rows)), is_products)]
+        return lambda: [list(values) for values in zip(*(column() for column in columns))]
+
+    def read_product_column(self, values: List) -> Optional[np.ma.MaskedArray]:
+        """
+        Read a column of products in one go with `read_shared_products` or `read_product_matrix` if possible
+        """
+        pending = self.prefetch_product_column(values)
+        return None if pending is None else pending()
+
+    def prefetch_product_column(self, values: List) -> Optional[Callable[[], Optional[np.ma.MaskedArray]]]:
+        """
+        Start reading a column as in `read_product_column`. Returns None straight away if the column has to be read
+        row by row, otherwise a function which waits for the result (which may still turn out to be None).
+        """
+        shared = self.read_shared_products(values)
+        if shared is not None:
+            return lambda: shared
+        if self.product_matrix:
+            return self.prefetch_product_matrix(values)
+        return None
+
+    def read_shared_products(self, values: List) -> Optional[MaskedColumn]:
+        """
+        Read a column of products in which most rows point to the same few products
+        (e.g. the wavelength grid shared by all the spectra in a file). Each distinct product is read and parsed once.
+        If there is only one, the column is a read-only view of it repeated for each row (so it is not copied),
+        otherwise it is a `SharedColumn` which refers to each distinct product from every row that shares it.
+        Returns None if the column is not like that (fewer than half the rows are repeats or there are nulls).
+        """
+        keys = []
+        for value in values:
+            if value is None or isinstance(value[0], list):
+                return None
+            keys.append(tuple(value))
+        try:
+            index = {}
+            codes = [index.setdefault(key, len(index)) for key in keys]
+        except TypeError:
+            return None
+        if len(index) > len(keys) // 2:
+            return None
+        products = [self.parse_value(v, False) for v in self.read_many([list(key) for key in index])]
+        if len(products) == 1:
+            data = np.broadcast_to(np.ma.getdata(products[0]), (len(keys), *np.shape(products[0])))
+            mask = np.ma.getmaskarray(products[0])
+            mask = np.broadcast_to(mask, data.shape) if mask.any() else np.ma.nomask
+            return np.ma.array(data, mask=mask, copy=False)
+        if all(np.ndim(p) == 0 for p in products):  # header values are not worth sharing
+            return np.ma.stack(products)[codes]
+        return SharedColumn.from_categories(products, np.array(codes))
 
-    def parse_to_table(self, cursor: Cursor, names: List[str], is_products: List[bool]):
-        rows = list(self.iterate_cursor(cursor, names, is_products, False))
+    def read_product_matrix(self, values: List) -> Optional[np.ma.MaskedArray]:
+        """
+        Read a column of products which are rows of the same length in fits tables straight into one 2D array.
+        If the rows are consecutive in one file, the array is a view of the (memory-mapped) file, otherwise the rows of
+        each file are copied into a preallocated array with one fancy-indexed read per file.
+        Only null rows and non-finite values are masked (there is no mask if there are none).
+        Returns None if the column is not like that, in which case the products are read row by row.
+        """
+        pending = self.prefetch_product_matrix(values)
+        return None if pending is None else pending()
+
+    def matrix_field(self, filename, ext, key) -> Optional[np.ndarray]:
+        """
+        Returns the 2D field `key` of a fits table or None if it isn't one
+        """
+        data = self.read_data(filename, ext)
+        if not isinstance(data, fits.FITS_rec) or data.field(key).ndim != 2:
+            return None
+        return data.field(key)
+
+    def matrix_rows(self, filename, ext, key, indices: List[int]) -> Optional[np.ndarray]:
+        """
+        Returns the rows of the 2D field `key` of a fits table (a view if they are consecutive) or None if it isn't one
+        """
+        field = self.matrix_field(filename, ext, key)
+        if field is None:
+            return None
+        indices = np.asarray(indices)
+        if indices[0] >= 0 and np.all(np.diff(indices) == 1):
+            return field[indices[0]:indices[-1] + 1]  # a view of the file
+        return field[indices]
+
+    def prefetch_product_matrix(self, values: List) -> Optional[Callable[[], Optional[np.ma.MaskedArray]]]:
+        """
+        Start reading a column as in `read_product_matrix`. Returns None straight away if the addresses or the
+        first file show that the column can't be read as a matrix, otherwise a function which waits for the matrix.
+        The other files are opened, checked and read by the thread pool (if there is one).
+        """
+        groups = defaultdict(list)
+        for i, value in enumerate(values):
+            if value is None:
+                continue
+            if isinstance(value[0], list):
+                return None
+            filename, ext, index, key, *header_only = value
+            if (header_only and header_only[0]) or not isinstance(index, (int, float)) or not isinstance(key, str):
+                return None
+            groups[(filename, ext, key)].append((i, int(index)))
+        if not groups or self.matrix_field(*next(iter(groups))) is None:
+            return None
+        if self.executor is None:
+            blocks = [(members, self.matrix_rows(*group, [index for _, index in members])) for group, members in groups.items()]
+        else:
+            blocks = [(members, self.executor.submit(self.matrix_rows, *group, [index for _, index in members]))
+                      for group, members in groups.items()]
+        nulls = [i for i, value in enumerate(values) if value is None]
+
+        def collect():
+            fields = [(members, block if self.executor is None else block.result()) for members, block in blocks]
+            if any(block is None for _, block in fields) or len({block.shape[1:] for _, block in fields}) != 1:
+                return None
+            if len(fields) == 1 and not nulls:
+                matrix = fields[0][1]
+            else:
+                shape = fields[0][1].shape[1:]
+                matrix = np.zeros((len(values), *shape), dtype=np.result_type(*[block.dtype for _, block in fields]))
+                for members, block in fields:
+                    matrix[[i for i, _ in members]] = block
+            try:
+                mask = ~np.isfinite(matrix)
+            except TypeError:
+                mask = np.zeros(matrix.shape, dtype=bool)
+            mask[nulls] = True
+            return np.ma.array(matrix, mask=mask if mask.any() else np.ma.nomask, copy=False)
+        return collect
+
+    def parse_value(self, value, is_product: bool) -> np.ma.MaskedArray:
+        """
+        Read the product (if it is one) and mask nulls and non-finite values
+        """
+        if is_product:
+            value = self.read_products([value])[0]
+        value = recursive_replace_None(value)
+        mask = value is None or np.size(value) == 0
+        try:
+            mask = mask | ~np.isfinite(value)
+        except TypeError:
+            pass
+        return np.ma.where(~mask, np.ma.asarray(value), np.ma.masked)
+
+    def iterate_cursor(self, cursor: Cursor, names: List[Union[str, None]], is_products: List[bool], as_row: bool,
+                       chunksize: int = 1000, prefetch: int = 2):
+        """
+        Parse rows as they arrive, reading the products of `chunksize` rows at a time.
+        With a thread pool, the products of up to `prefetch` chunks ahead are read while rows are being yielded.
+        """
+        cursor = iter(cursor)
+        window = deque()
+        while True:
+            rows = list(islice(cursor, chunksize))
+            if rows:
+                window.append((rows, self.prefetch_rows(rows, is_products)))
+            if not window:
+                break
+            if rows and self.executor is not None and len(window) <= prefetch:
+                continue
+            rows, pending = window.popleft()
+            for row, values in zip(rows, pending()):
+                yield self.parse_row(row.keys(), values, names, as_row)
+
+    def stream_to_table(self, cursor: Cursor, names: List[str], is_products: List[bool], ragged=None,
+                        chunksize: int = 1000, memory_budget: int = 2 * 1024**3, directory: Union[Path, str] = None):
+        """
+        Build the table `chunksize` rows at a time with `parse_to_table`, so that all the records are never held at once.
+        Once the chunks take up more than `memory_budget` bytes, they are written to temporary files (in `directory`)
+        and the table returned is a view of memory-mapped files which are only read from disk when they are used.
+        Each file belongs to the array mapped from it, so it is deleted once neither the table nor any slice of it is left.
+        The result has the same values as `parse_to_table`.
+        `cursor` is consumed lazily, so if it pulls its records from the server as they are needed (e.g. `Data.stream`),
+        no more than `chunksize` raw records are held at once.
+        """
+        cursor = iter(cursor)
+        chunks, nbytes, spill = [], 0, False
+        while True:
+            rows = list(islice(cursor, chunksize))
+            if not rows:
+                break
+            chunks.append(self.parse_to_table(rows, names, is_products, ragged))
+            nbytes += sum(column_nbytes(c) for c in chunks[-1].columns.values())
+            spill = spill or nbytes > memory_budget
+            if spill:
+                for i, chunk in enumerate(chunks):
+                    arrays = table_to_arrays(chunk) if not chunk.meta.get('_spilled') else None
+                    if arrays is not None:
+                        chunks[i] = table_from_arrays(spill_arrays(arrays, directory))
+                        chunks[i].meta['_spilled'] = True
+        if not chunks:
+            return self.parse_to_table([], names, is_products, ragged)
+        if len(chunks) == 1 and not spill:
+            return chunks[0]
+        allocate = ArrayAllocator(spill, directory)
+        return Table([concatenate_columns([chunk.columns[i] for chunk in chunks], name, ragged, allocate)
+                      for i, name in enumerate(chunks[0].colnames)], copy=False)
+
+    def parse_to_table(self, cursor: Cursor, names: List[str], is_products: List[bool], ragged=None):
+        """
+        Build the table column by column rather than row by row.
+        Columns of plain scalars are converted in one go, the products of a column are read together by `read_products`
+        (all product columns are started before any is parsed) and everything else is parsed value by value.
+        The result is the same as `vstack_rows` of each row parsed by `parse_product_row`.
+        :param ragged: If 'offsets' then columns of arrays of different lengths are returned as `RaggedColumn`s
+        """
+        check_ragged(ragged)
+        rows = list(cursor)
         if not rows:
             return Table([MaskedColumn([], name=name) for name in names])
-        return vstack_rows(rows)
+        names = [key if name is None or name == 'None' else name for key, name in zip(rows[0].keys(), names)]
+        columns = []
+        raw_columns = list(zip(*(row.values() for row in rows)))
+        matrices = [self.prefetch_product_column(v) if is_product else None for v, is_product in zip(raw_columns, is_products)]
+        pending = [self.prefetch_products(v) if is_product and matrix is None else partial(list, v)
+                   for v, matrix, is_product in zip(raw_columns, matrices, is_products)]
+        for raw, values, matrix, name, is_product in zip(raw_columns, pending, matrices, unique_column_names(names), is_products):
+            if matrix is not None:
+                matrix = matrix()
+                if matrix is None:  # a later file did not match the first after all
+                    values = self.prefetch_products(raw)
+            if isinstance(matrix, MaskedColumn):
+                column = matrix
+                column.name = name
+            elif matrix is not None:
+                column = MaskedColumn(matrix, name=name, copy=False)
+            else:
+                column = None if is_product else scalar_column(values(), name)
+            if column is None:
+                values = values()
+                column = ragged_column([self.parse_value(v, False) for v in values], name, ragged)
+            columns.append(column)
+        return Table(columns, copy=False)
 
 
 def apply(obj, func, *args, **kwargs):
@@ -237,25 +1074,57 @@ def identifier(origin, filepath, fileobj, *args, **kwargs):
     return registry._identifiers[('fits', AstropyTable)](origin, filepath, fileobj, *args, **kwargs)
 
 
+def meta_list(meta, key) -> list:
+    """A list written to a fits header is read back as a single value if it only had one item"""
+    value = meta.get(key, [])
+    return value if isinstance(value, list) else [value]
+
+
 def reader(input, hdu=None, astropy_native=False, memmap=False, character_as_bytes=True):
     original = registry.get_reader('fits', AstropyTable)
     table = original(input, hdu=hdu, astropy_native=astropy_native, memmap=memmap, character_as_bytes=character_as_bytes)
-    for colname, fill_value, nan_mask in zip(table.meta['_MASKED'], table.meta['_FILL'], table.meta['_NAN']):
+    masked = [meta_list(table.meta, key) for key in ['_MASKED', '_FILL', '_NAN']]
+    for colname, fill_value, nan_mask in zip(*masked):
         if nan_mask:
             fill_value = np.nan
             mask = np.isnan(table[colname])
         else:
             mask = table[colname] == fill_value
         table[colname] = MaskedColumn(table[colname], fill_value=fill_value, mask=mask)
+    for colname in meta_list(table.meta, '_RAGGED'):
+        # ragged columns are written as variable length arrays, where null rows have no values
+        arrays = [np.ma.masked_invalid(a) if np.issubdtype(a.dtype, np.floating) else np.ma.asarray(a) for a in table[colname]]
+        arrays = [np.ma.masked if not len(a) else a for a in arrays]
+        table[colname] = RaggedColumn.from_arrays(arrays, name=colname)
+    if '_ORDER' in table.meta:
+        table = table[meta_list(table.meta, '_ORDER')]
     return table
 
+
+def ragged_to_fits_column(column: RaggedColumn) -> fits.Column:
+    """
+    Returns a variable length array column, where masked floats are NaN and null rows have no values
+    """
+    values = column.flat_values
+    fill = np.nan if np.issubdtype(values.dtype, np.floating) else column.fill_value
+    values = values.filled(fill) if np.issubdtype(values.dtype, np.floating) else values.filled()
+    offsets = column.offsets
+    arrays = [values[start:stop] for start, stop in zip(offsets[:-1], offsets[1:])]
+    fmt = fits.column.NUMPY2FITS[values.dtype.str[1:]]
+    return fits.Column(name=column.name, format=f'P{fmt}()', array=arrays)
+
+
 def writer(input, output, overwrite=False):
     original = registry.get_writer('fits', AstropyTable)
+    if any(isinstance(input[c], SharedColumn) for c in input.colnames):
+        input = Table([input[c].dense() if isinstance(input[c], SharedColumn) else input[c] for c in input.colnames],
+                      meta=input.meta, copy=False)
     input.meta['_masked'] = []
     input.meta['_fill'] = []
     input.meta['_nan'] = []
+    ragged = [c for c in input.colnames if isinstance(input[c], RaggedColumn)]
     for colname in input.colnames:
-        if isinstance(input[colname], MaskedColumn):
+        if isinstance(input[colname], MaskedColumn) and colname not in ragged:
             input.meta['_masked'].append(colname)
             try:
                 if np.isnan(input[colname].fill_value):
@@ -266,7 +1135,15 @@ def writer(input, output, overwrite=False):
                 pass
             input.meta['_fill'].append(input[colname].fill_value)
             input.meta['_nan'].append(False)
-    return original(input, output, overwrite)
+    if not ragged:
+        return original(input, output, overwrite)
+    # astropy cannot write object columns, so ragged columns are added to the HDU as variable length arrays
+    input.meta['_ragged'] = ragged
+    input.meta['_order'] = input.colnames
+    hdu = fits.table_to_hdu(input[[c for c in input.colnames if c not in ragged]])
+    columns = hdu.columns + fits.ColDefs([ragged_to_fits_column(input[c]) for c in ragged])
+    hdu = fits.BinTableHDU.from_columns(columns, header=hdu.header)
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(output, overwrite=overwrite)
 
 
 registry.register_identifier('fits', Table, identifier, force=True)
@@ -1,6 +1,7 @@
 from typing import Union
 
-from . import BaseQuery, AttributeQuery
+from .base import BaseQuery
+from .objects import AttributeQuery
 from .objects import ObjectQuery
 
 
@@ -1,5 +1,7 @@
 from typing import Optional, TYPE_CHECKING
 
+import xxhash
+
 if TYPE_CHECKING:
     from weaveio.readquery.parser import QueryGraph
 
@@ -26,6 +28,14 @@ class Statement:
         obs = map(lambda x: tuple(x) if isinstance(x, list) else x, obs)
         return hash(tuple(map(hash, obs)))
 
+    @property
+    def fingerprint(self) -> str:
+        """
+        A digest of everything this statement renders. Unlike `hash`, this is the same in every python process
+        """
+        ids = sorted(set(self.ids + self.default_ids + ['output_variables']))
+        return xxhash.xxh64(repr([(i, getattr(self, i)) for i in ids])).hexdigest()
+
     @property
     def edge(self):
         return self._edge
@@ -245,12 +255,11 @@ class Return(Statement):
         self.index_variable = index_variable
         self.column_variables = column_variables
         self.dropna = dropna
+        cols = self.column_variables if self.index_variable is None else self.column_variables[:-1]
+        self.columns = [self.make_variable('r') for _ in cols]  # the names of the returned columns, in order
 
     def make_cypher(self, ordering: list) -> Optional[str]:
-        names = [self.graph.get_variable_name('r') for _ in self.column_variables]  # to prevent overflow
-        names.append(self.graph.get_variable_name('i'))
-        cols = self.column_variables if self.index_variable is None else self.column_variables[:-1]
-        cols = ', '.join([f"{c} as {n}" for c, n in zip(cols, names)])
+        cols = ', '.join([f"{c} as {n}" for c, n in zip(self.column_variables, self.columns)])
         if self.dropna is not None:
             return f"WITH * WHERE {self.dropna} is not null RETURN {cols}"
         return f"RETURN {cols}"
@@ -0,0 +1,41 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip('neo4j')
+
+
+def test_acall_matches_call(data):
+    runs = data.runs
+    query = runs[runs.camera == 'red'][['id', 'camera']]
+    expected = query(limit=10)
+    table = asyncio.run(query.acall(limit=10))
+    assert table.colnames == expected.colnames
+    assert np.all(table == expected)
+
+
+def test_aiter_matches_iteration(data):
+    query = data.runs.id
+
+    async def collect():
+        return [row async for row in query.aiter(limit=10, chunksize=3)]
+
+    assert asyncio.run(collect()) == list(query._iterate(limit=10))
+
+
+def test_memory_budget_streams_through_the_driver(data, monkeypatch):
+    query = data.runs[['id', 'camera']]
+    expected = query(limit=None)
+    streamed = []
+    stream = data.stream
+
+    def recording_stream(cypher, params, fetch_size=None):
+        streamed.append(cypher)
+        return stream(cypher, params, fetch_size)
+
+    monkeypatch.setattr(data, 'stream', recording_stream)
+    table = query(limit=None, memory_budget=0)
+    assert len(streamed) == 1
+    assert table.colnames == expected.colnames
+    assert np.all(table == expected)
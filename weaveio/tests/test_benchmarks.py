@@ -0,0 +1,52 @@
+"""
+Benchmarks, some of which use the test database. These are not run by default, use `pytest -m benchmark`
+"""
+import time
+
+import pytest
+
+from weaveio.readquery.results import RowParser
+from weaveio.tests.test_results import make_records, legacy_table
+from weaveio.utilities import lift_literals
+
+
+def filter_queries(data, values):
+    for value in values:
+        runs = data.runs
+        query, lines = runs[runs.id == value]['id']._compile(0, None, False)
+        params = {k.replace('$', ''): v for k, v in query._G.dependency_parameters(query._node).items()}
+        yield query, '\n'.join(lines), params
+
+
+def time_planning(data, queries):
+    start = time.perf_counter()
+    for cypher, params in queries:
+        data.graph.execute(f'EXPLAIN {cypher}', **params).stats()
+    return time.perf_counter() - start
+
+
+@pytest.mark.benchmark
+def test_lifted_literals_share_a_query_plan(data):
+    values = list(range(100))
+    raw, lifted = [], []
+    for query, cypher, params in filter_queries(data, values):
+        raw.append((cypher, params))
+        lifted.append(lift_literals(cypher, params, query._G.variable_names))
+    assert len({cypher for cypher, _ in lifted}) == 1
+    raw_time, lifted_time = time_planning(data, raw), time_planning(data, lifted)
+    print(f'planning {len(values)} filters: {raw_time:.3f}s as rendered, {lifted_time:.3f}s with lifted literals')
+
+
+@pytest.mark.benchmark
+def test_columnar_table_building(tmp_path):
+    parser = RowParser(tmp_path)
+    records = make_records(200_000)
+    names = [f'c{i}' for i in range(len(records[0]))]
+    is_products = [False] * len(names)
+    start = time.perf_counter()
+    legacy_table(parser, records, names, is_products)
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    parser.parse_to_table(records, names, is_products)
+    columnar_time = time.perf_counter() - start
+    print(f'building a table of {len(records)} rows: {legacy_time:.3f}s row by row, {columnar_time:.3f}s by column')
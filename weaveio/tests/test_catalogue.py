@@ -0,0 +1,82 @@
+import os
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+
+from weaveio.catalogue import FileCatalogue
+
+
+class CountingFile:
+    parts = [None]
+    opened = 0
+
+    @classmethod
+    def match_file(cls, directory, fname, graph):
+        return Path(fname).name.startswith('single')
+
+    @classmethod
+    def length(cls, path, part=None):
+        cls.opened += 1
+        return fits.getheader(path, 1)['NAXIS2']
+
+
+def write_fits(path, nrows, obsmode='MOS'):
+    primary = fits.PrimaryHDU()
+    primary.header['OBSMODE'] = obsmode
+    primary.header['OBSTYPE'] = 'TARGET'
+    table = fits.BinTableHDU.from_columns([fits.Column(name='x', format='D', array=np.arange(nrows))])
+    fits.HDUList([primary, table]).writeto(path, overwrite=True)
+
+
+def test_rescan_only_describes_changed_files(tmp_path):
+    rootdir = tmp_path / 'data'
+    rootdir.mkdir()
+    write_fits(rootdir / 'single_1.fit', 5)
+    write_fits(rootdir / 'single_2.fit', 3, obsmode='LIFU')
+    write_fits(rootdir / 'other.fit', 2)
+    CountingFile.opened = 0
+    entries = FileCatalogue(rootdir, [CountingFile], tmp_path / 'catalogue.sqlite').scan()
+    assert entries[rootdir / 'single_1.fit'].lengths == {'None': 5}
+    assert entries[rootdir / 'single_1.fit'].mos and not entries[rootdir / 'single_2.fit'].mos
+    assert entries[rootdir / 'other.fit'].filetypes == []
+    assert CountingFile.opened == 1
+
+    catalogue = FileCatalogue(rootdir, [CountingFile], tmp_path / 'catalogue.sqlite')
+    assert catalogue.scan() == entries
+    assert catalogue.length(CountingFile, rootdir / 'single_1.fit') == 5
+    assert CountingFile.opened == 1
+
+    write_fits(rootdir / 'single_1.fit', 7)
+    os.utime(rootdir / 'single_1.fit', (0, 0))
+    (rootdir / 'other.fit').unlink()
+    entries = catalogue.scan()
+    assert entries[rootdir / 'single_1.fit'].lengths == {'None': 7}
+    assert rootdir / 'other.fit' not in entries
+    assert CountingFile.opened == 2
+
+
+class DependentFile(CountingFile):
+    match_uses_database = True
+
+    @classmethod
+    def match_file(cls, directory, fname, graph):
+        return Path(fname).name.startswith('l2') and 'single_1.fit' in graph  # `graph` stands in for the database
+
+
+def test_database_dependent_matches_are_rematched(tmp_path):
+    rootdir = tmp_path / 'data'
+    rootdir.mkdir()
+    write_fits(rootdir / 'single_1.fit', 5)
+    write_fits(rootdir / 'l2_1.fit', 4)
+    catalogue = FileCatalogue(rootdir, [CountingFile, DependentFile], tmp_path / 'catalogue.sqlite')
+    assert catalogue.scan(graph=set())[rootdir / 'l2_1.fit'].filetypes == []
+    entry = catalogue.scan(graph={'single_1.fit'})[rootdir / 'l2_1.fit']
+    assert entry.filetypes == ['DependentFile'] and entry.mos
+    assert catalogue.length(DependentFile, rootdir / 'l2_1.fit') == 4
+
+
+def test_version_depends_on_filetype_patterns(tmp_path):
+    repatterned = type('CountingFile', (CountingFile,), {'match_pattern': 'single_\\d+\\.fit'})
+    assert FileCatalogue(tmp_path, [CountingFile]).version != FileCatalogue(tmp_path, [repatterned]).version
+    assert FileCatalogue(tmp_path, [CountingFile]).version == FileCatalogue(tmp_path, [CountingFile]).version
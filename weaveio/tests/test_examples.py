@@ -1,3 +1,6 @@
+from pathlib import Path
+
+import numpy as np
 from astropy.io import fits
 from astropy.table import Table
 import pytest
@@ -73,3 +76,39 @@ def test_adjunct(data):
     assert np.all(t['camera0'] == 'red')
     assert np.all(t['camera1'] == 'blue')
 
+
+
+def test_pages_cover_the_whole_result(data):
+    query = data.runs[['id', 'camera']]
+    pages = list(query.pages(7))
+    assert all(len(page) == 7 for page in pages[:-1]) and len(pages[-1]) <= 7
+    paged = sorted(tuple(row) for page in pages for row in page)
+    assert paged == sorted(tuple(row) for row in query(limit=None))
+
+
+def test_pages_keep_every_row_of_a_repeated_index(data):
+    query = data.runs.ob[['id']]  # each ob is the index of the rows of several runs
+    paged = sorted(tuple(row) for page in query.pages(2) for row in page)
+    assert paged == sorted(tuple(row) for row in query(limit=None))
+
+
+def test_pages_run_the_query_once(data, monkeypatch):
+    query = data.runs[['id', 'camera']]
+    queries = []
+    read_records = data.read_records
+
+    def recording_read_records(cypher, parameters):
+        queries.append(cypher)
+        return read_records(cypher, parameters)
+
+    monkeypatch.setattr(data, 'read_records', recording_read_records)
+    assert len(list(query.pages(7))) > 1
+    assert len(queries) == 1
+
+
+def test_connection_pool_is_shared(data):
+    assert data.graph.neograph is data.graph.neograph
+    with data.write as graph:
+        assert graph.write_allowed and graph.neograph is data.neograph
+    assert not data.graph.write_allowed
+    assert data.check_connection()
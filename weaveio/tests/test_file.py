@@ -0,0 +1,19 @@
+import numpy as np
+from astropy.io import fits
+
+from weaveio.file import fits_files, open_fits, read_fits_table
+
+
+def test_fits_files_opens_once_and_closes(tmp_path):
+    path = tmp_path / 'a.fits'
+    table = fits.BinTableHDU.from_columns([fits.Column(name='x', format='D', array=np.arange(3))])
+    fits.HDUList([fits.PrimaryHDU(), table]).writeto(path)
+    with fits_files() as files:
+        hdulist = open_fits(path)
+        with fits_files():
+            assert open_fits(str(path)) is hdulist
+            assert read_fits_table(path, 1) is read_fits_table(path, 1)
+        assert files.hdulists
+    assert not files.hdulists
+    assert hdulist._file.closed
+    assert open_fits(path) is not open_fits(path)
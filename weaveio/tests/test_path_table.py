@@ -0,0 +1,55 @@
+import gc
+import weakref
+
+import networkx as nx
+import pytest
+
+from weaveio.path_finding import HierarchyGraph, PathTable, hierarchy_hash
+from weaveio.opr3.hierarchy import OB
+from weaveio.opr3.l1 import L1SingleSpectrum
+from weaveio.opr3.l1files import RawFile
+
+
+@pytest.fixture(scope='module')
+def graph():
+    g = HierarchyGraph()
+    g.initialise()
+    return g
+
+
+def test_lookup_matches_find_paths(graph, tmp_path):
+    table = PathTable(graph, tmp_path)
+    paths, singulars, reversed = table.lookup(L1SingleSpectrum, OB, True)
+    assert (paths, singulars, reversed) == table.compute(L1SingleSpectrum, OB, True)
+    assert all(singulars)
+
+
+def test_table_is_persisted(graph, tmp_path):
+    table = PathTable(graph, tmp_path)
+    expected = table.lookup(OB, L1SingleSpectrum, False)
+    table.save()
+    reloaded = PathTable(graph, tmp_path)
+    assert (OB, L1SingleSpectrum, False) in reloaded.table
+    assert reloaded.lookup(OB, L1SingleSpectrum, False) == expected
+
+
+def test_missing_paths_are_remembered(graph, tmp_path, monkeypatch):
+    table = PathTable(graph, tmp_path)
+    with pytest.raises(nx.NetworkXNoPath):
+        table.lookup(RawFile, L1SingleSpectrum, True)  # a raw file has many spectra
+    table.save()
+    reloaded = PathTable(graph, tmp_path)
+    monkeypatch.setattr(graph, 'find_paths', lambda *args: pytest.fail('the graph was searched'))
+    with pytest.raises(nx.NetworkXNoPath):
+        reloaded.lookup(RawFile, L1SingleSpectrum, True)
+
+
+def test_tables_are_not_kept_alive(graph, tmp_path):
+    table = weakref.ref(PathTable(graph, tmp_path))
+    gc.collect()
+    assert table() is None
+
+
+def test_version_depends_on_hierarchies(graph):
+    assert hierarchy_hash(graph.nodes) == hierarchy_hash(list(graph.nodes)[::-1])
+    assert hierarchy_hash(graph.nodes) != hierarchy_hash(list(graph.nodes)[1:])
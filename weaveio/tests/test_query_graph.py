@@ -0,0 +1,83 @@
+from collections import Counter
+from types import SimpleNamespace
+
+import networkx as nx
+import pytest
+
+from weaveio import *
+from weaveio.readquery.cache import CompiledCypherCache
+from weaveio.readquery.digraph import node_hashes
+from weaveio.readquery.parser import plan, traverse, verify_traversal
+from weaveio.readquery.statements import Return
+
+
+@pytest.fixture()
+def queries(data):
+    runs = data.runs
+    nsky = sum(runs.targuses == 'S', wrt=runs)
+    runs = runs[(runs.camera == 'red') & (nsky > 10)]
+    spectra = runs.l1single_spectra
+    return [nsky, runs[['id', nsky]], spectra[spectra.snr > 1][['flux', 'snr']], count(spectra, wrt=runs)]
+
+
+def test_restricted_matches_reachability(queries):
+    G = queries[0]._G
+    dag = nx.subgraph_view(G.G, filter_edge=lambda a, b: G.G.edges[(a, b)]['type'] != 'wrt')
+    for node in G.G.nodes:
+        expected = {n for n in G.G.nodes if nx.has_path(dag, n, node)}
+        assert set(G.restricted(node).nodes) == expected
+        assert G.G.ancestors_of(node) == expected
+
+
+def test_planner_is_equivalent_to_backtracking(queries):
+    for query in queries:
+        compiled = query._precompile()
+        graph = compiled._G.restricted(compiled._node)
+        planned = plan(graph)
+        verify_traversal(graph, planned, reference=traverse(graph)[0])
+
+
+def test_compiled_cypher_is_persisted(data, tmp_path):
+    query = data.runs[['id', 'camera']]._precompile()
+    G, node = query._G, query._node
+    original, G.compiled_cache = G.compiled_cache, CompiledCypherCache(tmp_path / 'compiled.sqlite', 'test')
+    try:
+        G.G.nodes[node].pop('cypher', None)
+        G.G.nodes[node].pop('ordering', None)
+        lines = G.cypher_lines(node)
+        assert G._load_compiled(node) == (G.G.nodes[node]['ordering'], lines)
+    finally:
+        G.compiled_cache = original
+
+
+def test_incremental_hashes_match_full_rehash(queries):
+    G = queries[0]._G
+    assert G.G.node_hash == node_hashes(G.G)
+    for node in G.G.nodes:
+        restricted = G.restricted(node)
+        assert restricted.name == G.G.node_hash[node] == node_hashes(restricted)[node]
+
+
+def test_planner_is_linear_in_a_chain_of_diamonds():
+    graph = nx.DiGraph()
+    ndiamonds = 60  # 2**60 distinct paths from top to bottom
+    for i in range(ndiamonds):
+        for side in 'ab':
+            graph.add_edge(f'join{i}', f'{side}{i}', type='traversal')
+            graph.add_edge(f'{side}{i}', f'join{i + 1}', type='traversal')
+    ordering = plan(graph, start='join0', end=f'join{ndiamonds}')
+    assert ordering[0] == 'join0' and ordering[-1] == f'join{ndiamonds}'
+
+
+def test_return_names_its_columns_before_it_is_compiled():
+    counts = Counter({'r': 3})
+
+    def get_variable_name(name):
+        counts[name] += 1
+        return f'{name}{counts[name] - 1}'
+
+    graph = SimpleNamespace(get_variable_name=get_variable_name)
+    statement = Return(['run0.id', 'nsky2'], 'run0', None, graph)
+    assert statement.columns == ['r3', 'r4']
+    assert statement.make_cypher([]) == 'RETURN run0.id as r3, nsky2 as r4'
+    assert statement.make_cypher([]) == 'RETURN run0.id as r3, nsky2 as r4'  # the same names every time
@@ -0,0 +1,365 @@
+import gc
+import mmap
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+from weaveio.data import Data
+from weaveio.readquery.cache import ResultCache
+from weaveio.readquery.results import RowParser, vstack_rows, ragged_column, RaggedColumn, SharedColumn, Table, \
+    MaskedColumn
+
+
+class Record(tuple):
+    """Looks like a py2neo record"""
+    def __new__(cls, keys, values):
+        record = super().__new__(cls, values)
+        record._keys = keys
+        return record
+
+    def keys(self):
+        return list(self._keys)
+
+    def values(self):
+        return list(self)
+
+
+def make_records(nrows, seed=0):
+    rng = np.random.default_rng(seed)
+    keys = ['r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7']
+    records = []
+    for i in range(nrows):
+        null = rng.random() < 0.1
+        records.append(Record(keys, [
+            int(rng.integers(-10**12, 10**12)),  # ints
+            None if null else int(i),  # ints with nulls
+            float(rng.normal()) if not null else float('nan'),  # floats with nans
+            bool(i % 2),  # bools
+            f'run{i}',  # strings
+            None if null else 'red',  # strings with nulls
+            [1.0, 2.0][:i % 3],  # lists of different lengths
+            float('inf') if i % 7 == 0 else i,  # a mixture of ints and floats
+        ]))
+    return records
+
+
+def legacy_table(parser, records, names, is_products):
+    return vstack_rows(list(parser.iterate_cursor(records, names, is_products, False)))
+
+
+@pytest.mark.parametrize('nrows', [1, 2, 100])
+def test_columnar_table_is_identical_to_row_by_row(tmp_path, nrows):
+    parser = RowParser(tmp_path)
+    records = make_records(nrows)
+    names = ['a', 'b', None, 'a', 'e', 'f', 'g', 'h']
+    is_products = [False] * len(names)
+    expected = legacy_table(parser, records, names, is_products)
+    table = parser.parse_to_table(records, names, is_products)
+    assert table.colnames == expected.colnames
+    for name in table.colnames:
+        assert table[name].dtype == expected[name].dtype
+        assert np.array_equal(table[name].mask, expected[name].mask)
+        assert table[name].data.data.tobytes() == expected[name].data.data.tobytes()
+
+
+@pytest.fixture()
+def arrays():
+    return [np.arange(3.), np.ma.masked, np.ma.masked_invalid([1., np.nan, 3., 4., 5.]), np.arange(1.)]
+
+
+def test_ragged_column_is_not_padded(arrays):
+    column = ragged_column(arrays, 'flux', ragged='offsets')
+    assert isinstance(column, RaggedColumn)
+    assert column.offsets.tolist() == [0, 3, 3, 8, 9]
+    assert column.null.tolist() == [False, True, False, False]
+    assert np.ma.getmaskarray(column.flat_values).sum() == 1
+
+
+def test_ragged_column_dense_is_default_padding(arrays):
+    column = ragged_column(arrays, 'flux', ragged='offsets')
+    padded = ragged_column([np.ma.masked_all(1) if a is np.ma.masked else a for a in arrays], 'flux')
+    dense = column.dense()
+    assert np.array_equal(dense.mask[[0, 2, 3]], padded.mask[[0, 2, 3]])
+    assert np.array_equal(dense.filled(0)[[0, 2, 3]], padded.filled(0)[[0, 2, 3]])
+    assert dense.mask[1].all()
+
+
+def test_ragged_column_apply_and_fits_roundtrip(arrays, tmp_path):
+    column = ragged_column(arrays, 'flux', ragged='offsets')
+    doubled = column.apply(lambda x: x * 2)
+    assert isinstance(doubled, RaggedColumn)
+    assert doubled.lengths.tolist() == column.lengths.tolist()
+    table = Table([np.arange(4), column], names=['i', 'flux'])
+    table.write(tmp_path / 'ragged.fits')
+    read = Table.read(tmp_path / 'ragged.fits')
+    assert read.colnames == ['i', 'flux']
+    assert isinstance(read['flux'], RaggedColumn)
+    assert read['flux'].offsets.tolist() == column.offsets.tolist()
+    assert np.array_equal(read['flux'].flat_values.mask, column.flat_values.mask)
+
+
+def test_read_many_matches_read(tmp_path):
+    flux = np.arange(40.).reshape(8, 5)
+    table = fits.BinTableHDU.from_columns([fits.Column('FLUX', 'E', array=np.arange(8.)),
+                                           fits.Column('SPEC', '5E', array=flux)], name='TAB')
+    fits.HDUList([fits.PrimaryHDU(flux), table]).writeto(tmp_path / 'products.fits')
+    parser = RowParser(tmp_path)
+    addresses = [['products.fits', 0, 5, None, False], ['products.fits', 'TAB', 2.0, 'SPEC', False],
+                 ['products.fits', 1, 7, 'FLUX', False], ['products.fits', 'TAB', 2, 'SPEC', False],
+                 ['products.fits', 0, 1, None, False], ['products.fits', 1, None, 'FLUX', False],
+                 ['products.fits', 1, 0, 'SPEC', False], ['products.fits', 1, 0, 'NAXIS2', True]]
+    for batched, address in zip(parser.read_many(addresses), addresses):
+        assert np.array_equal(batched, parser.read(*address))
+    records = [Record(['p'], [addresses[i]]) for i in [0, 1, 3, 4, 6]] + [Record(['p'], [None])]
+    table = parser.parse_to_table(records, ['p'], [True])
+    expected = legacy_table(parser, records, ['p'], [True])
+    assert np.array_equal(table['p'].filled(0), expected['p'].filled(0))
+
+
+def test_file_cache_is_lru_and_byte_budgeted(tmp_path):
+    for name in 'abc':
+        fits.PrimaryHDU(np.zeros((10, 10))).writeto(tmp_path / f'{name}.fits')
+    size = (tmp_path / 'a.fits').stat().st_size
+    parser = RowParser(tmp_path, max_mapped_bytes=2 * size)
+    a = parser.open_file('a.fits')
+    parser.open_file('b.fits')
+    parser.open_file('a.fits')
+    parser.open_file('c.fits')  # evicts b since a was used more recently
+    assert list(parser.files) == [tmp_path / 'a.fits', tmp_path / 'c.fits']
+    assert parser.mapped_bytes == 2 * size
+    parser.read_header('a.fits')
+    parser.read_header('a.fits', 0)
+    info = parser.cache_info()
+    assert (info.misses, info.evictions, info.files) == (3, 1, 2)
+    parser.close_all()
+    assert a._file.closed
+    assert parser.read('a.fits', header_only=True, key='NAXIS') == 2  # headers outlive their files
+
+
+def test_threaded_product_reads_preserve_order(tmp_path):
+    for i in range(5):
+        fits.PrimaryHDU(np.arange(12.).reshape(4, 3) + 100 * i).writeto(tmp_path / f'{i}.fits')
+    addresses = [[f'{i % 5}.fits', 0, i % 4, None, False] for i in range(50)]
+    records = [Record(['p'], [a]) for a in addresses]
+    serial = RowParser(tmp_path)
+    threaded = RowParser(tmp_path, product_workers=3)
+    assert all(np.array_equal(a, b) for a, b in zip(threaded.read_many(addresses), serial.read_many(addresses)))
+    rows = list(threaded.iterate_cursor(records, ['p'], [True], False, chunksize=7, prefetch=2))
+    expected = list(serial.iterate_cursor(records, ['p'], [True], False))
+    assert len(rows) == len(expected) == 50
+    for (row, _), (other, _) in zip(rows, expected):
+        assert np.array_equal(row[0], other[0])
+
+
+def test_single_file_chunks_are_prefetched_in_the_pool(tmp_path):
+    fits.PrimaryHDU(np.arange(12.).reshape(4, 3)).writeto(tmp_path / 'a.fits')
+    parser = RowParser(tmp_path, product_workers=1)
+    threads = []
+    read_many = parser._read_many
+    parser._read_many = lambda addresses: threads.append(threading.current_thread().name) or read_many(addresses)
+    pending = parser.prefetch_many([['a.fits', 0, i, None, False] for i in range(4)])
+    assert np.array_equal(pending()[2], [6., 7., 8.])
+    assert threads == ['weaveio-products_0']
+
+
+def test_files_are_opened_once_and_outside_the_lock(tmp_path, monkeypatch):
+    for name in 'ab':
+        fits.PrimaryHDU(np.arange(3.)).writeto(tmp_path / f'{name}.fits')
+    parser = RowParser(tmp_path, product_workers=3)
+    parser.read_data('a.fits', 0)
+    opening, release, opened = threading.Event(), threading.Event(), []
+    original = fits.open
+    def slow_open(name, *args, **kwargs):
+        opened.append(os.path.basename(name))
+        opening.set()
+        release.wait(5)
+        return original(name, *args, **kwargs)
+    monkeypatch.setattr(fits, 'open', slow_open)
+    futures = [parser.executor.submit(parser.read_data, 'b.fits', 0) for _ in range(3)]
+    assert opening.wait(5)
+    read = []
+    reader = threading.Thread(target=lambda: read.append(parser.read_data('a.fits', 0)))
+    reader.start()
+    reader.join(2)
+    release.set()
+    assert read and np.array_equal(read[0], np.arange(3.))  # not held up by b.fits being opened
+    assert all(np.array_equal(future.result(), np.arange(3.)) for future in futures)
+    assert opened == ['b.fits']
+
+
+def test_result_cache_is_invalidated_by_writes(arrays, tmp_path):
+    table = Table([np.arange(4), ragged_column(arrays, 'flux', ragged='offsets'),
+                   MaskedColumn(np.ma.masked_invalid([1., np.nan, 2., 3.]), name='snr')], names=['i', 'flux', 'snr'])
+    cache = ResultCache(tmp_path, maxbytes=10**6)
+    key = cache.key('MATCH (n) RETURN n.id', {'p0': 1})
+    assert key != cache.key('MATCH (n) RETURN n.id', {'p0': 2})
+    cache.set(key, 100, table)
+    read = cache.get(key, 100)
+    assert read.colnames == table.colnames and isinstance(read['flux'], RaggedColumn)
+    assert read['flux'].offsets.tolist() == table['flux'].offsets.tolist()
+    assert np.array_equal(read['snr'].mask, table['snr'].mask)
+    assert cache.get(key, 101) is None  # something has been written since
+    assert cache.get(key, 100) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_result_cache_is_invalidated_by_deletes_and_write_files(tmp_path):
+    table = Table([np.arange(4)], names=['i'])
+    cache = ResultCache(tmp_path)
+    cache.set('a', [1000, 50, 70], table)
+    assert cache.get('a', [1000, 49, 70]) is None  # a node was deleted, the latest write time is the same
+    cache.set('a', [1000, 50, 70], table)
+    cache.set('b', [1000, 50, 70], table)
+    data = SimpleNamespace(result_cache=cache, graph=SimpleNamespace(execute=lambda cypher: None))
+    Data.remove_query_hashes(data)  # done before and after each write in `write_files`
+    assert not list(tmp_path.glob('*.npz'))
+
+
+def test_result_cache_evicts_least_recently_used(tmp_path):
+    table = Table([np.arange(1000.)], names=['x'])
+    cache = ResultCache(tmp_path, maxbytes=10**10)
+    for t, key in enumerate('abc'):
+        cache.set(key, 0, table)
+        os.utime(tmp_path / f'{key}.npz', (t, t))
+    cache.get('a', 0)  # a is now the most recently used
+    cache.maxbytes = 2 * (tmp_path / 'a.npz').stat().st_size
+    cache.evict()
+    assert sorted(f.stem for f in tmp_path.glob('*.npz')) == ['a', 'c']
+
+
+def is_memory_mapped(column):
+    array = np.ma.getdata(column)
+    while isinstance(array, np.ndarray):
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+@pytest.mark.parametrize('ragged', [None, 'offsets'])
+@pytest.mark.parametrize('memory_budget', [0, 10**9])
+def test_streamed_table_matches_parse_to_table(tmp_path, ragged, memory_budget):
+    parser = RowParser(tmp_path)
+    records = make_records(100)
+    names = ['a', 'b', None, 'a', 'e', 'f', 'g', 'h']
+    is_products = [False] * len(names)
+    expected = parser.parse_to_table(records, names, is_products, ragged)
+    table = parser.stream_to_table(records, names, is_products, ragged, chunksize=7, memory_budget=memory_budget,
+                                   directory=tmp_path)
+    dense = [name for name in table.colnames if not isinstance(table[name], RaggedColumn)]
+    assert any(is_memory_mapped(table[name]) for name in dense) == (memory_budget == 0)
+    assert table.colnames == expected.colnames
+    for name in table.colnames:
+        assert type(table[name]) is type(expected[name])
+        assert np.array_equal(table[name].dense().mask, expected[name].dense().mask)
+        assert np.array_equal(table[name].dense().filled(0), expected[name].dense().filled(0))
+
+
+def test_streamed_table_consumes_records_a_chunk_at_a_time(tmp_path):
+    parser = RowParser(tmp_path)
+    records = make_records(100)
+    names = ['a', 'b', None, 'a', 'e', 'f', 'g', 'h']
+    pulled = []
+
+    def cursor():
+        for i, record in enumerate(records):
+            pulled.append(i)
+            yield record
+
+    parse_to_table = parser.parse_to_table
+    pulled_at_parse = []
+
+    def parse_chunk(rows, *args):
+        pulled_at_parse.append(len(pulled))
+        return parse_to_table(rows, *args)
+
+    parser.parse_to_table = parse_chunk
+    parser.stream_to_table(cursor(), names, [False] * len(names), chunksize=7, memory_budget=0, directory=tmp_path)
+    assert pulled_at_parse[:3] == [7, 14, 21]  # no record is pulled before the chunk it belongs to is parsed
+
+
+@pytest.mark.parametrize('ragged', [None, 'offsets'])
+def test_spilled_table_outlives_the_original_in_copies_and_slices(tmp_path, ragged):
+    parser = RowParser(tmp_path)
+    records = make_records(100)
+    names = ['a', 'b', None, 'a', 'e', 'f', 'g', 'h']
+    is_products = [False] * len(names)
+    expected = parser.parse_to_table(records, names, is_products, ragged)
+    spill = tmp_path / 'spill'
+    spill.mkdir()
+    table = parser.stream_to_table(records, names, is_products, ragged, chunksize=7, memory_budget=0, directory=spill)
+    copied, sliced = table.copy(), table[10:50]
+    del table
+    gc.collect()
+    for name in expected.colnames:
+        assert np.array_equal(copied[name].dense().filled(0), expected[name].dense().filled(0))
+        assert np.array_equal(sliced[name].dense().filled(0), copied[10:50][name].dense().filled(0))
+    del copied, sliced
+    gc.collect()
+    assert list(spill.iterdir()) == []
+
+
+def test_equal_length_products_are_read_as_one_matrix(tmp_path):
+    for name, offset in [('a', 0), ('b', 100)]:
+        flux = np.arange(40, dtype=np.float32).reshape(8, 5) + offset
+        flux[3, 2] = np.nan
+        fits.BinTableHDU.from_columns([fits.Column('FLUX', '5E', array=flux)]).writeto(tmp_path / f'{name}.fits')
+    parser = RowParser(tmp_path)
+    consecutive = [['a.fits', 1, i, 'FLUX', False] for i in range(2, 6)]
+    matrix = parser.read_product_matrix(consecutive)
+    assert np.shares_memory(matrix.data, parser.read_data('a.fits', 1).field('FLUX'))
+    assert matrix.mask.tolist() == [[False] * 5, [False, False, True, False, False], [False] * 5, [False] * 5]
+    mixed = [['b.fits', 1, 7, 'FLUX', False], None, ['a.fits', 1, 3, 'FLUX', False], ['b.fits', 1, 0, 'FLUX', False]]
+    matrix = parser.read_product_matrix(mixed)
+    assert matrix.data.flags.c_contiguous and matrix.shape == (4, 5)
+    assert matrix.mask[1].all() and matrix.mask[2, 2] and matrix.mask.sum() == 6
+    for row, address in zip(matrix, mixed):
+        if address is not None:
+            assert np.array_equal(row.filled(-1), parser.parse_value(address, True).filled(-1))
+    assert parser.read_product_matrix([['a.fits', 1, 0, 'FLUX', True]]) is None
+
+
+def test_product_matrix_is_opt_in_and_read_by_workers(tmp_path):
+    for name, offset in [('a', 0), ('b', 100)]:
+        flux = np.arange(40, dtype=np.float32).reshape(8, 5) + offset
+        fits.BinTableHDU.from_columns([fits.Column('FLUX', '5E', array=flux)]).writeto(tmp_path / f'{name}.fits')
+    records = [Record(['flux'], [[f'{name}.fits', 1, i, 'FLUX', False]]) for name in 'ab' for i in range(8)]
+    assert RowParser(tmp_path).prefetch_product_column([r.values()[0] for r in records]) is None
+    parser = RowParser(tmp_path, product_workers=2, product_matrix=True)
+    threads = {}
+    matrix_rows = parser.matrix_rows
+    parser.matrix_rows = lambda filename, *args: threads.setdefault(filename, threading.current_thread().name) \
+                                                 and matrix_rows(filename, *args)
+    column = parser.parse_to_table(records, ['flux'], [True])['flux']
+    assert column.data.flags.c_contiguous and column.shape == (16, 5)
+    assert threads['b.fits'].startswith('weaveio-products')
+    assert np.array_equal(column.data, legacy_table(parser, records, ['flux'], [True])['flux'].data)
+
+
+def test_shared_products_are_read_once(tmp_path):
+    wvl = np.linspace(4000, 5000, 7)
+    fits.HDUList([fits.PrimaryHDU(), fits.ImageHDU(wvl, name='WVL'), fits.ImageHDU(wvl * 2, name='WVL2')]).writeto(tmp_path / 'a.fits')
+    parser = RowParser(tmp_path)
+    addresses = [['a.fits', 'WVL', None, None, False]] * 6
+    first, *others = parser.read_many(addresses)
+    assert all(np.shares_memory(first, other) for other in others) and not first.flags.writeable
+    records = [Record(['wvl'], [a]) for a in addresses]
+    column = parser.parse_to_table(records, ['wvl'], [True])['wvl']
+    assert column.shape == (6, 7) and column.data.strides[0] == 0
+    assert np.array_equal(column.data, legacy_table(parser, records, ['wvl'], [True])['wvl'].data)
+    two = [['a.fits', 'WVL', None, None, False], ['a.fits', 'WVL2', None, None, False]] * 3
+    records = [Record(['wvl'], [a]) for a in two]
+    column = parser.parse_to_table(records, ['wvl'], [True])['wvl']
+    assert isinstance(column, SharedColumn) and column.codes.tolist() == [0, 1] * 3
+    assert all(column[i] is column.categories[code] for i, code in enumerate(column.codes))
+    dense = legacy_table(parser, records, ['wvl'], [True])['wvl']
+    assert np.array_equal(column.dense().data, dense.data) and np.array_equal(dense.data, [wvl, wvl * 2] * 3)
+    copy = Table([column]).copy()
+    assert isinstance(copy['wvl'], SharedColumn) and np.array_equal(copy.dense()['wvl'].data, dense.data)
+    streamed = parser.stream_to_table(records * 2, ['wvl'], [True], chunksize=4, memory_budget=0, directory=tmp_path)
+    assert isinstance(streamed['wvl'], SharedColumn) and len(streamed['wvl'].categories) == 3 * 2  # 2 per chunk
+    assert np.array_equal(streamed['wvl'].dense().data, [wvl, wvl * 2] * 6)
+    copy.write(tmp_path / 'shared.fits')
+    assert np.array_equal(Table.read(tmp_path / 'shared.fits')['wvl'].data, dense.data)
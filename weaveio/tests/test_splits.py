@@ -1,3 +1,4 @@
+import numpy as np
 from weaveio import *
 from weaveio.readquery.results import Row
 from astropy.table import vstack
@@ -53,4 +54,14 @@ def test_continue_query_traverse(data):
     query = split_obs.l1stack_spectra
 
     for index, q in query:
-        assert np.all(count(q.l1single_spectra, wrt=q)() == 3)
\ No newline at end of file
+        assert np.all(count(q.l1single_spectra, wrt=q)() == 3)
+
+def test_called_split_matches_separate_subqueries(data):
+    split_obs = split(data.obs)
+    r = split_obs[[count(split_obs.l1single_spectra, wrt=split_obs), 'id']]
+    results = r(limit=None)
+    separate = {index: subquery(limit=None) for index, subquery in r}
+    assert len(results) == len(separate)
+    for index, (table, new) in results:
+        row = new._post_process_table(table, True)
+        assert list(row) == list(separate[index])
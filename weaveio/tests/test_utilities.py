@@ -1,4 +1,11 @@
 from weaveio.readquery.utilities import remove_successive_duplicate_lines
+from weaveio.utilities import lift_literals, replace_parameters
+from weaveio.writequery import CypherQuery, merge_node, merge_relationship
+from weaveio.data import rows_are_covered, Data
+import subprocess
+import sys
+from types import SimpleNamespace
+
 import pytest
 from string import printable
 from hypothesis import given, strategies as st, example
@@ -15,3 +22,76 @@ def test_remove_successive_duplicate_lines(x):
     for a, b in pairs:
         if a != b:
             assert (a, b) in pairs
+
+
+def test_lift_literals_gives_the_same_text_for_the_same_shape():
+    a, aparams = lift_literals("MATCH (run3:Run) WHERE run3.camera = 'red' AND run3.id > $param2 RETURN run3.id as r5 LIMIT 10",
+                               {'param2': 1}, {'run': 4, 'r': 6})
+    b, bparams = lift_literals("MATCH (run1:Run) WHERE run1.camera = 'blue' AND run1.id > $param0 RETURN run1.id as r0 LIMIT 5",
+                               {'param0': 2}, {'run': 4, 'r': 6})
+    assert a == b == "MATCH (run0:Run) WHERE run0.camera = $p0 AND run0.id > $p1 RETURN run0.id as r0 LIMIT $p2"
+    assert aparams == {'p0': 'red', 'p1': 1, 'p2': 10}
+    assert bparams == {'p0': 'blue', 'p1': 2, 'p2': 5}
+
+
+def test_lift_literals_leaves_non_literals_alone():
+    cypher = "CYPHER runtime=slotted\n// 'comment' 1\nMATCH (a)-[*1..3]->(b {`x 1`: \"it\\'s\"}) RETURN log10(b.x2) * 2.5e3, $tag"
+    lifted, params = lift_literals(cypher, {'tag': 'x', '_unused': 1})
+    assert lifted == "CYPHER runtime=slotted\n// 'comment' 1\nMATCH (a)-[*1..3]->(b {`x 1`: $p0}) RETURN log10(b.x2) * $p1, $p2"
+    assert params == {'_unused': 1, 'p0': "it's", 'p1': 2.5e3, 'p2': 'x'}
+
+
+def test_lift_literals_leaves_the_queries_of_a_conditional_write_alone():
+    with CypherQuery() as query:
+        run = merge_node(['Run'], {'id': 1}, {'camera': 'red'})
+        ob = merge_node(['OB'], {'id': 2}, {'mode': 'MOS'})
+        merge_relationship(run, ob, 'is_required_by', {'order': 0}, {'note': 'x'})
+    lines, params = query.render_query(parameterise=True)
+    cypher = '\n'.join(lines)
+    assert "'return null as is_required_by0'" in cypher and '"RETURN $time"' in cypher
+    assert 'call apoc.merge.relationship($parent, "is_required_by", $ident, $props, $child, $onmatch)' in cypher
+    assert all('$' not in value for value in params.values() if isinstance(value, str))
+    assert {'red', 'MOS', 'x', 1, 2} <= set(params.values())  # literals outside of apoc calls are still lifted
+
+
+def test_replace_parameters_only_replaces_whole_parameters():
+    cypher = "CALL apoc.do.when(x, 'RETURN $group1 as y', '') YIELD value\n// $group1\nWITH * WHERE a = $group1 AND b = $group10 RETURN a"
+    assert replace_parameters(cypher, {'group1': '_group.group1'}) == \
+           "CALL apoc.do.when(x, 'RETURN $group1 as y', '') YIELD value\n// $group1\nWITH * WHERE a = _group.group1 AND b = $group10 RETURN a"
+
+
+def test_import_is_lazy():
+    code = "import sys, weaveio; assert not {'astropy', 'py2neo', 'pandas', 'networkx', 'graphviz'} & set(sys.modules)"
+    subprocess.run([sys.executable, '-c', code], check=True)
+
+
+@pytest.mark.parametrize('module', ['weaveio.hierarchy', 'weaveio.readquery', 'weaveio.readquery.cache'])
+def test_submodules_import_in_a_fresh_interpreter(module):
+    subprocess.run([sys.executable, '-c', f'import {module}'], check=True)
+
+
+def test_lazy_names_are_the_query_functions():
+    import weaveio
+    import weaveio.readquery
+    assert set(weaveio._QUERY_NAMES) == set(weaveio.readquery.__all__)
+    assert all(getattr(weaveio, name) is getattr(weaveio.readquery, name) for name in weaveio._QUERY_NAMES)
+    with pytest.raises(AttributeError):
+        weaveio.writequery_typo
+
+
+@pytest.mark.parametrize('installed', [True, False])
+def test_records_are_streamed_with_the_driver_if_it_is_installed(monkeypatch, installed):
+    data = SimpleNamespace(graph=SimpleNamespace(execute=lambda cypher, **params: ('py2neo', cypher, params)),
+                           stream=lambda cypher, params: ('driver', cypher, params))
+    monkeypatch.setattr('weaveio.data.find_spec', lambda name: object() if installed else None)
+    read = Data.read_records(data, 'RETURN $x', {'x': 1})
+    assert read == ('driver' if installed else 'py2neo', 'RETURN $x', {'x': 1})
+
+
+@given(st.lists(st.tuples(st.integers(0, 50), st.integers(0, 10))), st.integers(0, 60), st.integers(0, 60), st.integers(1, 3))
+def test_rows_are_covered_matches_rowwise_check(intervals, start, stop, step):
+    starts = [s for s, n in intervals]
+    ends = [s + n for s, n in intervals]
+    rows = range(start, stop, step)
+    expected = all(any(s <= row <= e for s, e in zip(starts, ends)) for row in rows)
+    assert rows_are_covered(rows, starts, ends) == expected
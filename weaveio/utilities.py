@@ -1,4 +1,10 @@
+import os
 import re
+from collections import defaultdict
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Tuple, Optional
+
 import xxhash
 import inflect
 
@@ -78,4 +84,167 @@ def hash_pandas_dataframe(df):
 def int_or_none(x):
     if x is None:
         return None
-    return int(x)
\ No newline at end of file
+    return int(x)
+
+
+def cache_directory() -> Path:
+    """
+    Returns the directory in which weaveio persists things it derives (e.g. path lookup tables).
+    This is `~/.cache/weaveio` unless the WEAVEIO_CACHE_DIR environment variable is set
+    """
+    path = Path(os.getenv('WEAVEIO_CACHE_DIR', Path.home() / '.cache' / 'weaveio'))
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+@lru_cache(maxsize=None)
+def json_encoders() -> Optional[dict]:
+    """
+    Returns fastapi's table of json encoders (importing fastapi only once) or None if it is not installed
+    """
+    try:
+        from fastapi.encoders import ENCODERS_BY_TYPE
+    except ImportError:
+        return None
+    return ENCODERS_BY_TYPE
+
+
+def register_json_encoder(cls, encoder):
+    """
+    Tell fastapi how to serialise instances of `cls`, if fastapi is installed
+    """
+    encoders = json_encoders()
+    if encoders is not None and cls not in encoders:
+        encoders[cls] = encoder
+
+
+CYPHER_TOKENS = re.compile(r"""
+    (?P<comment>//[^\n]*)
+  | (?P<string>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<escaped>`[^`]*`)
+  | (?P<parameter>\$\w+)
+  | (?P<identifier>[^\W\d]\w*)
+  | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+""", re.VERBOSE)
+CYPHER_ESCAPES = {'\\': '\\', "'": "'", '"': '"', 'n': '\n', 't': '\t', 'b': '\b', 'f': '\f', 'r': '\r'}
+CYPHER_CALL = re.compile(r'\s*\(')
+APOC_CALL = re.compile(r'(\s*\.\s*\w+)+\s*\(')  # follows `apoc` in a call such as `apoc.do.when(`
+CYPHER_PREAMBLE = re.compile(r'(\s*(CYPHER|PROFILE|EXPLAIN)\b[^\n]*\n)*', re.IGNORECASE)
+
+
+def unescape_cypher_string(literal: str) -> Optional[str]:
+    """
+    Returns the value of a quoted cypher string literal or None if it uses an escape we don't know about
+    """
+    def replace(match):
+        escape = match.group(1)
+        if escape[0] in 'uU':
+            return chr(int(escape[1:], 16))
+        return CYPHER_ESCAPES[escape]
+    try:
+        return re.sub(r'\\(u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8}|.)', replace, literal[1:-1])
+    except KeyError:
+        return None
+
+
+def split_variable_name(name: str, variables: Dict[str, int]) -> Optional[str]:
+    """
+    Returns the prefix of `name` if it was made by a `{prefix}{count}` variable counter, None if that is not certain
+    """
+    prefixes = [name[:i] for i in range(1, len(name)) if name[i:].isdigit() and (name[i] != '0' or i == len(name) - 1)
+                and int(name[i:]) < variables.get(name[:i], 0)]
+    return prefixes[0] if len(prefixes) == 1 else None
+
+
+def replace_parameters(cypher: str, replacements: Dict[str, str]) -> str:
+    """
+    Replaces the parameters named in `replacements` (given without their leading "$") by the cypher expressions they map to.
+    Only whole parameters are replaced, so strings, comments and parameters whose names merely start the same are left alone.
+    """
+    def replace(token):
+        if token.lastgroup == 'parameter' and token.group()[1:] in replacements:
+            return replacements[token.group()[1:]]
+        return token.group()
+    return CYPHER_TOKENS.sub(replace, cypher)
+
+
+def lift_literals(cypher: str, parameters: dict, variables: Dict[str, int] = None) -> Tuple[str, dict]:
+    """
+    Rewrites cypher so that its text only depends on the shape of the query, so that neo4j can reuse its cached plan:
+        - string and number literals are replaced by parameters
+        - parameters are renamed to $p0, $p1, ... in order of appearance
+        - if `variables` (the counters that made the variable names) is given, variables are renumbered in order of appearance
+    Leading CYPHER/PROFILE/EXPLAIN lines, comments and `escaped` names are left alone.
+    So are strings given to apoc procedures and functions, since they are often queries in their own right
+    (e.g. `apoc.do.when(condition, 'query if true', 'query if false', params)`).
+    Parameters are given and returned without their leading "$". Those not used in the query are returned unchanged.
+    """
+    preamble = CYPHER_PREAMBLE.match(cypher).group()
+    body = cypher[len(preamble):]
+    tokens = list(CYPHER_TOKENS.finditer(body))
+    used_parameters = {t.group()[1:] for t in tokens if t.lastgroup == 'parameter'} & set(parameters)
+    lifted = {k: v for k, v in parameters.items() if k not in used_parameters}
+    renamed_parameters, renamed_variables, counts = {}, {}, defaultdict(int)
+    if variables is not None:
+        names = {t.group() for t in tokens if t.lastgroup == 'identifier'}
+        prefixes = {n: split_variable_name(n, variables) for n in names}
+        taken = {n for n, p in prefixes.items() if p is None}
+    else:
+        prefixes, taken = {}, set()
+
+    def new_name(prefix, unavailable):
+        while True:
+            name = f'{prefix}{counts[prefix]}'
+            counts[prefix] += 1
+            if name not in unavailable:
+                return name
+
+    def is_property(i):
+        while i > 0 and body[i-1].isspace():
+            i -= 1
+        return body[i-1:i] == '.'
+
+    def add_parameter(value):
+        name = new_name('p', lifted)
+        lifted[name] = value
+        return f'${name}'
+
+    depth, apoc_calls = 0, []  # the bracket depth of the arguments of each apoc call that we are in
+
+    def count_brackets(text):
+        nonlocal depth
+        for character in text:
+            if character == '(':
+                depth += 1
+            elif character == ')':
+                depth -= 1
+                if apoc_calls and apoc_calls[-1] > depth:  # the end of the call's arguments
+                    apoc_calls.pop()
+
+    out, position = [preamble], 0
+    for token in tokens:
+        kind, text = token.lastgroup, token.group()
+        count_brackets(body[position:token.start()])
+        replacement = text
+        if kind == 'identifier' and text.lower() == 'apoc' and not is_property(token.start()) \
+                and APOC_CALL.match(body, token.end()):
+            apoc_calls.append(depth + 1)
+        if kind == 'parameter' and text[1:] in used_parameters:
+            if text not in renamed_parameters:
+                renamed_parameters[text] = add_parameter(parameters[text[1:]])
+            replacement = renamed_parameters[text]
+        elif kind == 'string' and not apoc_calls:
+            value = unescape_cypher_string(text)
+            if value is not None:
+                replacement = add_parameter(value)
+        elif kind == 'number' and not body.endswith(('*', '..'), 0, token.start()):  # variable length patterns cannot be parameters
+            replacement = add_parameter(float(text) if any(c in text for c in '.eE') else int(text))
+        elif kind == 'identifier' and prefixes.get(text) is not None and not is_property(token.start()) \
+                and not CYPHER_CALL.match(body, token.end()):
+            if text not in renamed_variables:
+                renamed_variables[text] = new_name(prefixes[text], taken)
+            replacement = renamed_variables[text]
+        out += [body[position:token.start()], replacement]
+        position = token.end()
+    out.append(body[position:])
+    return ''.join(out), lifted
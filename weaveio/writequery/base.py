@@ -8,6 +8,7 @@ import re
 from warnings import warn
 
 from ..context import ContextMeta
+from ..utilities import lift_literals
 
 
 def camelcase(x):
@@ -68,7 +69,11 @@ class CypherQuery(metaclass=ContextMeta):
                     d[namehint] += 1
                     v._name = f'{namehint}{i}'
 
-    def render_query(self, procedure_tag='', as_lines=False, statement_batch_size=None, statement_batch_i=None):
+    def render_query(self, procedure_tag='', as_lines=False, statement_batch_size=None, statement_batch_i=None, parameterise=False):
+        """
+        Returns the cypher (as a list of lines) and the data parameters it uses.
+        If `parameterise`, literals are replaced by parameters so that batches of the same shape have the same cypher text
+        """
         if not isinstance(self.statements[-1], Returns):
             self.returns(self.timestamp)
         self.make_variable_names()
@@ -92,6 +97,10 @@ class CypherQuery(metaclass=ContextMeta):
         datadict = {d.name: d.data for d in self.data if any(d.name in q for q in qs)}
         q = '\n'.join(qs)
         q = dedent(re.sub(r'(custom\.[\w\d]+)\(', fr'\1-----{procedure_tag}(', q).replace('-----', ''))
+        if parameterise:
+            q, datadict = lift_literals(q, datadict)
+            if as_lines:
+                return q.split('\n'), datadict
         if as_lines:
             return qs, datadict
         return q.split('\n'), datadict
@@ -4,6 +4,8 @@ from typing import List, Dict, Union, Tuple, Optional, Iterable, Type
 from . import CypherQuery
 from .base import camelcase, Varname, Statement, CypherVariable, CypherData, CypherVariableItem, Collection
 
+QUERY_HASH_LABEL = '_QueryHashed'  # marks nodes whose relationships still carry a `_query_hash` from the current write
+
 
 def are_different(a: str, b: str) -> str:
     return f"apoc.coll.different([apoc.coll.flatten([[{a}]]), apoc.coll.flatten([[{b}]])])"
@@ -453,7 +455,7 @@ class MergeDependentNode(CollisionManager):
         WITH {aliases}, $time0 as time0
         {hashes}
         {merge_real_relations}
-        SET {self.out} += ${self.propvar}
+        SET {self.out} += ${self.propvar}, {self.out}:{QUERY_HASH_LABEL}
         RETURN {self.out}, {on_create_rel_returns}
         """
         iffalse = f"RETURN ${self.dummy} as {self.out}, {on_match_rel_returns}"